@@ -0,0 +1,267 @@
+"""Load and latency benchmark for the auth endpoints.
+
+Drives the app in process by default, against a temporary SQLite database and inside the app's lifespan so the
+start up hooks, including warm-up, run first. With --url it drives a running server instead. Users are seeded
+straight into the database with the crud helpers, so --url needs to point at a server using the same database, and
+every user the run created is deleted again afterwards.
+
+    python benchmark.py --requests 500 --concurrency 20 --mix auth=70,verify=20,signup=5,resetpassword=5
+    python benchmark.py --baseline bench_baseline.json --max-regression 0.1
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import sys
+import tempfile
+import time
+import uuid
+from collections import Counter
+from dataclasses import dataclass
+from datetime import timedelta
+import httpx
+from sqlalchemy import delete, select
+from sqlalchemy.orm import sessionmaker
+from config import settings
+from database.auth_models import Base, EmailOutbox, RefreshToken, User
+from database.auth_schemas import UserCreate
+from database.crud import create_user, get_user_by_username
+from jwt_utilities import encode_jwt
+from email_utils import PasswordResetEmail, VerificationEmail
+from hash_utils import build_password_hasher
+
+
+OPERATIONS = ("auth", "signup", "verify", "resetpassword")
+DEFAULT_MIX = "auth=70,verify=20,signup=5,resetpassword=5"
+BENCHMARK_PASSWORD = "benchmark-password"
+
+
+@dataclass
+class BenchmarkUser:
+    username: str
+    public_id: str
+    verify_token: str
+
+
+def parse_mix(mix: str) -> dict[str, float]:
+    weights = {}
+    for part in mix.split(","):
+        operation, weight = part.split("=")
+        if operation not in OPERATIONS:
+            raise ValueError(f"Unknown operation {operation}, expected one of {', '.join(OPERATIONS)}")
+        weights[operation] = float(weight)
+    return weights
+
+
+def seed_users(session_factory: sessionmaker, service: str, count: int, run_id: str) -> list[BenchmarkUser]:
+    password_hash = build_password_hasher().hash(BENCHMARK_PASSWORD)
+    users = []
+    with session_factory() as db:
+        for i in range(count):
+            user = UserCreate(email=f"bench-{run_id}-{i}@bench.test",
+                              username=f"bench-{run_id}-{i}",
+                              password_hash=password_hash)
+            db_user = create_user(db, user, service)
+            db_user.verified = True
+            verify_token = encode_jwt({"sub": db_user.public_id, "typ": VerificationEmail.token_type}, service,
+                                      expires_delta=timedelta(hours=1))
+            users.append(BenchmarkUser(db_user.username, db_user.public_id, verify_token))
+        db.commit()
+    return users
+
+
+# Deletes the seeded and signed up users of one run, along with their refresh tokens and queued emails
+def remove_users(session_factory: sessionmaker, service: str, run_id: str):
+    prefix = f"bench-{run_id}-"
+    with session_factory() as db:
+        public_ids = select(User.public_id).where(User.service == service, User.username.startswith(prefix))
+        db.execute(delete(RefreshToken).where(RefreshToken.service == service,
+                                              RefreshToken.public_id.in_(public_ids)))
+        db.execute(delete(EmailOutbox).where(EmailOutbox.to_email.startswith(prefix)))
+        db.execute(delete(User).where(User.service == service, User.username.startswith(prefix)))
+        db.commit()
+
+
+def percentile(sorted_values: list[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    rank = max(0, math.ceil(pct / 100 * len(sorted_values)) - 1)
+    return sorted_values[rank]
+
+
+def summarise(latencies: list[float], statuses: Counter, elapsed: float) -> dict:
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "rps": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "statuses": dict(statuses)
+    }
+
+
+class BenchmarkRunner:
+    def __init__(self, client: httpx.AsyncClient, session_factory: sessionmaker, service: str,
+                 users: list[BenchmarkUser], reset_users: list[BenchmarkUser], run_id: str):
+        self.client = client
+        self.session_factory = session_factory
+        self.service = service
+        self.users = users
+        self.run_id = run_id
+        self._signups = 0
+        # Each reset changes the user's password hash, so a user is only handed to one reset at a time
+        self._reset_users = asyncio.Queue()
+        for user in reset_users:
+            self._reset_users.put_nowait(user)
+
+    def _reset_path(self, username: str) -> str:
+        with self.session_factory() as db:
+            user = get_user_by_username(db, username, self.service)
+            return PasswordResetEmail(user, self.service, base_url='').token_url
+
+    async def run_operation(self, operation: str) -> tuple[float, int]:
+        match operation:
+            case "auth":
+                user = random.choice(self.users)
+                request = self.client.build_request("POST", f"/auth?service={self.service}",
+                                                    data={"username": user.username, "password": BENCHMARK_PASSWORD})
+            case "signup":
+                self._signups += 1
+                username = f"bench-{self.run_id}-signup-{self._signups}"
+                request = self.client.build_request("POST", f"/signup?service={self.service}",
+                                                    data={"email": f"{username}@bench.test",
+                                                          "username": username,
+                                                          "password": BENCHMARK_PASSWORD})
+            case "verify":
+                user = random.choice(self.users)
+                request = self.client.build_request("GET", "/verify", params={"token": user.verify_token,
+                                                                            "redirect_url": "http://bench.test"})
+            case "resetpassword":
+                user = await self._reset_users.get()
+                try:
+                    # Building the one time token reads the current hash, which is kept out of the timing
+                    path = await asyncio.to_thread(self._reset_path, user.username)
+                    request = self.client.build_request("POST", path, data={"new_password": BENCHMARK_PASSWORD})
+                    return await self._timed(request)
+                finally:
+                    self._reset_users.put_nowait(user)
+        return await self._timed(request)
+
+    async def _timed(self, request: httpx.Request) -> tuple[float, int]:
+        start = time.perf_counter()
+        response = await self.client.send(request)
+        return time.perf_counter() - start, response.status_code
+
+    async def run(self, mix: dict[str, float], total_requests: int, concurrency: int) -> dict:
+        operations = random.choices(list(mix), weights=list(mix.values()), k=total_requests)
+        results: dict[str, tuple[list[float], Counter]] = {operation: ([], Counter()) for operation in mix}
+        pending = iter(operations)
+
+        async def worker():
+            for operation in pending:
+                latency, status_code = await self.run_operation(operation)
+                latencies, statuses = results[operation]
+                latencies.append(latency)
+                statuses[status_code] += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+        all_latencies = [latency for latencies, _ in results.values() for latency in latencies]
+        all_statuses = sum((statuses for _, statuses in results.values()), Counter())
+        return {
+            "config": {"requests": total_requests, "concurrency": concurrency, "mix": mix},
+            "overall": summarise(all_latencies, all_statuses, elapsed),
+            "endpoints": {operation: summarise(latencies, statuses, elapsed)
+                          for operation, (latencies, statuses) in results.items()}
+        }
+
+
+async def run_benchmark(client: httpx.AsyncClient, session_factory: sessionmaker, service: str = "tourtracker",
+                        mix: str = DEFAULT_MIX, total_requests: int = 200, concurrency: int = 10,
+                        user_count: int = 20) -> dict:
+    run_id = uuid.uuid4().hex[:8]
+    weights = parse_mix(mix)
+    try:
+        users = await asyncio.to_thread(seed_users, session_factory, service, user_count, run_id)
+        reset_users = await asyncio.to_thread(seed_users, session_factory, service, concurrency, f"{run_id}-reset")
+        runner = BenchmarkRunner(client, session_factory, service, users, reset_users, run_id)
+        return await runner.run(weights, total_requests, concurrency)
+    finally:
+        await asyncio.to_thread(remove_users, session_factory, service, run_id)
+
+
+# Returns a description of every endpoint whose p95 latency or throughput regressed by more than max_regression
+def compare_to_baseline(results: dict, baseline: dict, max_regression: float) -> list[str]:
+    regressions = []
+    for name, current in [("overall", results["overall"]), *results["endpoints"].items()]:
+        previous = baseline["overall"] if name == "overall" else baseline["endpoints"].get(name)
+        if not previous:
+            continue
+        if previous["p95_ms"] and current["p95_ms"] > previous["p95_ms"] * (1 + max_regression):
+            regressions.append(f"{name} p95 {current['p95_ms']:.1f}ms vs baseline {previous['p95_ms']:.1f}ms")
+        if previous["rps"] and current["rps"] < previous["rps"] * (1 - max_regression):
+            regressions.append(f"{name} rps {current['rps']:.1f} vs baseline {previous['rps']:.1f}")
+    return regressions
+
+
+async def run_remote(args) -> dict:
+    from db_utils import SessionLocal
+    async with httpx.AsyncClient(base_url=args.url, timeout=30.0) as client:
+        return await run_benchmark(client, SessionLocal, args.service, args.mix, args.requests, args.concurrency,
+                                   args.users)
+
+
+# Points every session factory the app uses at a throwaway database, so the configured one is never touched
+async def run_in_process(args) -> dict:
+    from db_utils import SessionLocal, AsyncSessionLocal, create_db_engine, create_async_db_engine
+    from main import app
+    # Every request comes from the same client address, which the login throttle would otherwise reject
+    settings.THROTTLE_ENABLED = args.keep_throttling
+    with tempfile.TemporaryDirectory() as directory:
+        url = f"sqlite:///{directory}/benchmark.db"
+        db_engine, async_db_engine = create_db_engine(url), create_async_db_engine(url)
+        Base.metadata.create_all(bind=db_engine)
+        SessionLocal.configure(bind=db_engine)
+        AsyncSessionLocal.configure(bind=async_db_engine)
+        try:
+            async with app.router.lifespan_context(app):
+                async with httpx.AsyncClient(app=app, base_url="http://bench.test", timeout=30.0) as client:
+                    return await run_benchmark(client, SessionLocal, args.service, args.mix, args.requests,
+                                               args.concurrency, args.users)
+        finally:
+            await async_db_engine.dispose()
+            db_engine.dispose()
+
+
+async def main(args) -> int:
+    results = await (run_remote(args) if args.url else run_in_process(args))
+    print(json.dumps(results, indent=2))
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare_to_baseline(results, json.load(baseline_file), args.max_regression)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}", file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the auth endpoints")
+    parser.add_argument("--url", help="base URL of a running server, the app is driven in process if omitted")
+    parser.add_argument("--service", default="tourtracker")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="comma separated operation=weight pairs")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--users", type=int, default=20, help="number of users to seed")
+    parser.add_argument("--keep-throttling", action="store_true", help="leave login throttling on in process")
+    parser.add_argument("--baseline", help="fail if results regress against this stored result file")
+    parser.add_argument("--max-regression", type=float, default=0.1)
+    parser.add_argument("--save-baseline", help="write the results to this file")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,114 @@
+"""Picks argon2 parameters for this host that keep verify latency under a target at a given concurrency.
+
+    python calibrate_argon2.py --target-ms 250 --concurrency 4 --env-file .env
+
+The chosen ARGON2_* settings are printed, and written into --env-file if given. Existing hashes are upgraded to
+the new parameters as their users log in.
+"""
+import argparse
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Callable
+from argon2 import PasswordHasher
+from config import settings
+
+
+# OWASP's floor for argon2id memory, calibration never goes below it however slow the host is
+MIN_MEMORY_COST_KIB = 19 * 1024
+MAX_TIME_COST = 10
+CALIBRATION_PASSWORD = "calibration-password"
+
+
+@dataclass(frozen=True)
+class Argon2Parameters:
+    time_cost: int
+    memory_cost_kib: int
+    parallelism: int
+
+    def to_settings(self) -> dict[str, int]:
+        return {"ARGON2_TIME_COST": self.time_cost,
+                "ARGON2_MEMORY_COST_KIB": self.memory_cost_kib,
+                "ARGON2_PARALLELISM": self.parallelism}
+
+
+def _timed_verify(parameters: Argon2Parameters) -> float:
+    hasher = PasswordHasher(time_cost=parameters.time_cost,
+                            memory_cost=parameters.memory_cost_kib,
+                            parallelism=parameters.parallelism)
+    password_hash = hasher.hash(CALIBRATION_PASSWORD)
+    start = time.perf_counter()
+    hasher.verify(password_hash, CALIBRATION_PASSWORD)
+    return time.perf_counter() - start
+
+
+# Runs rounds * concurrency verifies, concurrency at a time, and returns the p95 latency
+def measure_latency(pool: ProcessPoolExecutor, parameters: Argon2Parameters, concurrency: int,
+                    rounds: int = 3) -> float:
+    latencies = sorted(pool.map(_timed_verify, [parameters] * (concurrency * rounds)))
+    return latencies[max(0, math.ceil(0.95 * len(latencies)) - 1)]
+
+
+def calibrate(measure: Callable[[Argon2Parameters], float], target_seconds: float, max_memory_cost_kib: int,
+              parallelism: int, min_memory_cost_kib: int = MIN_MEMORY_COST_KIB,
+              max_time_cost: int = MAX_TIME_COST) -> Argon2Parameters:
+    """Returns the most expensive parameters whose measured latency stays within target_seconds.
+
+    Memory is settled first, halving from max_memory_cost_kib until a single pass fits the target, then the
+    time cost is raised for as long as the target allows.
+    """
+    memory_cost_kib = max(max_memory_cost_kib, min_memory_cost_kib)
+    parameters = Argon2Parameters(1, memory_cost_kib, parallelism)
+    while measure(parameters) > target_seconds and memory_cost_kib // 2 >= min_memory_cost_kib:
+        memory_cost_kib //= 2
+        parameters = Argon2Parameters(1, memory_cost_kib, parallelism)
+    best = parameters
+    for time_cost in range(2, max_time_cost + 1):
+        parameters = Argon2Parameters(time_cost, memory_cost_kib, parallelism)
+        if measure(parameters) > target_seconds:
+            break
+        best = parameters
+    return best
+
+
+# Replaces the ARGON2_* lines already in the file and appends any that are missing
+def write_env_file(path: str, parameters: Argon2Parameters):
+    values = parameters.to_settings()
+    lines = []
+    if os.path.exists(path):
+        with open(path) as env_file:
+            lines = env_file.read().splitlines()
+    for i, line in enumerate(lines):
+        key = line.split("=", 1)[0].strip()
+        if key in values:
+            lines[i] = f"{key}={values.pop(key)}"
+    lines.extend(f"{key}={value}" for key, value in values.items())
+    with open(path, "w") as env_file:
+        env_file.write("\n".join(lines) + "\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Calibrate argon2 parameters for this host")
+    parser.add_argument("--target-ms", type=float, default=250, help="p95 verify latency to aim for")
+    parser.add_argument("--concurrency", type=int, default=settings.HASHING_MAX_CONCURRENCY,
+                        help="verifies running at once while measuring, defaults to HASHING_MAX_CONCURRENCY")
+    parser.add_argument("--parallelism", type=int, default=settings.ARGON2_PARALLELISM)
+    parser.add_argument("--max-memory-mib", type=int,
+                        help="defaults to HASHING_MEMORY_BUDGET_MIB split across --concurrency")
+    parser.add_argument("--env-file", help="write the chosen settings into this file")
+    args = parser.parse_args()
+    max_memory_mib = args.max_memory_mib or settings.HASHING_MEMORY_BUDGET_MIB // args.concurrency
+    with ProcessPoolExecutor(max_workers=args.concurrency) as pool:
+        def measure(parameters: Argon2Parameters) -> float:
+            latency = measure_latency(pool, parameters, args.concurrency)
+            print(f"t={parameters.time_cost} m={parameters.memory_cost_kib}KiB p={parameters.parallelism}: "
+                  f"p95 {latency * 1000:.1f}ms")
+            return latency
+
+        chosen = calibrate(measure, args.target_ms / 1000, max_memory_mib * 1024, args.parallelism)
+    for key, value in chosen.to_settings().items():
+        print(f"{key}={value}")
+    if args.env_file:
+        write_env_file(args.env_file, chosen)
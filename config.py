@@ -1,5 +1,7 @@
 from starlette.datastructures import CommaSeparatedStrings, Secret
 from starlette.config import Config
+from dataclasses import dataclass
+import os
 
 config = Config('.env')
 
@@ -16,7 +18,111 @@ class Settings():
     # Keys etc
     SECRET_KEY = config('SECRET_KEY', cast=Secret)
     JWT_ALGORITHM = config('JWT_ALGORITHM', cast=str)
+    # PEM private key, only used when JWT_ALGORITHM is an RS* or ES* algorithm
+    JWT_PRIVATE_KEY_PATH = config('JWT_PRIVATE_KEY_PATH', cast=str, default=None)
+    # Defaults to the RFC 7638 thumbprint of the public key
+    JWT_KEY_ID = config('JWT_KEY_ID', cast=str, default=None)
+    # One time tokens (e.g. password reset) are always HMAC signed with a per user secret
+    JWT_ONE_TIME_ALGORITHM = config('JWT_ONE_TIME_ALGORITHM', cast=str, default='HS256')
+    JWKS_MAX_AGE_SECONDS = config('JWKS_MAX_AGE_SECONDS', cast=int, default=3600)
     ACCESS_TOKEN_EXPIRE_MINUTES = config('ACCESS_TOKEN_EXPIRE_MINUTES', cast=int, default=60)
+    # Verification and password reset links, a reset request's password lock expires along with its link
+    ONE_TIME_TOKEN_EXPIRE_MINUTES = config('ONE_TIME_TOKEN_EXPIRE_MINUTES', cast=int, default=15)
+    # Refresh tokens rotate on every use, so this is how long a client can stay idle before logging in again
+    REFRESH_TOKEN_EXPIRE_DAYS = config('REFRESH_TOKEN_EXPIRE_DAYS', cast=int, default=30)
+    # 'sha256' (default) or 'argon2' for the access token fingerprint hash
+    FINGERPRINT_HASH_MODE = config('FINGERPRINT_HASH_MODE', cast=str, default='sha256')
+
+    # Token revocation, a Bloom filter of revoked jtis sits in front of the revoked_tokens table. Other processes'
+    # revocations are picked up every refresh, and expired rows are pruned on every rebuild
+    REVOCATION_BLOOM_CAPACITY = config('REVOCATION_BLOOM_CAPACITY', cast=int, default=100000)
+    REVOCATION_BLOOM_ERROR_RATE = config('REVOCATION_BLOOM_ERROR_RATE', cast=float, default=0.001)
+    REVOCATION_REFRESH_SECONDS = config('REVOCATION_REFRESH_SECONDS', cast=float, default=5)
+    REVOCATION_REBUILD_SECONDS = config('REVOCATION_REBUILD_SECONDS', cast=float, default=3600)
+    # How long a Bloom filter false positive confirmed against the table is trusted before it is checked again
+    REVOCATION_NEGATIVE_CACHE_SECONDS = config('REVOCATION_NEGATIVE_CACHE_SECONDS', cast=float, default=5)
+
+    # Token introspection cache
+    INTROSPECTION_CACHE_SIZE = config('INTROSPECTION_CACHE_SIZE', cast=int, default=10000)
+    INTROSPECTION_CACHE_TTL_SECONDS = config('INTROSPECTION_CACHE_TTL_SECONDS', cast=int, default=60)
+    INTROSPECTION_BATCH_MAX_TOKENS = config('INTROSPECTION_BATCH_MAX_TOKENS', cast=int, default=100)
+
+    # User lookup cache
+    USER_CACHE_SIZE = config('USER_CACHE_SIZE', cast=int, default=10000)
+    USER_CACHE_TTL_SECONDS = config('USER_CACHE_TTL_SECONDS', cast=int, default=30)
+
+    # Login throttling, token buckets per client IP and per (service, username or email)
+    THROTTLE_ENABLED = config('THROTTLE_ENABLED', cast=bool, default=True)
+    THROTTLE_IP_CAPACITY = config('THROTTLE_IP_CAPACITY', cast=float, default=30)
+    THROTTLE_IP_REFILL_PER_SECOND = config('THROTTLE_IP_REFILL_PER_SECOND', cast=float, default=0.5)
+    THROTTLE_IDENTITY_CAPACITY = config('THROTTLE_IDENTITY_CAPACITY', cast=float, default=5)
+    THROTTLE_IDENTITY_REFILL_PER_SECOND = config('THROTTLE_IDENTITY_REFILL_PER_SECOND', cast=float, default=0.05)
+
+    # Sweeper for unverified accounts, expired password locks and old outbox emails, see sweeper.py. Each batch is its own short
+    # transaction, with a pause between batches so the sweeper never holds the write lock for long
+    SWEEPER_UNVERIFIED_MAX_AGE_DAYS = config('SWEEPER_UNVERIFIED_MAX_AGE_DAYS', cast=int, default=7)
+    SWEEPER_ARCHIVE = config('SWEEPER_ARCHIVE', cast=bool, default=False)
+    SWEEPER_BATCH_SIZE = config('SWEEPER_BATCH_SIZE', cast=int, default=200)
+    SWEEPER_BATCH_PAUSE_SECONDS = config('SWEEPER_BATCH_PAUSE_SECONDS', cast=float, default=0.5)
+    SWEEPER_INTERVAL_SECONDS = config('SWEEPER_INTERVAL_SECONDS', cast=float, default=3600)
+
+    # Database, the async driver used on the request path is derived from DATABASE_URL
+    DATABASE_URL = config('DATABASE_URL', cast=str, default='sqlite:///./database/database.db')
+    DATABASE_POOL_SIZE = config('DATABASE_POOL_SIZE', cast=int, default=5)
+    DATABASE_MAX_OVERFLOW = config('DATABASE_MAX_OVERFLOW', cast=int, default=10)
+    DATABASE_POOL_TIMEOUT_SECONDS = config('DATABASE_POOL_TIMEOUT_SECONDS', cast=float, default=30)
+    DATABASE_POOL_RECYCLE_SECONDS = config('DATABASE_POOL_RECYCLE_SECONDS', cast=int, default=1800)
+    DATABASE_POOL_PRE_PING = config('DATABASE_POOL_PRE_PING', cast=bool, default=True)
+    # SQLite only, applied as pragmas on every new connection
+    SQLITE_BUSY_TIMEOUT_MS = config('SQLITE_BUSY_TIMEOUT_MS', cast=int, default=5000)
+    SQLITE_MMAP_SIZE = config('SQLITE_MMAP_SIZE', cast=int, default=256 * 1024 * 1024)
+
+    # Run warmup.warm_up before serving, trading a slower start up for a fast first request
+    WARMUP_ON_STARTUP = config('WARMUP_ON_STARTUP', cast=bool, default=True)
+
+    # server.py, SERVER_WORKERS=0 sizes the worker count from the cores and SERVER_MEMORY_BUDGET_MIB, which
+    # defaults to 75% of physical memory. Each worker may hold HASHING_MEMORY_BUDGET_MIB of argon2 memory on top of
+    # SERVER_WORKER_MEMORY_MIB for itself. Keep-alive should outlast the load balancer's idle timeout
+    SERVER_HOST = config('SERVER_HOST', cast=str, default='0.0.0.0')
+    SERVER_PORT = config('SERVER_PORT', cast=int, default=8000)
+    SERVER_WORKERS = config('SERVER_WORKERS', cast=int, default=0)
+    SERVER_MEMORY_BUDGET_MIB = config('SERVER_MEMORY_BUDGET_MIB', cast=int, default=0)
+    SERVER_WORKER_MEMORY_MIB = config('SERVER_WORKER_MEMORY_MIB', cast=int, default=150)
+    SERVER_BACKLOG = config('SERVER_BACKLOG', cast=int, default=2048)
+    SERVER_KEEPALIVE_SECONDS = config('SERVER_KEEPALIVE_SECONDS', cast=int, default=65)
+    SERVER_GRACEFUL_TIMEOUT_SECONDS = config('SERVER_GRACEFUL_TIMEOUT_SECONDS', cast=int, default=30)
+    # How long a worker keeps serving with /ready at 503 after SIGTERM, at least the load balancer's health check
+    # interval times its unhealthy threshold
+    SERVER_DRAIN_SECONDS = config('SERVER_DRAIN_SECONDS', cast=float, default=10)
+
+    # Shared state for throttles, revocations and cache invalidation, see state_store.py. Use sqlite whenever more
+    # than one worker serves requests, memory is only correct for a single process and server.py refuses to start
+    # more than one worker with it.
+    STATE_BACKEND = config('STATE_BACKEND', cast=str, default='memory')
+    STATE_STORE_PATH = config('STATE_STORE_PATH', cast=str, default='./database/state.db')
+    STATE_POLL_SECONDS = config('STATE_POLL_SECONDS', cast=float, default=0.25)
+    STATE_MESSAGE_RETENTION_SECONDS = config('STATE_MESSAGE_RETENTION_SECONDS', cast=float, default=60)
+
+    # Structured logging, see log_utils.py. LOG_SAMPLE_RATES is a list of path=rate pairs, e.g.
+    # /introspect=0.01,/metrics=0 keeps 1% of introspection logs; warnings and errors are never sampled out.
+    LOG_LEVEL = config('LOG_LEVEL', cast=str, default='INFO')
+    LOG_SAMPLE_RATES = config('LOG_SAMPLE_RATES', cast=CommaSeparatedStrings, default='')
+    LOG_DEFAULT_SAMPLE_RATE = config('LOG_DEFAULT_SAMPLE_RATE', cast=float, default=1.0)
+    LOG_QUEUE_SIZE = config('LOG_QUEUE_SIZE', cast=int, default=10000)
+    # Tokens in log lines are masked unless this is off, e.g. to click email links in local development
+    LOG_REDACT = config('LOG_REDACT', cast=bool, default=not DEBUG)
+
+    # Password hashing, the argon2 cost can be tuned for this host with calibrate_argon2.py.
+    # Hashes made with other parameters are upgraded the next time their user logs in
+    ARGON2_TIME_COST = config('ARGON2_TIME_COST', cast=int, default=3)
+    ARGON2_MEMORY_COST_KIB = config('ARGON2_MEMORY_COST_KIB', cast=int, default=65536)
+    ARGON2_PARALLELISM = config('ARGON2_PARALLELISM', cast=int, default=4)
+    HASHING_WORKERS = config('HASHING_WORKERS', cast=int, default=os.cpu_count() or 1)
+    # Admission control for hash/verify calls, over budget calls queue and are shed with a 503 after the max wait
+    HASHING_MEMORY_BUDGET_MIB = config('HASHING_MEMORY_BUDGET_MIB', cast=int, default=512)
+    HASHING_MAX_CONCURRENCY = config('HASHING_MAX_CONCURRENCY', cast=int, default=HASHING_WORKERS)
+    HASHING_MAX_QUEUE = config('HASHING_MAX_QUEUE', cast=int, default=100)
+    HASHING_MAX_QUEUE_WAIT_SECONDS = config('HASHING_MAX_QUEUE_WAIT_SECONDS', cast=float, default=2.0)
 
     # API keys etc
     SENDGRID_API_KEY = config('SENDGRID_API_KEY', cast=Secret)
@@ -24,13 +130,47 @@ class Settings():
     # Email addresses
     EMAIL_SENDER_ADDRESS = config('EMAIL_SENDER_ADDRESS', cast=str)
 
-    # Sendgrid Email Templates
-    TOURTRACKER_VERIFICATION_EMAIL_TEMPLATE_ID = config('TOURTRACKER_VERIFICATION_EMAIL_TEMPLATE_ID', cast=str)
-    TOURTRACKER_PASSWORD_RESET_EMAIL_TEMPLATE_ID = config('TOURTRACKER_PASSWORD_RESET_EMAIL_TEMPLATE_ID', cast=str)
-    TOURTRACKER_PASSWORD_RESET_CONFIRMATION_EMAIL_TEMPLATE_ID = config('TOURTRACKER_PASSWORD_RESET_CONFIRMATION_EMAIL_TEMPLATE_ID', cast=str)
-    ARCADE_VERIFICATION_EMAIL_TEMPLATE_ID = config('ARCADE_VERIFICATION_EMAIL_TEMPLATE_ID', cast=str)
-    ARCADE_PASSWORD_RESET_EMAIL_TEMPLATE_ID = config('ARCADE_PASSWORD_RESET_EMAIL_TEMPLATE_ID', cast=str)
-    ARCADE_PASSWORD_RESET_CONFIRMATION_EMAIL_TEMPLATE_ID = config('ARCADE_PASSWORD_RESET_CONFIRMATION_EMAIL_TEMPLATE_ID', cast=str)
+    # Email dispatch
+    SENDGRID_API_URL = config('SENDGRID_API_URL', cast=str, default='https://api.sendgrid.com/v3/mail/send')
+    EMAIL_CONCURRENCY = config('EMAIL_CONCURRENCY', cast=int, default=4)
+    EMAIL_BATCH_SIZE = config('EMAIL_BATCH_SIZE', cast=int, default=100)
+    EMAIL_MAX_RETRIES = config('EMAIL_MAX_RETRIES', cast=int, default=5)
+    EMAIL_RETRY_BACKOFF_SECONDS = config('EMAIL_RETRY_BACKOFF_SECONDS', cast=float, default=0.5)
+    EMAIL_OUTBOX_BATCH_SIZE = config('EMAIL_OUTBOX_BATCH_SIZE', cast=int, default=100)
+    EMAIL_OUTBOX_POLL_SECONDS = config('EMAIL_OUTBOX_POLL_SECONDS', cast=float, default=1.0)
+    # Emails claimed by a drainer that has not finished after this long are claimed again
+    EMAIL_OUTBOX_LEASE_SECONDS = config('EMAIL_OUTBOX_LEASE_SECONDS', cast=int, default=300)
+    EMAIL_OUTBOX_MAX_ATTEMPTS = config('EMAIL_OUTBOX_MAX_ATTEMPTS', cast=int, default=5)
+    # Sent and failed emails are deleted by the sweeper once they are this old
+    EMAIL_OUTBOX_RETENTION_DAYS = config('EMAIL_OUTBOX_RETENTION_DAYS', cast=int, default=7)
+
+    # Services (tenants) sharing the users table. Each one needs its SendGrid templates set as
+    # <SERVICE>_VERIFICATION_EMAIL_TEMPLATE_ID, <SERVICE>_PASSWORD_RESET_EMAIL_TEMPLATE_ID and
+    # <SERVICE>_PASSWORD_RESET_CONFIRMATION_EMAIL_TEMPLATE_ID
+    SERVICES = config('SERVICES', cast=CommaSeparatedStrings, default='tourtracker,arcade')
+
+
+@dataclass(frozen=True)
+class ServiceSettings:
+    name: str
+    verification_email_template_id: str
+    password_reset_email_template_id: str
+    password_reset_confirmation_email_template_id: str
+
+
+def load_services(service_names) -> dict[str, ServiceSettings]:
+    services = {}
+    for name in service_names:
+        prefix = name.upper()
+        services[name] = ServiceSettings(
+            name=name,
+            verification_email_template_id=config(f'{prefix}_VERIFICATION_EMAIL_TEMPLATE_ID', cast=str),
+            password_reset_email_template_id=config(f'{prefix}_PASSWORD_RESET_EMAIL_TEMPLATE_ID', cast=str),
+            password_reset_confirmation_email_template_id=config(
+                f'{prefix}_PASSWORD_RESET_CONFIRMATION_EMAIL_TEMPLATE_ID', cast=str)
+        )
+    return services
 
 
-settings = Settings()
\ No newline at end of file
+settings = Settings()
+services = load_services(settings.SERVICES)
\ No newline at end of file
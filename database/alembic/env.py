@@ -1,3 +1,4 @@
+import os
 from logging.config import fileConfig
 
 from sqlalchemy import engine_from_config
@@ -9,6 +10,10 @@ from alembic import context
 # access to the values within the .ini file in use.
 config = context.config
 
+# DATABASE_URL from the environment wins over alembic.ini, so migrations can target the same database as the app
+if os.environ.get("DATABASE_URL"):
+    config.set_main_option("sqlalchemy.url", os.environ["DATABASE_URL"])
+
 # Interpret the config file for Python logging.
 # This line sets up loggers basically.
 if config.config_file_name is not None:
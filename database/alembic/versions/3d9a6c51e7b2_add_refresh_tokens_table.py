@@ -0,0 +1,41 @@
+"""add refresh tokens table
+
+Revision ID: 3d9a6c51e7b2
+Revises: b83d5e61c2f4
+Create Date: 2026-10-18 15:02:17.540912
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3d9a6c51e7b2'
+down_revision = 'b83d5e61c2f4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'refresh_tokens',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('token_hash', sa.String, nullable=False),
+        sa.Column('family_id', sa.String, nullable=False),
+        sa.Column('service', sa.String, nullable=False),
+        sa.Column('public_id', sa.String, nullable=False),
+        sa.Column('created_at', sa.Integer),
+        sa.Column('expires_at', sa.Integer),
+        sa.Column('used_at', sa.Integer, nullable=True),
+        sa.Column('revoked', sa.Boolean, default=False)
+    )
+    op.create_index('ix_refresh_tokens_token_hash', 'refresh_tokens', ['token_hash'], unique=True)
+    op.create_index('ix_refresh_tokens_family_id', 'refresh_tokens', ['family_id'])
+    op.create_index('ix_refresh_tokens_service_public_id', 'refresh_tokens', ['service', 'public_id'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_refresh_tokens_service_public_id', 'refresh_tokens')
+    op.drop_index('ix_refresh_tokens_family_id', 'refresh_tokens')
+    op.drop_index('ix_refresh_tokens_token_hash', 'refresh_tokens')
+    op.drop_table('refresh_tokens')
@@ -0,0 +1,39 @@
+"""add email outbox table
+
+Revision ID: 7c1e4f2a9b30
+Revises: 54abce624803
+Create Date: 2026-10-18 10:12:41.118203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c1e4f2a9b30'
+down_revision = '54abce624803'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'email_outbox',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('to_email', sa.String),
+        sa.Column('subject', sa.String),
+        sa.Column('template_id', sa.String),
+        sa.Column('template_data', sa.JSON),
+        sa.Column('status', sa.String, default='pending'),
+        sa.Column('attempts', sa.Integer, default=0),
+        sa.Column('last_error', sa.String, nullable=True),
+        sa.Column('created_at', sa.Integer),
+        sa.Column('claimed_at', sa.Integer, nullable=True),
+        sa.Column('sent_at', sa.Integer, nullable=True)
+    )
+    op.create_index('ix_email_outbox_status_id', 'email_outbox', ['status', 'id'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_email_outbox_status_id', 'email_outbox')
+    op.drop_table('email_outbox')
@@ -0,0 +1,34 @@
+"""add revoked tokens table
+
+Revision ID: a61f0d2c8e47
+Revises: 3d9a6c51e7b2
+Create Date: 2026-10-18 16:24:53.207731
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a61f0d2c8e47'
+down_revision = '3d9a6c51e7b2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'revoked_tokens',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('jti', sa.String, nullable=False),
+        sa.Column('expires_at', sa.Integer, nullable=False),
+        sa.Column('revoked_at', sa.Integer)
+    )
+    op.create_index('ix_revoked_tokens_jti', 'revoked_tokens', ['jti'], unique=True)
+    op.create_index('ix_revoked_tokens_expires_at', 'revoked_tokens', ['expires_at'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_revoked_tokens_expires_at', 'revoked_tokens')
+    op.drop_index('ix_revoked_tokens_jti', 'revoked_tokens')
+    op.drop_table('revoked_tokens')
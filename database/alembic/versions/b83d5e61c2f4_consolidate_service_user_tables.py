@@ -0,0 +1,64 @@
+"""consolidate service user tables
+
+Revision ID: b83d5e61c2f4
+Revises: 7c1e4f2a9b30
+Create Date: 2026-10-18 11:02:17.482915
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b83d5e61c2f4'
+down_revision = '7c1e4f2a9b30'
+branch_labels = None
+depends_on = None
+
+# Table each existing service's users are moved out of
+SERVICE_TABLES = {
+    'tourtracker': 'tourtrackerusers',
+    'arcade': 'arcadeusers'
+}
+USER_COLUMNS = 'email, username, public_id, password_hash, verified, password_locked, created_at'
+
+
+def upgrade() -> None:
+    op.create_table(
+        'users',
+        sa.Column('id', sa.Integer, primary_key=True, index=True),
+        sa.Column('service', sa.String, nullable=False),
+        sa.Column('email', sa.String),
+        sa.Column('username', sa.String),
+        sa.Column('public_id', sa.String),
+        sa.Column('password_hash', sa.String),
+        sa.Column('verified', sa.Boolean, default=False),
+        sa.Column('password_locked', sa.Boolean, default=False),
+        sa.Column('created_at', sa.Integer)
+    )
+    op.create_index('ix_users_service_username', 'users', ['service', 'username'], unique=True)
+    op.create_index('ix_users_service_email', 'users', ['service', 'email'], unique=True)
+    op.create_index('ix_users_service_public_id', 'users', ['service', 'public_id'], unique=True)
+    for service, table in SERVICE_TABLES.items():
+        op.execute(f"INSERT INTO users (service, {USER_COLUMNS}) SELECT '{service}', {USER_COLUMNS} FROM {table}")
+        op.drop_table(table)
+
+
+def downgrade() -> None:
+    for service, table in SERVICE_TABLES.items():
+        op.create_table(
+            table,
+            sa.Column('id', sa.Integer, primary_key=True, index=True),
+            sa.Column('email', sa.String(100), unique=True, index=True),
+            sa.Column('username', sa.String(50), unique=True, index=True),
+            sa.Column('password_hash', sa.String(100)),
+            sa.Column('verified', sa.Boolean, default=False),
+            sa.Column('password_locked', sa.Boolean, default=False),
+            sa.Column('created_at', sa.Integer),
+            sa.Column('public_id', sa.String)
+        )
+        op.execute(f"INSERT INTO {table} ({USER_COLUMNS}) SELECT {USER_COLUMNS} FROM users WHERE service = '{service}'")
+    op.drop_index('ix_users_service_public_id', 'users')
+    op.drop_index('ix_users_service_email', 'users')
+    op.drop_index('ix_users_service_username', 'users')
+    op.drop_table('users')
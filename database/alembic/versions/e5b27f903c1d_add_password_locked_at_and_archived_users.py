@@ -0,0 +1,45 @@
+"""add password locked at and archived users
+
+Revision ID: e5b27f903c1d
+Revises: a61f0d2c8e47
+Create Date: 2026-10-18 18:41:06.731250
+
+"""
+import time
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5b27f903c1d'
+down_revision = 'a61f0d2c8e47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('users', sa.Column('password_locked_at', sa.Integer, nullable=True))
+    # Locks from before this migration have no time, so they are treated as starting now
+    op.execute(f"UPDATE users SET password_locked_at = {int(time.time())} WHERE password_locked")
+    op.create_index('ix_users_verified_created_at', 'users', ['verified', 'created_at'])
+    op.create_index('ix_users_password_locked_at', 'users', ['password_locked_at'])
+    op.create_table(
+        'archived_users',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('service', sa.String, nullable=False),
+        sa.Column('email', sa.String),
+        sa.Column('username', sa.String),
+        sa.Column('public_id', sa.String),
+        sa.Column('password_hash', sa.String),
+        sa.Column('created_at', sa.Integer),
+        sa.Column('archived_at', sa.Integer),
+        sa.Column('archive_reason', sa.String)
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('archived_users')
+    op.drop_index('ix_users_password_locked_at', 'users')
+    op.drop_index('ix_users_verified_created_at', 'users')
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.drop_column('password_locked_at')
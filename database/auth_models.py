@@ -1,37 +1,123 @@
-from sqlalchemy import Boolean, Column, String, Integer
+from sqlalchemy import Boolean, Column, String, Integer, JSON, Index
 from sqlalchemy.orm import DeclarativeBase
-from argon2 import PasswordHasher
 from argon2 import exceptions as argonexceptions
+from config import settings
+from hash_utils import build_password_hasher
+import hashlib
+import hmac
 import secrets
 
 
-class BaseUser(DeclarativeBase):
+class Base(DeclarativeBase):
+    pass
+
+
+# One table for every service, usernames, emails and public ids are only unique within a service
+class User(Base):
+    __tablename__ = "users"
+    __table_args__ = (
+        Index("ix_users_service_username", "service", "username", unique=True),
+        Index("ix_users_service_email", "service", "email", unique=True),
+        Index("ix_users_service_public_id", "service", "public_id", unique=True),
+        # For the sweeper, see sweeper.py
+        Index("ix_users_verified_created_at", "verified", "created_at"),
+        Index("ix_users_password_locked_at", "password_locked_at"),
+    )
     id = Column(Integer, primary_key=True, index=True)
-    email = Column(String, unique=True, index=True)
-    username = Column(String, unique=True, index=True)
-    public_id = Column(String, unique=True, index=True)
+    service = Column(String, nullable=False)
+    email = Column(String)
+    username = Column(String)
+    public_id = Column(String)
     password_hash = Column(String)
     verified = Column(Boolean, default=False)
     password_locked = Column(Boolean, default=False)
+    password_locked_at = Column(Integer, nullable=True)
     created_at = Column(Integer)
-    pwd_hasher = PasswordHasher()
+    pwd_hasher = build_password_hasher()
 
+    # Upgrades a hash made with out of date argon2 parameters in place, the caller commits it
     def authenticate_user(self, password):
         try:
             self.pwd_hasher.verify(self.password_hash, password)
         except argonexceptions.VerifyMismatchError:
             return False
+        if self.pwd_hasher.check_needs_rehash(self.password_hash):
+            self.password_hash = self.pwd_hasher.hash(password)
         return True
 
+    # The fingerprint is a 256 bit random value so a fast digest is enough, as per
+    # https://cheatsheetseries.owasp.org/cheatsheets/JSON_Web_Token_for_Java_Cheat_Sheet.html
     def generate_user_fingerprint(self):
         fingerprint = secrets.token_urlsafe(32)
-        fingerprint_hash = self.pwd_hasher.hash(fingerprint)
+        if settings.FINGERPRINT_HASH_MODE == 'argon2':
+            fingerprint_hash = self.pwd_hasher.hash(fingerprint)
+        else:
+            fingerprint_hash = hashlib.sha256(fingerprint.encode()).hexdigest()
         return fingerprint, fingerprint_hash
 
+    # Accepts both SHA-256 digests and argon2 hashes so tokens issued before the switch still verify
+    @classmethod
+    def verify_user_fingerprint(cls, fingerprint: str, fingerprint_hash: str) -> bool:
+        if fingerprint_hash.startswith('$argon2'):
+            try:
+                return cls.pwd_hasher.verify(fingerprint_hash, fingerprint)
+            except argonexceptions.VerificationError:
+                return False
+        return hmac.compare_digest(hashlib.sha256(fingerprint.encode()).hexdigest(), fingerprint_hash)
+
+
+# Emails are written here in the same transaction as the change that triggers them and sent by email_outbox.py
+class EmailOutbox(Base):
+    __tablename__ = "email_outbox"
+    __table_args__ = (Index("ix_email_outbox_status_id", "status", "id"),)
+    id = Column(Integer, primary_key=True)
+    to_email = Column(String)
+    subject = Column(String)
+    template_id = Column(String)
+    template_data = Column(JSON)
+    status = Column(String, default="pending")
+    attempts = Column(Integer, default=0)
+    last_error = Column(String, nullable=True)
+    created_at = Column(Integer)
+    claimed_at = Column(Integer, nullable=True)
+    sent_at = Column(Integer, nullable=True)
+
 
-class TourTrackerUser(BaseUser):
-    __tablename__ = "tourtrackerusers"
 
+# Only an HMAC of each refresh token is stored. Every rotation issues a new row in the same family, and presenting
+# an already used token revokes the whole family
+class RefreshToken(Base):
+    __tablename__ = "refresh_tokens"
+    __table_args__ = (Index("ix_refresh_tokens_service_public_id", "service", "public_id"),)
+    id = Column(Integer, primary_key=True)
+    token_hash = Column(String, nullable=False, unique=True, index=True)
+    family_id = Column(String, nullable=False, index=True)
+    service = Column(String, nullable=False)
+    public_id = Column(String, nullable=False)
+    created_at = Column(Integer)
+    expires_at = Column(Integer)
+    used_at = Column(Integer, nullable=True)
+    revoked = Column(Boolean, default=False)
+
+
+# jtis of tokens revoked before their exp, rows can be pruned once expires_at has passed
+class RevokedToken(Base):
+    __tablename__ = "revoked_tokens"
+    id = Column(Integer, primary_key=True)
+    jti = Column(String, nullable=False, unique=True, index=True)
+    expires_at = Column(Integer, nullable=False, index=True)
+    revoked_at = Column(Integer)
 
-class ArcadeUser(BaseUser):
-    __tablename__ = "arcadeusers"
+
+# Users removed by the sweeper when SWEEPER_ARCHIVE is set, id is the user's id in the users table
+class ArchivedUser(Base):
+    __tablename__ = "archived_users"
+    id = Column(Integer, primary_key=True)
+    service = Column(String, nullable=False)
+    email = Column(String)
+    username = Column(String)
+    public_id = Column(String)
+    password_hash = Column(String)
+    created_at = Column(Integer)
+    archived_at = Column(Integer)
+    archive_reason = Column(String)
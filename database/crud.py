@@ -1,43 +1,43 @@
+import hashlib
+import hmac
+import secrets
 import uuid
 
-from sqlalchemy.orm import Session
+from sqlalchemy import select, insert, update, delete, func, case, literal, null, or_, and_, tuple_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, make_transient_to_detached
 from . import auth_models, auth_schemas
+from email_dispatcher import EmailMessage
+from cache_utils import TTLCache
+from config import settings
+from metrics import DB_QUERY_DURATION
+from state_store import state_store
 import time
 
 
-# TODO: try and collate all these match case statements for DRY and improved maintainability
+# Every lookup filters on service plus one column, matching one of the composite (service, ...) indexes
+def _select_user_by(service, field: str, value):
+    return select(auth_models.User).where(auth_models.User.service == service,
+                                          getattr(auth_models.User, field) == value).limit(1)
 
 
-def get_user_by_public_id(db: Session, public_id: str, service) -> auth_models.BaseUser:
-    match service:
-        case "tourtracker":
-            return db.query(auth_models.TourTrackerUser).filter(auth_models.TourTrackerUser.public_id == public_id).first()
-        case "arcade":
-            return db.query(auth_models.ArcadeUser).filter(auth_models.ArcadeUser.public_id == public_id).first()
+def get_user_by_public_id(db: Session, public_id: str, service) -> auth_models.User:
+    return db.scalars(_select_user_by(service, "public_id", public_id)).first()
 
 
-def get_user_by_email(db: Session, email: str, service) -> auth_models.BaseUser:
-    match service:
-        case "tourtracker":
-            return db.query(auth_models.TourTrackerUser).filter(auth_models.TourTrackerUser.email == email).first()
-        case "arcade":
-            return db.query(auth_models.ArcadeUser).filter(auth_models.ArcadeUser.email == email).first()
+def get_user_by_email(db: Session, email: str, service) -> auth_models.User:
+    return db.scalars(_select_user_by(service, "email", email)).first()
 
 
-def get_user_by_username(db: Session, username: str, service) -> auth_models.BaseUser:
-    match service:
-        case "tourtracker":
-            return db.query(auth_models.TourTrackerUser).filter(auth_models.TourTrackerUser.username == username).first()
-        case "arcade":
-            return db.query(auth_models.ArcadeUser).filter(auth_models.ArcadeUser.username == username).first()
+def get_user_by_username(db: Session, username: str, service) -> auth_models.User:
+    return db.scalars(_select_user_by(service, "username", username)).first()
 
 
-def create_user(db: Session, user: auth_schemas.UserCreate, service) -> auth_models.BaseUser:
-    match service:
-        case "tourtracker":
-            db_user = auth_models.TourTrackerUser(email=user.email, username=user.username, password_hash=user.password_hash)
-        case "arcade":
-            db_user = auth_models.ArcadeUser(email=user.email, username=user.username, password_hash=user.password_hash)
+def create_user(db: Session, user: auth_schemas.UserCreate, service) -> auth_models.User:
+    db_user = auth_models.User(service=service, email=user.email, username=user.username,
+                               password_hash=user.password_hash)
     db_user.created_at = int(time.time())
     db_user.public_id = str(uuid.uuid4())
     db.add(db_user)
@@ -46,4 +46,377 @@ def create_user(db: Session, user: auth_schemas.UserCreate, service) -> auth_mod
     return db_user
 
 
+# Inserts a batch of users as one executemany, skipping any whose email or username is already taken in the
+# service, including by an earlier row of the same batch. Returns whether each user was inserted. The caller commits
+def create_users_bulk(db: Session, users: list[auth_schemas.UserCreate], service,
+                      verified: list[bool] | None = None) -> list[bool]:
+    model = auth_models.User
+    now = int(time.time())
+    rows = [{"service": service, "email": user.email, "username": user.username,
+             "password_hash": user.password_hash, "public_id": str(uuid.uuid4()), "created_at": now,
+             "verified": verified[i] if verified else False, "password_locked": False}
+            for i, user in enumerate(users)]
+    if not rows:
+        return []
+    statement = _insert_ignoring_conflicts(db, model)
+    with DB_QUERY_DURATION.time(query="create_users_bulk"):
+        if statement is not None:
+            inserted = set(db.scalars(statement.returning(model.public_id), rows))
+        else:
+            inserted = set()
+            for row in rows:
+                try:
+                    with db.begin_nested():
+                        db.execute(insert(model).values(**row))
+                    inserted.add(row["public_id"])
+                except IntegrityError:
+                    pass
+    return [row["public_id"] in inserted for row in rows]
 
+
+# Async versions used on the request path
+
+# Read through cache of user rows keyed by (service, field, value). Entries are column snapshots rather than ORM
+# instances so they are never shared between sessions. Callers must invalidate_cached_user after committing
+# a change to a user, which also evicts the user from every other worker's cache.
+user_cache = TTLCache(settings.USER_CACHE_SIZE, settings.USER_CACHE_TTL_SECONDS)
+USER_CACHE_FIELDS = ("username", "email", "public_id")
+USER_CACHE_CHANNEL = "user_cache"
+
+
+def _snapshot_user(user: auth_models.User) -> dict:
+    return {column.key: getattr(user, column.key) for column in auth_models.User.__table__.columns}
+
+
+def _evict_cached_user(keys: list):
+    for key in keys:
+        user_cache.delete(tuple(key))
+
+
+# users can be User objects or rows with the service and USER_CACHE_FIELDS columns, e.g. from the sweeps below
+async def invalidate_cached_users(users):
+    keys = [(user.service, field, getattr(user, field)) for user in users for field in USER_CACHE_FIELDS]
+    if keys:
+        _evict_cached_user(keys)
+        await state_store.publish(USER_CACHE_CHANNEL, keys)
+
+
+async def invalidate_cached_user(user: auth_models.User):
+    await invalidate_cached_users([user])
+
+
+state_store.subscribe(USER_CACHE_CHANNEL, _evict_cached_user)
+
+
+async def _get_user_by(db: AsyncSession, service, field: str, value) -> auth_models.User | None:
+    snapshot = user_cache.get((service, field, value))
+    if snapshot is not None:
+        # Attach a copy to the session as if it had just been loaded, so changes to it still flush as updates
+        user = auth_models.User(**snapshot)
+        make_transient_to_detached(user)
+        return await db.merge(user, load=False)
+    with DB_QUERY_DURATION.time(query=f"get_user_by_{field}"):
+        result = await db.execute(_select_user_by(service, field, value))
+    user = result.scalars().first()
+    if user is not None:
+        snapshot = _snapshot_user(user)
+        for cache_field in USER_CACHE_FIELDS:
+            user_cache.set((service, cache_field, snapshot[cache_field]), snapshot)
+    return user
+
+
+async def get_user_by_public_id_async(db: AsyncSession, public_id: str, service) -> auth_models.User:
+    return await _get_user_by(db, service, "public_id", public_id)
+
+
+# Snapshots of the users with any of the (service, public_id) keys, found in the user cache or else with one IN query.
+# Snapshots are plain dicts, so this is only for callers that read the users
+async def get_user_snapshots_by_public_ids_async(db: AsyncSession, keys: list[tuple[str, str]]) -> dict[tuple, dict]:
+    snapshots, missing = {}, []
+    for service, public_id in set(keys):
+        snapshot = user_cache.get((service, "public_id", public_id))
+        if snapshot is not None:
+            snapshots[(service, public_id)] = snapshot
+        else:
+            missing.append((service, public_id))
+    if missing:
+        with DB_QUERY_DURATION.time(query="get_users_by_public_ids"):
+            result = await db.scalars(select(auth_models.User).where(
+                tuple_(auth_models.User.service, auth_models.User.public_id).in_(missing)))
+        for user in result:
+            snapshot = _snapshot_user(user)
+            for cache_field in USER_CACHE_FIELDS:
+                user_cache.set((user.service, cache_field, snapshot[cache_field]), snapshot)
+            snapshots[(user.service, user.public_id)] = snapshot
+    return snapshots
+
+
+async def get_user_by_email_async(db: AsyncSession, email: str, service) -> auth_models.User:
+    return await _get_user_by(db, service, "email", email)
+
+
+async def get_user_by_username_async(db: AsyncSession, username: str, service) -> auth_models.User:
+    return await _get_user_by(db, service, "username", username)
+
+
+# None on dialects without ON CONFLICT DO NOTHING, callers then fall back to catching the IntegrityError.
+# Without values the statement takes its rows as execute parameters, i.e. an executemany
+def _insert_ignoring_conflicts(db: Session | AsyncSession, model, values: dict | None = None):
+    match db.get_bind().dialect.name:
+        case "sqlite":
+            statement = sqlite_insert(model)
+        case "postgresql":
+            # Imported here so SQLite deployments never load the postgres dialect modules
+            from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+            statement = postgresql_insert(model)
+        case _:
+            return None
+    if values is not None:
+        statement = statement.values(**values)
+    return statement.on_conflict_do_nothing()
+
+
+# Single round trip insert that relies on the unique (service, email/username) indexes instead of checking first.
+# Returns None if the email or username is taken, otherwise a transient user built from the inserted values.
+# With commit=False the caller can add e.g. an outbox email to the same transaction before committing.
+async def create_user_async(db: AsyncSession, user: auth_schemas.UserCreate, service,
+                            commit: bool = True) -> auth_models.User | None:
+    model = auth_models.User
+    values = {
+        "service": service,
+        "email": user.email,
+        "username": user.username,
+        "password_hash": user.password_hash,
+        "public_id": str(uuid.uuid4()),
+        "created_at": int(time.time()),
+        "verified": False,
+        "password_locked": False
+    }
+    statement = _insert_ignoring_conflicts(db, model, values)
+    with DB_QUERY_DURATION.time(query="create_user"):
+        if statement is not None:
+            result = await db.execute(statement.returning(model.id))
+            user_id = result.scalar_one_or_none()
+        else:
+            try:
+                async with db.begin_nested():
+                    result = await db.execute(insert(model).values(**values))
+                user_id = result.inserted_primary_key[0]
+            except IntegrityError:
+                user_id = None
+        if user_id is None:
+            return None
+        if commit:
+            await db.commit()
+    return model(id=user_id, **values)
+
+
+# Email outbox
+
+def enqueue_email(db: Session | AsyncSession, message: EmailMessage) -> auth_models.EmailOutbox:
+    outbox_email = auth_models.EmailOutbox(to_email=message.to_email,
+                                           subject=message.subject,
+                                           template_id=message.template_id,
+                                           template_data=message.template_data,
+                                           status="pending",
+                                           attempts=0,
+                                           created_at=int(time.time()))
+    db.add(outbox_email)
+    return outbox_email
+
+
+# Claims pending emails plus any left in 'sending' by a drainer that died more than lease_seconds ago
+async def claim_outbox_emails(db: AsyncSession, batch_size: int, lease_seconds: int) -> list[auth_models.EmailOutbox]:
+    now = int(time.time())
+    outbox = auth_models.EmailOutbox
+    claimable = select(outbox.id).where(or_(
+        outbox.status == "pending",
+        and_(outbox.status == "sending", outbox.claimed_at < now - lease_seconds)
+    )).order_by(outbox.id).limit(batch_size).with_for_update(skip_locked=True)
+    with DB_QUERY_DURATION.time(query="claim_outbox_emails"):
+        result = await db.execute(
+            update(outbox)
+            .where(outbox.id.in_(claimable.scalar_subquery()))
+            .values(status="sending", claimed_at=now, attempts=outbox.attempts + 1)
+            .returning(outbox)
+            .execution_options(synchronize_session=False)
+        )
+        claimed = list(result.scalars().all())
+        await db.commit()
+    return claimed
+
+
+# template_data holds the one time token links, so it is cleared as soon as an email will not be sent again
+async def mark_outbox_emails_sent(db: AsyncSession, ids: list[int]):
+    outbox = auth_models.EmailOutbox
+    with DB_QUERY_DURATION.time(query="mark_outbox_emails_sent"):
+        await db.execute(update(outbox).where(outbox.id.in_(ids)).values(status="sent", sent_at=int(time.time()),
+                                                                         template_data=null()))
+        await db.commit()
+
+
+# Failed emails go back to pending until they have used up max_attempts
+async def mark_outbox_emails_failed(db: AsyncSession, ids: list[int], error: str, max_attempts: int):
+    outbox = auth_models.EmailOutbox
+    given_up = outbox.attempts >= max_attempts
+    with DB_QUERY_DURATION.time(query="mark_outbox_emails_failed"):
+        await db.execute(update(outbox).where(outbox.id.in_(ids)).values(
+            status=case((given_up, "failed"), else_="pending"),
+            template_data=case((given_up, null()), else_=outbox.template_data),
+            last_error=error
+        ))
+        await db.commit()
+
+
+async def prune_outbox_emails(db: AsyncSession, created_before: int, batch_size: int) -> int:
+    outbox = auth_models.EmailOutbox
+    old = select(outbox.id).where(outbox.status.in_(("sent", "failed")), outbox.created_at < created_before) \
+        .order_by(outbox.id).limit(batch_size).with_for_update(skip_locked=True)
+    with DB_QUERY_DURATION.time(query="prune_outbox_emails"):
+        result = await db.execute(delete(outbox).where(outbox.id.in_(old.scalar_subquery()))
+                                  .execution_options(synchronize_session=False))
+        await db.commit()
+    return result.rowcount
+
+
+async def get_outbox_depth(db: AsyncSession) -> dict[str, int]:
+    outbox = auth_models.EmailOutbox
+    with DB_QUERY_DURATION.time(query="get_outbox_depth"):
+        result = await db.execute(select(outbox.status, func.count())
+                                  .where(outbox.status != "sent")
+                                  .group_by(outbox.status))
+    depth = {"pending": 0, "sending": 0, "failed": 0}
+    depth.update({status: count for status, count in result.all()})
+    return depth
+
+
+def hash_refresh_token(token: str) -> str:
+    return hmac.new(str(settings.SECRET_KEY).encode(), token.encode(), hashlib.sha256).hexdigest()
+
+
+# Returns the raw token, which is only ever handed to the client. The caller commits
+def create_refresh_token(db: AsyncSession, user: auth_models.User, service, family_id: str | None = None) -> str:
+    token = secrets.token_urlsafe(32)
+    now = int(time.time())
+    db.add(auth_models.RefreshToken(token_hash=hash_refresh_token(token),
+                                    family_id=family_id or str(uuid.uuid4()),
+                                    service=service,
+                                    public_id=user.public_id,
+                                    created_at=now,
+                                    expires_at=now + settings.REFRESH_TOKEN_EXPIRE_DAYS * 24 * 60 * 60))
+    return token
+
+
+async def get_refresh_token_async(db: AsyncSession, token: str, service) -> auth_models.RefreshToken | None:
+    refresh_token = auth_models.RefreshToken
+    with DB_QUERY_DURATION.time(query="get_refresh_token"):
+        result = await db.execute(select(refresh_token).where(refresh_token.token_hash == hash_refresh_token(token),
+                                                              refresh_token.service == service))
+    return result.scalars().first()
+
+
+# Conditional on used_at still being empty, so of two concurrent refreshes with the same token only one wins
+async def mark_refresh_token_used(db: AsyncSession, token_id: int) -> bool:
+    refresh_token = auth_models.RefreshToken
+    with DB_QUERY_DURATION.time(query="mark_refresh_token_used"):
+        result = await db.execute(update(refresh_token)
+                                  .where(refresh_token.id == token_id, refresh_token.used_at.is_(None))
+                                  .values(used_at=int(time.time()))
+                                  .execution_options(synchronize_session=False))
+    return result.rowcount == 1
+
+
+async def revoke_refresh_token_family(db: AsyncSession, family_id: str):
+    refresh_token = auth_models.RefreshToken
+    await db.execute(update(refresh_token).where(refresh_token.family_id == family_id).values(revoked=True)
+                     .execution_options(synchronize_session=False))
+
+
+async def revoke_user_refresh_tokens(db: AsyncSession, user: auth_models.User):
+    refresh_token = auth_models.RefreshToken
+    await db.execute(update(refresh_token)
+                     .where(refresh_token.service == user.service, refresh_token.public_id == user.public_id)
+                     .values(revoked=True)
+                     .execution_options(synchronize_session=False))
+
+
+# Sweeper, every function handles one batch in its own transaction and returns how many rows it changed
+
+ARCHIVED_USER_COLUMNS = ("id", "service", "email", "username", "public_id", "password_hash", "created_at")
+
+
+# Both sweeps return the users they changed, for invalidate_cached_users
+async def sweep_unverified_users(db: AsyncSession, created_before: int, batch_size: int, archive: bool) -> list:
+    user = auth_models.User
+    stale = select(user.id).where(user.verified.is_(False), user.created_at < created_before) \
+        .order_by(user.id).limit(batch_size).with_for_update(skip_locked=True)
+    with DB_QUERY_DURATION.time(query="sweep_unverified_users"):
+        ids = list(await db.scalars(stale))
+        if not ids:
+            return []
+        # Rechecked in the same transaction in case a user verified since the ids were read
+        condition = and_(user.id.in_(ids), user.verified.is_(False))
+        if archive:
+            columns = [getattr(user, column) for column in ARCHIVED_USER_COLUMNS]
+            await db.execute(insert(auth_models.ArchivedUser).from_select(
+                [*ARCHIVED_USER_COLUMNS, "archived_at", "archive_reason"],
+                select(*columns, literal(int(time.time())), literal("unverified")).where(condition)))
+        result = await db.execute(delete(user).where(condition)
+                                  .returning(user.service, *[getattr(user, field) for field in USER_CACHE_FIELDS])
+                                  .execution_options(synchronize_session=False))
+        swept = result.all()
+        await db.commit()
+    return swept
+
+
+async def clear_expired_password_locks(db: AsyncSession, locked_before: int, batch_size: int) -> list:
+    user = auth_models.User
+    expired = select(user.id).where(user.password_locked.is_(True), user.password_locked_at < locked_before) \
+        .order_by(user.id).limit(batch_size).with_for_update(skip_locked=True)
+    with DB_QUERY_DURATION.time(query="clear_expired_password_locks"):
+        result = await db.execute(update(user)
+                                  .where(user.id.in_(expired.scalar_subquery()))
+                                  .values(password_locked=False, password_locked_at=None)
+                                  .returning(user.service, *[getattr(user, field) for field in USER_CACHE_FIELDS])
+                                  .execution_options(synchronize_session=False))
+        cleared = result.all()
+        await db.commit()
+    return cleared
+
+
+# Token revocation
+
+# Revoking an already revoked jti is a no-op. The caller commits
+async def revoke_token_async(db: AsyncSession, jti: str, expires_at: int):
+    values = {"jti": jti, "expires_at": expires_at, "revoked_at": int(time.time())}
+    statement = _insert_ignoring_conflicts(db, auth_models.RevokedToken, values)
+    with DB_QUERY_DURATION.time(query="revoke_token"):
+        if statement is not None:
+            await db.execute(statement)
+        else:
+            try:
+                async with db.begin_nested():
+                    await db.execute(insert(auth_models.RevokedToken).values(**values))
+            except IntegrityError:
+                pass
+
+
+async def is_token_revoked_async(db: AsyncSession, jti: str) -> bool:
+    revoked_token = auth_models.RevokedToken
+    with DB_QUERY_DURATION.time(query="is_token_revoked"):
+        return await db.scalar(select(revoked_token.id).where(revoked_token.jti == jti)) is not None
+
+
+# Rows are returned in id order, so the last id seen is a watermark for the next incremental load
+def get_revoked_tokens_since(db: Session, last_id: int) -> list[tuple[int, str, int]]:
+    revoked_token = auth_models.RevokedToken
+    return list(db.execute(select(revoked_token.id, revoked_token.jti, revoked_token.expires_at)
+                           .where(revoked_token.id > last_id)
+                           .order_by(revoked_token.id)).tuples())
+
+
+def prune_revoked_tokens(db: Session, now: int) -> int:
+    revoked_token = auth_models.RevokedToken
+    result = db.execute(delete(revoked_token).where(revoked_token.expires_at <= now))
+    db.commit()
+    return result.rowcount
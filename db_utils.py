@@ -1,14 +1,77 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncEngine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from config import settings
 
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./database/database.db"
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+# Async drivers for each backend, postgres uses asyncpg and psycopg2 for the sync engine
+ASYNC_DRIVERS = {"sqlite": "sqlite+aiosqlite", "postgresql": "postgresql+asyncpg"}
+
+
+def async_database_url(url: str) -> str:
+    database_url = make_url(url)
+    backend = database_url.get_backend_name()
+    if backend in ASYNC_DRIVERS and not database_url.get_dialect().is_async:
+        database_url = database_url.set(drivername=ASYNC_DRIVERS[backend])
+    return database_url.render_as_string(hide_password=False)
+
+
+# WAL lets reads carry on while a signup is writing, and synchronous=NORMAL is still crash safe under WAL
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={settings.SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute(f"PRAGMA mmap_size={settings.SQLITE_MMAP_SIZE}")
+    cursor.close()
+
+
+def _engine_options(url: str) -> dict:
+    database_url = make_url(url)
+    options = {"pool_recycle": settings.DATABASE_POOL_RECYCLE_SECONDS}
+    if database_url.get_backend_name() == "sqlite":
+        # In memory databases live and die with their one connection, so they keep SQLAlchemy's default pool
+        if database_url.database in (None, "", ":memory:"):
+            return {}
+        options["connect_args"] = {"check_same_thread": False}
+    else:
+        # A SQLite file can't drop the connection, so only network databases pay for the ping on every checkout
+        options["pool_pre_ping"] = settings.DATABASE_POOL_PRE_PING
+    options.update(pool_size=settings.DATABASE_POOL_SIZE,
+                   max_overflow=settings.DATABASE_MAX_OVERFLOW,
+                   pool_timeout=settings.DATABASE_POOL_TIMEOUT_SECONDS)
+    return options
+
+
+def create_db_engine(url: str) -> Engine:
+    db_engine = create_engine(url, **_engine_options(url))
+    if db_engine.dialect.name == "sqlite":
+        event.listen(db_engine, "connect", set_sqlite_pragmas)
+    return db_engine
+
+
+def create_async_db_engine(url: str) -> AsyncEngine:
+    url = async_database_url(url)
+    options = _engine_options(url)
+    # aiosqlite would otherwise default to opening a new connection, and setting its pragmas, on every checkout
+    if options and make_url(url).get_backend_name() == "sqlite":
+        options["poolclass"] = AsyncAdaptedQueuePool
+    db_engine = create_async_engine(url, **options)
+    if db_engine.dialect.name == "sqlite":
+        event.listen(db_engine.sync_engine, "connect", set_sqlite_pragmas)
+    return db_engine
+
+
+# Sync engine for scripts and migrations, async engine for the request path
+engine = create_db_engine(settings.DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
-def get_db():
-    db = SessionLocal()
-    try:
+async_engine = create_async_db_engine(settings.DATABASE_URL)
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
\ No newline at end of file
@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import random
+import time
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING
+from config import settings
+from metrics import EMAIL_SEND_DURATION
+
+# httpx is only imported once a client is opened, it is the slowest import on the app's start up path
+if TYPE_CHECKING:
+    import httpx
+
+
+logger = logging.getLogger(__name__)
+
+# SendGrid accepts up to 1000 personalizations per request, all sharing one template
+MAX_PERSONALIZATIONS = 1000
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+@dataclass(frozen=True)
+class EmailMessage:
+    to_email: str
+    subject: str
+    template_id: str
+    template_data: dict = field(default_factory=dict)
+
+
+class EmailSendError(Exception):
+    # Not retryable when SendGrid rejected the request itself, e.g. a 400 for a malformed address, so sending the
+    # same request again would fail the same way. status_code is SendGrid's response status, if it gave one
+    def __init__(self, message: str, retryable: bool = True, status_code: int | None = None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.status_code = status_code
+
+
+class EmailDispatcher:
+    """Long lived SendGrid sender with a pooled HTTP client and batched, retried sends, driven by email_outbox.py."""
+
+    def __init__(self,
+                 api_key: str,
+                 sender_address: str,
+                 api_url: str = settings.SENDGRID_API_URL,
+                 concurrency: int = settings.EMAIL_CONCURRENCY,
+                 batch_size: int = settings.EMAIL_BATCH_SIZE,
+                 max_retries: int = settings.EMAIL_MAX_RETRIES,
+                 retry_backoff: float = settings.EMAIL_RETRY_BACKOFF_SECONDS):
+        self.api_key = api_key
+        self.sender_address = sender_address
+        self.api_url = api_url
+        self.concurrency = concurrency
+        self.batch_size = min(batch_size, MAX_PERSONALIZATIONS)
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self._client: "httpx.AsyncClient | None" = None
+
+    async def open(self):
+        if self._client is None:
+            import httpx
+            limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+            self._client = httpx.AsyncClient(limits=limits,
+                                             timeout=10.0,
+                                             headers={"Authorization": f"Bearer {self.api_key}"})
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    # Messages sharing a template go out as one request with a personalization each, up to batch_size per request
+    async def send_batch(self, messages: list[EmailMessage]):
+        by_template: dict[str, list[EmailMessage]] = {}
+        for message in messages:
+            by_template.setdefault(message.template_id, []).append(message)
+        errors = []
+        for template_id, template_messages in by_template.items():
+            for start in range(0, len(template_messages), self.batch_size):
+                try:
+                    await self._post_with_retry(self._build_payload(
+                        template_id, template_messages[start:start + self.batch_size]))
+                except EmailSendError as e:
+                    errors.append(e)
+        if errors:
+            status_codes = {e.status_code for e in errors}
+            raise EmailSendError("; ".join(map(str, errors)), retryable=all(e.retryable for e in errors),
+                                 status_code=status_codes.pop() if len(status_codes) == 1 else None)
+
+    def _build_payload(self, template_id: str, messages: list[EmailMessage]) -> dict:
+        return {
+            "from": {"email": self.sender_address},
+            "template_id": template_id,
+            "personalizations": [
+                {
+                    "to": [{"email": message.to_email}],
+                    "subject": message.subject,
+                    "dynamic_template_data": message.template_data
+                } for message in messages
+            ]
+        }
+
+    async def _post_with_retry(self, payload: dict):
+        import httpx
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            start = time.perf_counter()
+            try:
+                response = await self._client.post(self.api_url, json=payload)
+            except httpx.TransportError as e:
+                EMAIL_SEND_DURATION.observe(time.perf_counter() - start, outcome="error")
+                error = repr(e)
+            else:
+                EMAIL_SEND_DURATION.observe(time.perf_counter() - start, outcome=str(response.status_code))
+                if response.is_success:
+                    return
+                if response.status_code not in RETRYABLE_STATUS_CODES:
+                    raise EmailSendError(f"SendGrid returned {response.status_code}: {response.text}", retryable=False,
+                                         status_code=response.status_code)
+                error = f"SendGrid returned {response.status_code}"
+                retry_after = response.headers.get("retry-after")
+            if attempt == self.max_retries:
+                raise EmailSendError(f"giving up after {attempt + 1} attempts, last error {error}")
+            if retry_after is not None and retry_after.isdigit():
+                delay = float(retry_after)
+            else:
+                delay = self.retry_backoff * 2 ** attempt * (1 + random.random())
+            logger.warning("Email send failed (%s), retrying in %.2fs", error, delay)
+            await asyncio.sleep(delay)
+
+
+email_dispatcher = EmailDispatcher(str(settings.SENDGRID_API_KEY), settings.EMAIL_SENDER_ADDRESS)
@@ -0,0 +1,93 @@
+"""Drains the email outbox table. Run as its own process: python email_outbox.py [--once]"""
+import argparse
+import asyncio
+import logging
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from config import settings
+from database.auth_models import EmailOutbox
+from database.crud import claim_outbox_emails, mark_outbox_emails_sent, mark_outbox_emails_failed, get_outbox_depth
+from db_utils import AsyncSessionLocal
+from email_dispatcher import EmailDispatcher, EmailMessage, EmailSendError, email_dispatcher
+
+
+logger = logging.getLogger(__name__)
+
+
+# A 400 from SendGrid fails every message in the request, so the batch is split in half and each half resent until
+# the rejected messages are on their own. Only those are marked failed. Any other error, e.g. a 401 for a bad API key,
+# would fail every half the same way, so it fails the whole batch at once
+async def _send_isolating_rejects(dispatcher: EmailDispatcher, outbox_emails: list[EmailOutbox],
+                                  sent: list[int], failed: dict[str, list[int]]):
+    ids = [outbox_email.id for outbox_email in outbox_emails]
+    messages = [EmailMessage(to_email=outbox_email.to_email,
+                             subject=outbox_email.subject,
+                             template_id=outbox_email.template_id,
+                             template_data=outbox_email.template_data) for outbox_email in outbox_emails]
+    try:
+        await dispatcher.send_batch(messages)
+    except EmailSendError as e:
+        if e.status_code != 400 or len(outbox_emails) == 1:
+            failed.setdefault(str(e), []).extend(ids)
+            return
+        middle = len(outbox_emails) // 2
+        await _send_isolating_rejects(dispatcher, outbox_emails[:middle], sent, failed)
+        await _send_isolating_rejects(dispatcher, outbox_emails[middle:], sent, failed)
+    else:
+        sent.extend(ids)
+
+
+async def send_outbox_emails(dispatcher: EmailDispatcher, outbox_emails: list[EmailOutbox],
+                             dry_run: bool) -> tuple[list[int], dict[str, list[int]]]:
+    by_template: dict[str, list[EmailOutbox]] = {}
+    for outbox_email in outbox_emails:
+        by_template.setdefault(outbox_email.template_id, []).append(outbox_email)
+    sent, failed = [], {}
+    for template_emails in by_template.values():
+        if dry_run:
+            for outbox_email in template_emails:
+                logger.info("EMAIL DEV MODE %s", outbox_email.template_data.get('token_url'),
+                            extra={"outbox_id": outbox_email.id, "subject": outbox_email.subject})
+            sent.extend(outbox_email.id for outbox_email in template_emails)
+            continue
+        await _send_isolating_rejects(dispatcher, template_emails, sent, failed)
+    return sent, failed
+
+
+async def drain_outbox(session_factory: async_sessionmaker = AsyncSessionLocal,
+                       dispatcher: EmailDispatcher = email_dispatcher,
+                       batch_size: int = settings.EMAIL_OUTBOX_BATCH_SIZE,
+                       poll_interval: float = settings.EMAIL_OUTBOX_POLL_SECONDS,
+                       lease_seconds: int = settings.EMAIL_OUTBOX_LEASE_SECONDS,
+                       max_attempts: int = settings.EMAIL_OUTBOX_MAX_ATTEMPTS,
+                       dry_run: bool = settings.DEBUG or settings.TESTING,
+                       once: bool = False):
+    await dispatcher.open()
+    try:
+        while True:
+            async with session_factory() as db:
+                outbox_emails = await claim_outbox_emails(db, batch_size, lease_seconds)
+                if outbox_emails:
+                    sent, failed = await send_outbox_emails(dispatcher, outbox_emails, dry_run)
+                    if sent:
+                        await mark_outbox_emails_sent(db, sent)
+                    for error, ids in failed.items():
+                        logger.error("Failed to send %d outbox emails: %s", len(ids), error)
+                        await mark_outbox_emails_failed(db, ids, error, max_attempts)
+                    logger.info("Outbox depth %s", await get_outbox_depth(db))
+            # A full batch means there is probably more waiting, so only sleep once the outbox is drained
+            if len(outbox_emails) < batch_size:
+                if once:
+                    return
+                await asyncio.sleep(poll_interval)
+    finally:
+        await dispatcher.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Send emails queued in the outbox table")
+    parser.add_argument("--once", action="store_true", help="exit once the outbox is empty")
+    parser.add_argument("--batch-size", type=int, default=settings.EMAIL_OUTBOX_BATCH_SIZE)
+    parser.add_argument("--poll-interval", type=float, default=settings.EMAIL_OUTBOX_POLL_SECONDS)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(drain_outbox(batch_size=args.batch_size, poll_interval=args.poll_interval, once=args.once))
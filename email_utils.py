@@ -1,75 +1,76 @@
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail
+import logging
 from urllib.parse import urlencode
 import os
-from config import settings
-from database.auth_models import TourTrackerUser, ArcadeUser, BaseUser
+from config import settings, services
+from database.auth_models import User
 from jwt_utilities import encode_jwt
+from email_dispatcher import EmailMessage
+from database.crud import enqueue_email
 from datetime import timedelta
 
 
+logger = logging.getLogger(__name__)
+
 
 class AuthEmail:
-    def __init__(self, user: BaseUser, service: str, base_url: str = '', redirect_url: str = ''):
+    token_type = "one_time"
+
+    def __init__(self, user: User, service: str, base_url: str = '', redirect_url: str = ''):
         self.user = user
         self.service = service
         self.base_url = base_url
         self.redirect_url = redirect_url
         self.url_path = ''
         self.payload = {
-            "sub": self.user.public_id
+            "sub": self.user.public_id,
+            "typ": self.token_type
         }
         self.token_url = self.generate_token_url()
         self.email_subject = ''
         self.sendgrid_template_id = ''
 
     def generate_token_url(self):
-        token = encode_jwt(self.payload, self.service, expires_delta=timedelta(minutes=15))
+        token = encode_jwt(self.payload, self.service, expires_delta=timedelta(minutes=settings.ONE_TIME_TOKEN_EXPIRE_MINUTES))
         params = {
             'token': token,
             'redirect_url': self.redirect_url
         }
         return f"{self.base_url}{self.url_path}?{urlencode(params)}"
 
-    def send_email(self):
-        if settings.DEBUG or settings.TESTING:
-            print("EMAIL DEV MODE")
-            print(self.token_url)
-            return self.email_subject, self.token_url
-        sg = SendGridAPIClient(api_key=str(settings.SENDGRID_API_KEY))
-        message = Mail(
-            from_email=settings.EMAIL_SENDER_ADDRESS,
-            to_emails=self.user.email,
-            subject=self.email_subject
+    def to_message(self) -> EmailMessage:
+        return EmailMessage(
+            to_email=self.user.email,
+            subject=self.email_subject,
+            template_id=self.sendgrid_template_id,
+            template_data={
+                'username': self.user.username,
+                'token_url': self.token_url
+            }
         )
-        message.dynamic_template_data = {
-            'username': self.user.username,
-            'token_url': self.token_url
-        }
-        message.template_id = self.sendgrid_template_id
-        try:
-            response = sg.send(message)
-        except Exception as e:
-            print(e)
+
+    # Writes the email to the outbox, it is only sent by email_outbox.py once the caller commits db
+    def send_email(self, db):
+        if settings.DEBUG or settings.TESTING:
+            logger.info("EMAIL DEV MODE %s", self.token_url, extra={"subject": self.email_subject})
+        enqueue_email(db, self.to_message())
+        return self.email_subject, self.token_url
 
 
 
 class PasswordResetEmail(AuthEmail):
-    def __init__(self, user: BaseUser, service: str, base_url: str = settings.BASE_URL, redirect_url=''):
+    token_type = "password_reset"
+
+    def __init__(self, user: User, service: str, base_url: str = settings.BASE_URL, redirect_url=''):
         super().__init__(user, service, base_url, redirect_url)
         self.email_subject = "Password Reset Email"
         self.url_path = '/resetpassword'
         self.token_url = self.generate_token_url()
-        match self.service:
-            case "tourtracker":
-                self.sendgrid_template_id = settings.TOURTRACKER_PASSWORD_RESET_EMAIL_TEMPLATE_ID
-            case "arcade":
-                self.sendgrid_template_id = settings.ARCADE_PASSWORD_RESET_EMAIL_TEMPLATE_ID
+        self.sendgrid_template_id = services[self.service].password_reset_email_template_id
 
     # Override parent token generation to create one time use token using password hash and user creation time
     def generate_token_url(self):
         secret_key = f"{self.user.password_hash}_{self.user.created_at}"
-        token = encode_jwt(self.payload, self.service, expires_delta=timedelta(minutes=15), secret_key=secret_key)
+        token = encode_jwt(self.payload, self.service, expires_delta=timedelta(minutes=settings.ONE_TIME_TOKEN_EXPIRE_MINUTES), secret_key=secret_key)
         params = {
             'username': self.user.username,
             'service': self.service,
@@ -80,24 +81,18 @@ class PasswordResetEmail(AuthEmail):
 
 
 class PasswordResetConfirmationEmail(AuthEmail):
-    def __init__(self, user: BaseUser, service: str, base_url: str = '', redirect_url=''):
+    def __init__(self, user: User, service: str, base_url: str = '', redirect_url=''):
         super().__init__(user, service, base_url, redirect_url)
         self.email_subject = 'Successful Password Reset'
-        match self.service:
-            case "tourtracker":
-                self.sendgrid_template_id = settings.TOURTRACKER_PASSWORD_RESET_CONFIRMATION_EMAIL_TEMPLATE_ID
-            case "arcade":
-                self.sendgrid_template_id = settings.ARCADE_PASSWORD_RESET_CONFIRMATION_EMAIL_TEMPLATE_ID
+        self.sendgrid_template_id = services[self.service].password_reset_confirmation_email_template_id
 
 
 
 class VerificationEmail(AuthEmail):
-    def __init__(self, user: BaseUser, service: str, base_url: str = '', redirect_url=''):
+    token_type = "verification"
+
+    def __init__(self, user: User, service: str, base_url: str = '', redirect_url=''):
         super().__init__(user, service, base_url, redirect_url)
         self.email_subject = "Please verify your email address"
         self.url_path = '/verify'
-        match self.service:
-            case "tourtracker":
-                self.sendgrid_template_id = settings.TOURTRACKER_VERIFICATION_EMAIL_TEMPLATE_ID
-            case "arcade":
-                self.sendgrid_template_id = settings.ARCADE_VERIFICATION_EMAIL_TEMPLATE_ID
+        self.sendgrid_template_id = services[self.service].verification_email_template_id
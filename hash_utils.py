@@ -0,0 +1,190 @@
+import asyncio
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from argon2 import PasswordHasher, extract_parameters
+from argon2 import exceptions as argonexceptions
+from fastapi import HTTPException, status
+from config import settings
+from metrics import ARGON2_DURATION
+
+
+def build_password_hasher() -> PasswordHasher:
+    return PasswordHasher(time_cost=settings.ARGON2_TIME_COST,
+                          memory_cost=settings.ARGON2_MEMORY_COST_KIB,
+                          parallelism=settings.ARGON2_PARALLELISM)
+
+
+# Each pool worker builds its own PasswordHasher in _init_worker so the hasher never has to be pickled per call
+_worker_hasher: PasswordHasher | None = None
+
+
+def _init_worker():
+    global _worker_hasher
+    _worker_hasher = build_password_hasher()
+
+
+def _hash_password(password: str) -> str:
+    return _worker_hasher.hash(password)
+
+
+# One task for many passwords, for bulk callers like import_users.py that would otherwise pay a round trip each
+def _hash_passwords(passwords: list[str]) -> list[str]:
+    return [_worker_hasher.hash(password) for password in passwords]
+
+
+def _verify_password(password_hash: str, password: str) -> bool:
+    try:
+        return _worker_hasher.verify(password_hash, password)
+    except argonexceptions.VerifyMismatchError:
+        return False
+
+
+# Returns whether the password matched and, if the stored hash used out of date parameters, its replacement
+def _verify_and_rehash_password(password_hash: str, password: str) -> tuple[bool, str | None]:
+    if not _verify_password(password_hash, password):
+        return False, None
+    if _worker_hasher.check_needs_rehash(password_hash):
+        return True, _worker_hasher.hash(password)
+    return True, None
+
+
+class AdmissionController:
+    """Admits hash/verify calls against an argon2 memory budget and a concurrency limit.
+
+    Calls that cannot be admitted queue in FIFO order, and are shed with a 503 if the queue is already full
+    or they wait longer than max_queue_wait.
+    """
+
+    def __init__(self, memory_budget_kib: int, max_concurrency: int, max_queue: int, max_queue_wait: float):
+        self.memory_budget_kib = memory_budget_kib
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_queue_wait = max_queue_wait
+        self.in_flight = 0
+        self.memory_in_use_kib = 0
+        self.admitted = 0
+        self.shed = 0
+        self._waiters: deque[tuple[asyncio.Future, int]] = deque()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    def _can_admit(self, memory_cost_kib: int) -> bool:
+        # A single call bigger than the whole budget is still let through once nothing else is running
+        return self.in_flight < self.max_concurrency and (
+            self.memory_in_use_kib + memory_cost_kib <= self.memory_budget_kib or self.in_flight == 0)
+
+    def _admit(self, memory_cost_kib: int):
+        self.in_flight += 1
+        self.memory_in_use_kib += memory_cost_kib
+        self.admitted += 1
+
+    def _shed(self):
+        self.shed += 1
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="Server busy, please retry",
+                            headers={"Retry-After": "1"})
+
+    async def acquire(self, memory_cost_kib: int):
+        if not self._waiters and self._can_admit(memory_cost_kib):
+            self._admit(memory_cost_kib)
+            return
+        if len(self._waiters) >= self.max_queue:
+            self._shed()
+        waiter = (asyncio.get_running_loop().create_future(), memory_cost_kib)
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter[0], self.max_queue_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            # Cancelled e.g. by a client disconnect, which must not leave the waiter counting against max_queue
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+                # The removed waiter may have been the one holding back the rest of the queue
+                self._admit_waiters()
+            elif waiter[0].done() and not waiter[0].cancelled():
+                # Admitted just as it was cancelled, so the caller will never release the slot itself
+                self.release(memory_cost_kib)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            self._shed()
+
+    def _admit_waiters(self):
+        while self._waiters and self._can_admit(self._waiters[0][1]):
+            future, waiter_cost = self._waiters.popleft()
+            if future.done():
+                continue
+            self._admit(waiter_cost)
+            future.set_result(None)
+
+    def release(self, memory_cost_kib: int):
+        self.in_flight -= 1
+        self.memory_in_use_kib -= memory_cost_kib
+        self._admit_waiters()
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "memory_in_use_kib": self.memory_in_use_kib,
+            "memory_budget_kib": self.memory_budget_kib,
+            "queue_depth": self.queue_depth,
+            "admitted": self.admitted,
+            "shed": self.shed
+        }
+
+
+class PasswordHashExecutor:
+    """Runs argon2 hash/verify on a bounded process pool so the event loop never does the hashing itself."""
+
+    def __init__(self, max_workers: int, admission: AdmissionController):
+        self.max_workers = max(1, max_workers)
+        self.admission = admission
+        self.memory_cost_kib = settings.ARGON2_MEMORY_COST_KIB
+        self._pool: ProcessPoolExecutor | None = None
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.max_workers, initializer=_init_worker)
+        return self._pool
+
+    async def _run(self, operation: str, memory_cost_kib: int, fn, *args):
+        await self.admission.acquire(memory_cost_kib)
+        try:
+            loop = asyncio.get_running_loop()
+            with ARGON2_DURATION.time(operation=operation):
+                return await loop.run_in_executor(self._get_pool(), fn, *args)
+        finally:
+            self.admission.release(memory_cost_kib)
+
+    async def hash(self, password: str) -> str:
+        return await self._run("hash", self.memory_cost_kib, _hash_password, password)
+
+    # Verifying costs whatever memory the stored hash was created with, not the current settings
+    def _verify_memory_cost(self, password_hash: str) -> int:
+        try:
+            return extract_parameters(password_hash).memory_cost
+        except argonexceptions.InvalidHash:
+            return self.memory_cost_kib
+
+    async def verify(self, password_hash: str, password: str) -> bool:
+        return await self._run("verify", self._verify_memory_cost(password_hash), _verify_password,
+                               password_hash, password)
+
+    # The rehash runs straight after the verify in the same worker call, so only the larger of the two costs is held
+    async def verify_and_rehash(self, password_hash: str, password: str) -> tuple[bool, str | None]:
+        memory_cost_kib = max(self._verify_memory_cost(password_hash), self.memory_cost_kib)
+        return await self._run("verify", memory_cost_kib, _verify_and_rehash_password, password_hash, password)
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+
+password_hasher = PasswordHashExecutor(
+    settings.HASHING_WORKERS,
+    AdmissionController(memory_budget_kib=settings.HASHING_MEMORY_BUDGET_MIB * 1024,
+                        max_concurrency=settings.HASHING_MAX_CONCURRENCY,
+                        max_queue=settings.HASHING_MAX_QUEUE,
+                        max_queue_wait=settings.HASHING_MAX_QUEUE_WAIT_SECONDS)
+)
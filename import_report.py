@@ -0,0 +1,61 @@
+"""Reports where start up import time goes, using python -X importtime in a fresh interpreter.
+
+    python import_report.py --top 15
+    python import_report.py --max-ms 800    # exits 1 if importing main takes longer
+"""
+import argparse
+import subprocess
+import sys
+from dataclasses import dataclass
+
+
+@dataclass
+class ImportTime:
+    module: str
+    self_us: int
+    cumulative_us: int
+    depth: int
+
+
+# Lines look like "import time:       self [us] |  cumulative | imported package", nested imports are indented
+def parse_importtime(stderr: str) -> list[ImportTime]:
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        module = name.strip()
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append(ImportTime(module, int(self_us), int(cumulative_us), depth))
+    return imports
+
+
+def measure_imports(module: str) -> list[ImportTime]:
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            capture_output=True, text=True, check=True)
+    return parse_importtime(result.stderr)
+
+
+def format_report(imports: list[ImportTime], module: str, top: int) -> str:
+    total = next((i.cumulative_us for i in imports if i.module == module and i.depth == 0), 0)
+    lines = [f"import {module}: {total / 1000:.1f}ms", "", "Slowest direct and second level imports (cumulative):"]
+    nested = sorted((i for i in imports if 1 <= i.depth <= 2), key=lambda i: i.cumulative_us, reverse=True)
+    lines += [f"  {i.cumulative_us / 1000:8.1f}ms  {'  ' * (i.depth - 1)}{i.module}" for i in nested[:top]]
+    lines += ["", "Slowest modules by own time:"]
+    lines += [f"  {i.self_us / 1000:8.1f}ms  {i.module}"
+              for i in sorted(imports, key=lambda i: i.self_us, reverse=True)[:top]]
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report start up import time")
+    parser.add_argument("--module", default="main")
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--max-ms", type=float, help="exit 1 if the import takes longer than this")
+    args = parser.parse_args()
+    imports = measure_imports(args.module)
+    print(format_report(imports, args.module, args.top))
+    total_ms = next((i.cumulative_us for i in imports if i.module == args.module and i.depth == 0), 0) / 1000
+    if args.max_ms is not None and total_ms > args.max_ms:
+        print(f"import {args.module} took {total_ms:.1f}ms, over the {args.max_ms:.0f}ms budget", file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,203 @@
+"""Bulk imports users for one service from a CSV or JSONL file.
+
+    python import_users.py users.csv --service tourtracker
+    python import_users.py users.jsonl --service arcade --batch-size 5000 --workers 8
+
+Each record needs email and username, plus either password_hash (an existing argon2 hash, kept as is) or
+password (hashed on a process pool). An optional verified column marks users as already verified.
+
+Records that can't be imported are written to the reject file without their password. Progress is saved to
+the checkpoint file after every committed batch, and a rerun resumes after it. A batch committed just before a
+crash is rejected as already registered when it is replayed.
+"""
+import argparse
+import csv
+import itertools
+import json
+import math
+import os
+import sys
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Iterator
+from argon2 import extract_parameters
+from argon2.exceptions import InvalidHash
+from sqlalchemy.orm import sessionmaker
+from config import settings, services
+from database.auth_schemas import UserCreate
+from database.crud import create_users_bulk
+from hash_utils import _init_worker, _hash_passwords
+
+
+TRUE_VALUES = {"1", "true", "yes", "y"}
+
+
+def read_records(path: str) -> Iterator[tuple[int, dict]]:
+    with open(path, newline="") as import_file:
+        if path.endswith(".jsonl"):
+            for line_number, line in enumerate(import_file, start=1):
+                if line.strip():
+                    try:
+                        yield line_number, json.loads(line)
+                    except json.JSONDecodeError:
+                        yield line_number, None
+        else:
+            # Line numbers count the header, so they match what an editor shows
+            for line_number, row in enumerate(csv.DictReader(import_file), start=2):
+                yield line_number, row
+
+
+@dataclass
+class ImportStats:
+    last_line: int = 0
+    inserted: int = 0
+    rejected: int = 0
+
+
+@dataclass
+class PreparedBatch:
+    last_line: int
+    records: list[tuple[int, dict]] = field(default_factory=list)
+    hashes: list[str | None] = field(default_factory=list)
+    # Futures for the plaintext passwords, each a chunk of hashes for the None slots in hashes, in order
+    hash_futures: list[Future] = field(default_factory=list)
+    rejects: list[dict] = field(default_factory=list)
+
+
+def _reject(line_number: int, record: dict, reason: str) -> dict:
+    redacted = {key: value for key, value in record.items() if key not in ("password", None)}
+    return {"line": line_number, "reason": reason, "record": redacted}
+
+
+class UserImporter:
+    def __init__(self, session_factory: sessionmaker, service: str, pool: ProcessPoolExecutor, workers: int,
+                 batch_size: int, reject_path: str, checkpoint_path: str):
+        self.session_factory = session_factory
+        self.service = service
+        self.pool = pool
+        self.workers = workers
+        self.batch_size = batch_size
+        self.reject_path = reject_path
+        self.checkpoint_path = checkpoint_path
+
+    def load_checkpoint(self) -> ImportStats:
+        if not os.path.exists(self.checkpoint_path):
+            return ImportStats()
+        with open(self.checkpoint_path) as checkpoint_file:
+            return ImportStats(**json.load(checkpoint_file))
+
+    # Written to a temporary file and renamed, so a crash mid write never leaves a corrupt checkpoint
+    def save_checkpoint(self, stats: ImportStats):
+        temporary_path = f"{self.checkpoint_path}.tmp"
+        with open(temporary_path, "w") as checkpoint_file:
+            json.dump(stats.__dict__, checkpoint_file)
+        os.replace(temporary_path, self.checkpoint_path)
+
+    # Validates the records and submits their plaintext passwords for hashing without waiting for the result
+    def prepare(self, records: list[tuple[int, dict]]) -> PreparedBatch:
+        batch = PreparedBatch(last_line=records[-1][0])
+        passwords = []
+        for line_number, record in records:
+            if not isinstance(record, dict):
+                batch.rejects.append(_reject(line_number, {}, "record is not a JSON object"))
+                continue
+            # csv puts the overflow of a row with too many columns under None, e.g. from an unquoted argon2 hash
+            if None in record:
+                batch.rejects.append(_reject(line_number, record, "row has more columns than the header"))
+                continue
+            email, username = record.get("email"), record.get("username")
+            # JSONL values can be any JSON type, not just strings
+            if not isinstance(email, str) or "@" not in email or not isinstance(username, str) or not username:
+                batch.rejects.append(_reject(line_number, record, "email and username are required"))
+                continue
+            if record.get("password_hash"):
+                try:
+                    if not isinstance(record["password_hash"], str):
+                        raise InvalidHash
+                    extract_parameters(record["password_hash"])
+                except InvalidHash:
+                    batch.rejects.append(_reject(line_number, record, "password_hash is not an argon2 hash"))
+                    continue
+                batch.hashes.append(record["password_hash"])
+            elif record.get("password") and isinstance(record["password"], str):
+                batch.hashes.append(None)
+                passwords.append(record["password"])
+            else:
+                batch.rejects.append(_reject(line_number, record, "password or password_hash is required"))
+                continue
+            batch.records.append((line_number, record))
+        chunk_size = max(1, math.ceil(len(passwords) / (self.workers * 4)))
+        batch.hash_futures = [self.pool.submit(_hash_passwords, passwords[i:i + chunk_size])
+                              for i in range(0, len(passwords), chunk_size)]
+        return batch
+
+    def write(self, batch: PreparedBatch, stats: ImportStats, reject_file):
+        computed_hashes = iter([password_hash for future in batch.hash_futures for password_hash in future.result()])
+        users = [UserCreate(email=record["email"], username=record["username"],
+                            password_hash=password_hash or next(computed_hashes))
+                 for (_, record), password_hash in zip(batch.records, batch.hashes)]
+        verified = [str(record.get("verified", "")).lower() in TRUE_VALUES for _, record in batch.records]
+        with self.session_factory() as db:
+            inserted = create_users_bulk(db, users, self.service, verified)
+            db.commit()
+        rejects = batch.rejects + [_reject(line_number, record, "email or username already registered")
+                                   for (line_number, record), was_inserted in zip(batch.records, inserted)
+                                   if not was_inserted]
+        for reject in sorted(rejects, key=lambda reject: reject["line"]):
+            reject_file.write(json.dumps(reject) + "\n")
+        reject_file.flush()
+        stats.last_line = batch.last_line
+        stats.inserted += sum(inserted)
+        stats.rejected += len(rejects)
+        self.save_checkpoint(stats)
+
+    # Hashing for the next batch runs on the pool while the current one is inserted
+    def run(self, path: str) -> ImportStats:
+        stats = self.load_checkpoint()
+        records = ((line_number, record) for line_number, record in read_records(path)
+                   if line_number > stats.last_line)
+        pending: PreparedBatch | None = None
+        with open(self.reject_path, "a") as reject_file:
+            while batch := list(itertools.islice(records, self.batch_size)):
+                prepared = self.prepare(batch)
+                if pending is not None:
+                    self.write(pending, stats, reject_file)
+                pending = prepared
+            if pending is not None:
+                self.write(pending, stats, reject_file)
+        return stats
+
+
+# Never runs more hashing workers than the argon2 memory budget allows
+def worker_count(requested: int) -> int:
+    memory_limited = settings.HASHING_MEMORY_BUDGET_MIB * 1024 // settings.ARGON2_MEMORY_COST_KIB
+    return max(1, min(requested, memory_limited))
+
+
+def import_users(path: str, service: str, session_factory: sessionmaker, batch_size: int = 1000,
+                 workers: int = settings.HASHING_WORKERS, reject_path: str | None = None,
+                 checkpoint_path: str | None = None) -> ImportStats:
+    workers = worker_count(workers)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+        importer = UserImporter(session_factory, service, pool, workers, batch_size,
+                                reject_path or f"{path}.rejects.jsonl", checkpoint_path or f"{path}.checkpoint")
+        return importer.run(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk import users from a CSV or JSONL file")
+    parser.add_argument("path", help="a .csv file with a header row, or a .jsonl file")
+    parser.add_argument("--service", required=True, choices=list(services))
+    parser.add_argument("--batch-size", type=int, default=1000, help="records per insert transaction")
+    parser.add_argument("--workers", type=int, default=settings.HASHING_WORKERS, help="password hashing processes")
+    parser.add_argument("--reject-file", help="defaults to <path>.rejects.jsonl")
+    parser.add_argument("--checkpoint", help="defaults to <path>.checkpoint")
+    args = parser.parse_args()
+    from db_utils import SessionLocal
+    start = time.perf_counter()
+    result = import_users(args.path, args.service, SessionLocal, args.batch_size, args.workers,
+                          args.reject_file, args.checkpoint)
+    elapsed = time.perf_counter() - start
+    print(f"Imported {result.inserted} users, rejected {result.rejected}, up to line {result.last_line} "
+          f"in {elapsed:.1f}s", file=sys.stderr)
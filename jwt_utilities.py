@@ -1,27 +1,106 @@
-from jose import jwt, JWTError, ExpiredSignatureError
+from jose import jwt, jwk, JWTError, ExpiredSignatureError
+from jose.constants import ALGORITHMS
 from config import settings
+from metrics import JWT_DURATION
+from revocation import revocation_store
+from dataclasses import dataclass
 from datetime import datetime, timedelta
 from fastapi import HTTPException
-import secrets
+from functools import lru_cache
+import base64
+import hashlib
+import json
+import uuid
 
 
+ASYMMETRIC_ALGORITHMS = ALGORITHMS.RSA_DS | ALGORITHMS.EC_DS
+# Members used for the RFC 7638 JWK thumbprint, which doubles as the default kid
+THUMBPRINT_MEMBERS = {'RSA': ('e', 'kty', 'n'), 'EC': ('crv', 'kty', 'x', 'y')}
+ACCESS_TOKEN_TYPE = "access"
 
-def encode_jwt(data, service: str, expires_delta: timedelta | None = None, secret_key: str = str(settings.SECRET_KEY)):
+
+@dataclass(frozen=True)
+class SigningKeys:
+    signing_key: str
+    verification_key: str
+    kid: str | None = None
+    public_jwk: dict | None = None
+
+
+def _jwk_thumbprint(public_jwk: dict) -> str:
+    members = {member: public_jwk[member] for member in THUMBPRINT_MEMBERS[public_jwk['kty']]}
+    digest = hashlib.sha256(json.dumps(members, separators=(',', ':'), sort_keys=True).encode()).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b'=').decode()
+
+
+@lru_cache(maxsize=1)
+def get_signing_keys() -> SigningKeys:
+    if settings.JWT_ALGORITHM not in ASYMMETRIC_ALGORITHMS:
+        return SigningKeys(signing_key=str(settings.SECRET_KEY), verification_key=str(settings.SECRET_KEY))
+    with open(settings.JWT_PRIVATE_KEY_PATH) as key_file:
+        private_key = key_file.read()
+    public_key = jwk.construct(private_key, settings.JWT_ALGORITHM).public_key()
+    public_jwk = public_key.to_dict()
+    kid = settings.JWT_KEY_ID or _jwk_thumbprint(public_jwk)
+    public_jwk.update({'kid': kid, 'use': 'sig'})
+    return SigningKeys(signing_key=private_key,
+                       verification_key=public_key.to_pem().decode(),
+                       kid=kid,
+                       public_jwk=public_jwk)
+
+
+@lru_cache(maxsize=1)
+def get_jwks() -> tuple[bytes, str]:
+    signing_keys = get_signing_keys()
+    keys = [signing_keys.public_jwk] if signing_keys.public_jwk else []
+    body = json.dumps({'keys': keys}, separators=(',', ':'), sort_keys=True).encode()
+    etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+    return body, etag
+
+
+# Passing secret_key signs a one time token with JWT_ONE_TIME_ALGORITHM instead of the service signing key. The typ
+# claim says what the token is for, access tokens unless data sets another type
+def encode_jwt(data, service: str, expires_delta: timedelta | None = None, secret_key: str | None = None):
     if expires_delta:
         expire = datetime.utcnow() + expires_delta
     else:
         expire = datetime.utcnow() + timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
     data.update({"exp": expire})
     data.update({"service": service})
-    encoded_jwt = jwt.encode(data, secret_key, algorithm=settings.JWT_ALGORITHM)
+    data.setdefault("jti", uuid.uuid4().hex)
+    data.setdefault("typ", ACCESS_TOKEN_TYPE)
+    with JWT_DURATION.time(operation="encode"):
+        if secret_key is not None:
+            return jwt.encode(data, secret_key, algorithm=settings.JWT_ONE_TIME_ALGORITHM)
+        signing_keys = get_signing_keys()
+        headers = {"kid": signing_keys.kid} if signing_keys.kid else None
+        encoded_jwt = jwt.encode(data, signing_keys.signing_key, algorithm=settings.JWT_ALGORITHM, headers=headers)
     return encoded_jwt
 
 
-def decode_jwt(token, secret_key: str = str(settings.SECRET_KEY)):
+# Checks the signature, expiry and type but not revocation, see verify_jwt. token_type rejects tokens issued for
+# another purpose, e.g. a verification link presented as an access token
+def decode_jwt(token, secret_key: str | None = None, token_type: str | None = None):
+    if secret_key is not None:
+        key, algorithm = secret_key, settings.JWT_ONE_TIME_ALGORITHM
+    else:
+        key, algorithm = get_signing_keys().verification_key, settings.JWT_ALGORITHM
     try:
-        token_payload = jwt.decode(token, secret_key, algorithms=settings.JWT_ALGORITHM)
+        with JWT_DURATION.time(operation="decode"):
+            token_payload = jwt.decode(token, key, algorithms=algorithm)
     except ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Expired JWT Token")
     except JWTError:
         raise HTTPException(status_code=400, detail="JWT Decode Error")
+    if token_type is not None and token_payload.get("typ") != token_type:
+        raise HTTPException(status_code=401, detail="Wrong JWT Token type")
+    return token_payload
+
+
+# decode_jwt for tokens being used, which also have to be unrevoked
+async def verify_jwt(token, secret_key: str | None = None, token_type: str | None = None):
+    token_payload = decode_jwt(token, secret_key, token_type)
+    # Tokens issued before jtis were added cannot be revoked, so they are let through
+    if "jti" in token_payload and await revocation_store.is_revoked(token_payload["jti"]):
+        raise HTTPException(status_code=401, detail="Revoked JWT Token")
     return token_payload
@@ -0,0 +1,171 @@
+"""Structured JSON logging that never writes on the request path.
+
+Request code logs as usual with logging.getLogger(__name__). Records are only put on a queue there, and a
+QueueListener thread formats, redacts and writes them, one JSON object per line.
+"""
+import contextvars
+import copy
+import json
+import logging
+import queue
+import random
+import re
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from config import settings
+
+
+request_id_var: contextvars.ContextVar[str | None] = contextvars.ContextVar("request_id", default=None)
+# Whether INFO and below are kept for the current request, decided once per request from LOG_SAMPLE_RATES
+request_sampled_var: contextvars.ContextVar[bool] = contextvars.ContextVar("request_sampled", default=True)
+
+SENSITIVE_KEYS = {"password", "new_password", "old_password", "password_hash", "token", "access_token",
+                  "refresh_token", "token_url", "fingerprint", "fgp_hash"}
+REDACTIONS = [
+    (re.compile(r"eyJ[A-Za-z0-9_-]+\.[A-Za-z0-9_-]+\.[A-Za-z0-9_-]*"), "[REDACTED_JWT]"),
+    (re.compile(r"\b((?:token|refresh_token|access_token|password)=)[^&\s]+"), r"\1[REDACTED]"),
+]
+# Attributes every LogRecord has, anything else on a record came from extra= and is logged as a field
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "request_id"}
+
+
+def redact(value):
+    if isinstance(value, str):
+        for pattern, replacement in REDACTIONS:
+            value = pattern.sub(replacement, value)
+    return value
+
+
+class JSONFormatter(logging.Formatter):
+    def __init__(self, redact_secrets: bool = True):
+        super().__init__()
+        self.redact_secrets = redact_secrets
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "request_id": getattr(record, "request_id", None),
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = "[REDACTED]" if self.redact_secrets and key in SENSITIVE_KEYS else value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        if self.redact_secrets:
+            entry = {key: redact(value) for key, value in entry.items()}
+        return json.dumps(entry, default=str)
+
+
+class RequestContextFilter(logging.Filter):
+    """Stamps the request id on records and drops INFO and below for requests that were not sampled.
+
+    Runs on the logging thread, before the record is queued, since the listener thread has no request context.
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get()
+        return record.levelno >= logging.WARNING or request_sampled_var.get()
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """Hands records to the listener with only their message merged, and drops them rather than wait on a full queue."""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    # The default prepare runs the whole JSON formatter, redaction included, on the calling thread. Only the message
+    # is merged here, so arguments changed after the call can't alter it, and the listener does the rest
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_listener: QueueListener | None = None
+_queue_handler: NonBlockingQueueHandler | None = None
+
+
+def start_logging(stream=None):
+    global _listener, _queue_handler
+    if _listener is not None:
+        return
+    output_handler = logging.StreamHandler(stream or sys.stdout)
+    output_handler.setFormatter(JSONFormatter(redact_secrets=settings.LOG_REDACT))
+    _queue_handler = NonBlockingQueueHandler(queue.Queue(maxsize=settings.LOG_QUEUE_SIZE))
+    _queue_handler.addFilter(RequestContextFilter())
+    root_logger = logging.getLogger()
+    root_logger.addHandler(_queue_handler)
+    root_logger.setLevel(settings.LOG_LEVEL)
+    _listener = QueueListener(_queue_handler.queue, output_handler, respect_handler_level=True)
+    _listener.start()
+
+
+# Writes out anything still queued before returning
+def stop_logging():
+    global _listener, _queue_handler
+    if _listener is None:
+        return
+    logging.getLogger().removeHandler(_queue_handler)
+    _listener.stop()
+    _listener, _queue_handler = None, None
+
+
+def _parse_sample_rates(rates) -> dict[str, float]:
+    return {path.strip(): float(rate) for path, rate in (item.split("=") for item in rates)}
+
+
+access_logger = logging.getLogger("access")
+
+
+class RequestLoggingMiddleware:
+    """Pure ASGI middleware that assigns request ids, samples requests by path and writes one access log line.
+
+    An incoming X-Request-ID header is kept so ids can be followed across services, and it is always echoed
+    back. Server errors are logged whether or not the request was sampled.
+    """
+
+    def __init__(self, app, sample_rates: dict[str, float] | None = None):
+        self.app = app
+        self.sample_rates = _parse_sample_rates(settings.LOG_SAMPLE_RATES) if sample_rates is None \
+            else sample_rates
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        request_id = dict(scope['headers']).get(b'x-request-id', b'').decode('latin-1')[:128] or uuid.uuid4().hex
+        sample_rate = self.sample_rates.get(scope['path'], settings.LOG_DEFAULT_SAMPLE_RATE)
+        request_id_token = request_id_var.set(request_id)
+        sampled_token = request_sampled_var.set(sample_rate >= 1 or random.random() < sample_rate)
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+                message['headers'] = [*message.get('headers', []), (b'x-request-id', request_id.encode('latin-1'))]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            access_logger.log(logging.WARNING if status_code >= 500 else logging.INFO,
+                              "%s %s %d", scope['method'], scope['path'], status_code,
+                              extra={"method": scope['method'], "path": scope['path'], "status": status_code,
+                                     "duration_ms": round((time.perf_counter() - start) * 1000, 2)})
+            request_sampled_var.reset(sampled_token)
+            request_id_var.reset(request_id_token)
@@ -1,3 +1,4 @@
+import asyncio
 from typing import Annotated
 from fastapi import FastAPI, Depends
 from fastapi.middleware.cors import CORSMiddleware
@@ -5,6 +6,13 @@ from routes import router
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from config import settings
+from hash_utils import password_hasher
+from metrics import MetricsMiddleware
+from log_utils import RequestLoggingMiddleware, start_logging, stop_logging
+from revocation import run_revocation_refresh
+from state_store import run_state_subscriptions
+from db_utils import get_db
+from warmup import warm_up
 
 allowed_origins = list(settings.ALLOWED_ORIGINS)
 
@@ -16,4 +24,57 @@ app.add_middleware(
     allow_methods=['GET', 'POST'],
     allow_credentials=True
 )
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(RequestLoggingMiddleware)
 app.include_router(router)
+
+
+app.state.ready = False
+
+
+@app.on_event("startup")
+def start_log_listener():
+    start_logging()
+
+
+@app.on_event("startup")
+async def warm_up_app():
+    if settings.WARMUP_ON_STARTUP:
+        await warm_up(app.dependency_overrides.get(get_db, get_db))
+
+
+@app.on_event("startup")
+async def start_revocation_refresh():
+    app.state.revocation_refresh = asyncio.create_task(run_revocation_refresh())
+
+
+@app.on_event("shutdown")
+async def stop_revocation_refresh():
+    app.state.revocation_refresh.cancel()
+
+
+@app.on_event("startup")
+async def start_state_subscriptions():
+    app.state.state_subscriptions = asyncio.create_task(run_state_subscriptions())
+
+
+@app.on_event("shutdown")
+async def stop_state_subscriptions():
+    app.state.state_subscriptions.cancel()
+
+
+@app.on_event("shutdown")
+def shutdown_password_hasher():
+    password_hasher.shutdown()
+
+
+@app.on_event("shutdown")
+def stop_log_listener():
+    stop_logging()
+
+
+# Registered last so /ready only reports ready once every other start up hook, including warm-up, has run. server.py
+# sets it back to False when a worker starts draining
+@app.on_event("startup")
+def mark_ready():
+    app.state.ready = True
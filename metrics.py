@@ -0,0 +1,187 @@
+"""Minimal Prometheus text format metrics, exposed by the /metrics route.
+
+Metrics are per process, so with several workers each one has to be scraped (or the numbers summed) separately.
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(labelnames: tuple, labelvalues: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    metric_type = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: dict[tuple, object] = {}
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self) -> list[str]:
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {value}' for key, value in self._values.items()]
+
+    def render(self) -> str:
+        with self._lock:
+            samples = self._samples()
+        return '\n'.join([f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.metric_type}',
+                          *samples])
+
+
+class Counter(Metric):
+    metric_type = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    # For totals that are counted elsewhere and only ever grow, e.g. TTLCache.hits, mirrored at scrape time
+    def set_total(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Gauge(Metric):
+    metric_type = 'gauge'
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    # Works around awaits too, since it only measures wall clock time between entering and leaving the block
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self) -> list[str]:
+        samples = []
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float('inf') else f'le="{bound}"'
+                samples.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}')
+            samples.append(f'{self.name}_sum{_format_labels(self.labelnames, key)} {total}')
+            samples.append(f'{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}')
+        return samples
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: list[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return '\n'.join(metric.render() for metric in self.metrics) + '\n'
+
+
+registry = MetricsRegistry()
+
+HTTP_REQUESTS = registry.register(Counter(
+    'http_requests_total', 'HTTP requests by route and status', ('method', 'route', 'status')))
+HTTP_REQUEST_DURATION = registry.register(Histogram(
+    'http_request_duration_seconds', 'HTTP request latency by route', ('method', 'route')))
+HTTP_REQUESTS_IN_FLIGHT = registry.register(Gauge(
+    'http_requests_in_flight', 'HTTP requests currently being handled'))
+ARGON2_DURATION = registry.register(Histogram(
+    'argon2_duration_seconds', 'argon2 hash and verify time on the hashing pool', ('operation',)))
+DB_QUERY_DURATION = registry.register(Histogram(
+    'db_query_duration_seconds', 'Database time per crud query', ('query',)))
+JWT_DURATION = registry.register(Histogram(
+    'jwt_duration_seconds', 'JWT encode and decode time', ('operation',),
+    buckets=(0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025)))
+EMAIL_SEND_DURATION = registry.register(Histogram(
+    'email_send_duration_seconds', 'SendGrid request time per attempt', ('outcome',)))
+EMAIL_BACKLOG = registry.register(Gauge(
+    'email_backlog', 'Emails in the outbox by status', ('queue',)))
+CACHE_HITS = registry.register(Counter(
+    'cache_hits_total', 'Cache lookups that found a live entry', ('cache',)))
+CACHE_MISSES = registry.register(Counter(
+    'cache_misses_total', 'Cache lookups that found no entry or an expired one', ('cache',)))
+CACHE_EVICTIONS = registry.register(Counter(
+    'cache_evictions_total', 'Cache entries dropped to stay within maxsize', ('cache',)))
+CACHE_SIZE = registry.register(Gauge(
+    'cache_size', 'Current number of cache entries', ('cache',)))
+HASHING_ADMISSION = registry.register(Gauge(
+    'hashing_admission', 'Hashing admission controller state', ('state',)))
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware recording per route latency, counts and in flight requests."""
+
+    def __init__(self, app):
+        self.app = app
+        self._route_paths: dict | None = None
+
+    # Labels by route template rather than raw path so path parameters cannot blow up the label set
+    def _route_path(self, scope) -> str:
+        if self._route_paths is None:
+            self._route_paths = {route.endpoint: route.path for route in scope['app'].routes
+                                 if hasattr(route, 'endpoint')}
+        return self._route_paths.get(scope.get('endpoint'), 'unmatched')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            await send(message)
+
+        HTTP_REQUESTS_IN_FLIGHT.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            duration = time.perf_counter() - start
+            HTTP_REQUESTS_IN_FLIGHT.dec()
+            route = self._route_path(scope)
+            HTTP_REQUEST_DURATION.observe(duration, method=scope['method'], route=route)
+            HTTP_REQUESTS.inc(method=scope['method'], route=route, status=status_code)
@@ -0,0 +1,151 @@
+import asyncio
+import hashlib
+import logging
+import math
+import threading
+import time
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.orm import sessionmaker
+from cache_utils import TTLCache
+from config import settings
+from database.crud import is_token_revoked_async, get_revoked_tokens_since, prune_revoked_tokens
+from db_utils import SessionLocal, AsyncSessionLocal
+from state_store import state_store
+
+
+logger = logging.getLogger(__name__)
+
+
+class BloomFilter:
+    """Fixed size Bloom filter sized for capacity items at the given false positive rate."""
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = max(1, capacity)
+        self.size = max(8, math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / self.capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    # Double hashing, every probe position comes from one 128 bit digest
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return ((first + i * second) % self.size for i in range(self.hash_count))
+
+    def add(self, item: str):
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+
+class RevocationStore:
+    """Answers whether a jti has been revoked, without touching the database for the common not revoked case.
+
+    A jti missing from the Bloom filter is definitely not revoked. A hit is confirmed against the revoked_tokens
+    table on the async session, confirmed revocations are remembered until the token expires and false positives
+    for REVOCATION_NEGATIVE_CACHE_SECONDS. refresh() adds rows revoked since the last load, and rebuild() prunes
+    expired rows and swaps in a fresh filter, which also picks up any rows committed out of id order. Both use the
+    sync session and are meant to run off the request path, see run_revocation_refresh.
+    """
+
+    def __init__(self, session_factory: sessionmaker, async_session_factory: async_sessionmaker, capacity: int,
+                 error_rate: float):
+        self.session_factory = session_factory
+        self.async_session_factory = async_session_factory
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.bloom = BloomFilter(capacity, error_rate)
+        self.last_id = 0
+        self.db_checks = 0
+        self._revoked = TTLCache(capacity, ttl=float('inf'))
+        self._not_revoked = TTLCache(capacity, ttl=settings.REVOCATION_NEGATIVE_CACHE_SECONDS)
+        self._refresh_lock = threading.Lock()
+
+    def add(self, jti: str, expires_at: float):
+        self.bloom.add(jti)
+        self._revoked.set(jti, True, ttl=expires_at - time.time())
+        self._not_revoked.delete(jti)
+
+    async def is_revoked(self, jti: str) -> bool:
+        if jti not in self.bloom:
+            # A jti revoked here while a rebuild was loading may be missing from the new filter until the next load
+            return self._revoked.get(jti, False)
+        if self._revoked.get(jti):
+            return True
+        if self._not_revoked.get(jti):
+            return False
+        self.db_checks += 1
+        async with self.async_session_factory() as db:
+            revoked = await is_token_revoked_async(db, jti)
+        # add() may have run while the query was in flight, in which case the answer is already stale
+        if revoked or self._revoked.get(jti):
+            return True
+        self._not_revoked.set(jti, True)
+        return False
+
+    def refresh(self):
+        with self._refresh_lock:
+            self._load_new_rows()
+            if self.bloom.count > self.bloom.capacity:
+                self._rebuild()
+
+    def _load_new_rows(self):
+        with self.session_factory() as db:
+            rows = get_revoked_tokens_since(db, self.last_id)
+        for row_id, jti, expires_at in rows:
+            self.add(jti, expires_at)
+            self.last_id = row_id
+
+    def rebuild(self):
+        with self._refresh_lock:
+            self._rebuild()
+
+    # Builds the new filter aside and swaps it in whole, so checks keep using the old one meanwhile
+    def _rebuild(self):
+        with self.session_factory() as db:
+            pruned = prune_revoked_tokens(db, int(time.time()))
+            rows = get_revoked_tokens_since(db, 0)
+        bloom = BloomFilter(max(self.capacity, len(rows) * 2), self.error_rate)
+        for _, jti, _ in rows:
+            bloom.add(jti)
+        self.bloom = bloom
+        self.last_id = rows[-1][0] if rows else 0
+        self._load_new_rows()
+        logger.info("Rebuilt revocation filter with %d tokens, pruned %d expired", len(rows), pruned)
+
+    def clear(self):
+        with self._refresh_lock:
+            self.bloom = BloomFilter(self.capacity, self.error_rate)
+            self.last_id = 0
+            self._revoked.clear()
+            self._not_revoked.clear()
+
+    def stats(self) -> dict:
+        return {"bloom_count": self.bloom.count, "bloom_size_bits": self.bloom.size, "last_id": self.last_id,
+                "db_checks": self.db_checks}
+
+
+revocation_store = RevocationStore(SessionLocal, AsyncSessionLocal, settings.REVOCATION_BLOOM_CAPACITY,
+                                   settings.REVOCATION_BLOOM_ERROR_RATE)
+# Revocations published as {"jti", "expires_at", "token_digest"} reach other workers before their next refresh()
+# would. routes.py evicts token_digest from the introspection cache
+REVOCATION_CHANNEL = "revoked_tokens"
+state_store.subscribe(REVOCATION_CHANNEL, lambda message: revocation_store.add(message["jti"], message["expires_at"]))
+
+
+# Runs for the life of the app, the database work happens on a thread so it never blocks request handling
+async def run_revocation_refresh(store: RevocationStore = revocation_store):
+    last_rebuild = None
+    while True:
+        try:
+            if last_rebuild is None or time.monotonic() - last_rebuild >= settings.REVOCATION_REBUILD_SECONDS:
+                await asyncio.to_thread(store.rebuild)
+                last_rebuild = time.monotonic()
+            else:
+                await asyncio.to_thread(store.refresh)
+        except Exception:
+            logger.exception("Refreshing the revocation filter failed")
+        await asyncio.sleep(settings.REVOCATION_REFRESH_SECONDS)
@@ -1,22 +1,50 @@
+import hashlib
+import logging
+import time
 from typing import Annotated
-from fastapi import APIRouter, HTTPException, Depends, status, Form, BackgroundTasks, Request, Response
+from fastapi import APIRouter, HTTPException, Depends, status, Form, Request, Response
 from fastapi.responses import RedirectResponse
 from fastapi.security import OAuth2PasswordRequestForm
-from pydantic import BaseModel
+from pydantic import BaseModel, conlist
 from database import auth_schemas
-from database.crud import get_user_by_email, get_user_by_username, create_user, get_user_by_public_id
+from database.crud import get_user_by_email_async, get_user_by_username_async, create_user_async, \
+    get_user_by_public_id_async, get_outbox_depth, invalidate_cached_user, user_cache, create_refresh_token, \
+    get_refresh_token_async, mark_refresh_token_used, revoke_refresh_token_family, revoke_user_refresh_tokens, \
+    revoke_token_async, get_user_snapshots_by_public_ids_async
 from db_utils import get_db
-from sqlalchemy.orm import Session
-from utils import pwd_hasher
+from sqlalchemy.ext.asyncio import AsyncSession
+from hash_utils import password_hasher
 from email_utils import VerificationEmail, PasswordResetEmail, PasswordResetConfirmationEmail
-from jwt_utilities import encode_jwt, decode_jwt
-from config import settings
+from jwt_utilities import encode_jwt, decode_jwt, verify_jwt, get_jwks, ACCESS_TOKEN_TYPE
+from cache_utils import TTLCache
+from throttling import enforce_throttle
+from revocation import revocation_store, REVOCATION_CHANNEL
+from state_store import state_store
+from config import settings, services
+from metrics import registry, EMAIL_BACKLOG, CACHE_HITS, CACHE_MISSES, CACHE_EVICTIONS, CACHE_SIZE, HASHING_ADMISSION
 
 # TODO add not valid before to JWT
-# TODO refresh tokens
 # TODO update password on reset password link click https://www.smashingmagazine.com/2017/11/safe-password-resets-with-json-web-tokens/
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
+
+# Decoded access token payloads keyed by _token_digest, never kept past the token's exp claim
+introspection_cache = TTLCache(settings.INTROSPECTION_CACHE_SIZE, settings.INTROSPECTION_CACHE_TTL_SECONDS)
+MAX_TOKEN_LIFETIME_SECONDS = max(settings.ACCESS_TOKEN_EXPIRE_MINUTES, settings.ONE_TIME_TOKEN_EXPIRE_MINUTES) * 60
+state_store.subscribe(REVOCATION_CHANNEL, lambda message: introspection_cache.delete(message["token_digest"]))
+
+
+# Some ASGI servers leave the client address out of the scope, those requests share one throttle bucket
+def _client_host(request: Request) -> str:
+    return request.client.host if request.client is not None else "unknown"
+
+
+def valid_service(service: str) -> str:
+    if service not in services:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail="Unknown service")
+    return service
 
 
 class SignupForm:
@@ -49,30 +77,45 @@ class PasswordResetRequestForm:
         self.email = email
 
 
+class RefreshForm:
+    def __init__(self,
+                 refresh_token: str = Form()):
+        self.refresh_token = refresh_token
+
+
+class IntrospectionForm:
+    def __init__(self,
+                 token: str = Form()):
+        self.token = token
+
+
+class BatchIntrospectionRequest(BaseModel):
+    tokens: conlist(str, min_items=1, max_items=settings.INTROSPECTION_BATCH_MAX_TOKENS)
+
+
 class Token(BaseModel):
     access_token: str
+    refresh_token: str
     #token_type: str
 
 
 @router.post("/signup", status_code=status.HTTP_201_CREATED)
-async def signup_user(service: str,
-                      background_tasks: BackgroundTasks,
+async def signup_user(service: Annotated[str, Depends(valid_service)],
                       form_data: Annotated[SignupForm, Depends()],
                       request: Request,
                       redirect_url: str = None,
-                      db: Session = Depends(get_db)):
-    db_user_email = get_user_by_email(db, form_data.email, service)
-    db_user_username = get_user_by_username(db, form_data.username, service)
-    if db_user_email or db_user_username:
-        raise HTTPException(status_code=409, detail="Email or username already registered.")
+                      db: AsyncSession = Depends(get_db)):
     user = auth_schemas.UserCreate(
         email=form_data.email,
         username=form_data.username,
-        password_hash=pwd_hasher.hash(form_data.password)
+        password_hash=await password_hasher.hash(form_data.password)
     )
-    user_object = create_user(db=db, user=user, service=service)
+    user_object = await create_user_async(db=db, user=user, service=service, commit=False)
+    if user_object is None:
+        raise HTTPException(status_code=409, detail="Email or username already registered.")
     verification_email = VerificationEmail(user_object, service, str(request.url_for('verify_user')), redirect_url)
-    background_tasks.add_task(verification_email.send_email)
+    verification_email.send_email(db)
+    await db.commit()
     return {"detail": "user created",
             "public_id": user_object.public_id}
 
@@ -80,45 +123,61 @@ async def signup_user(service: str,
 @router.get("/verify")
 async def verify_user(token: str,
                       redirect_url: str = None,
-                      db: Session = Depends(get_db)):
-    print(token)
-    token_payload = decode_jwt(token)
-    user = get_user_by_public_id(db, token_payload['sub'], token_payload['service'])
+                      db: AsyncSession = Depends(get_db)):
+    token_payload = await verify_jwt(token, token_type=VerificationEmail.token_type)
+    user = await get_user_by_public_id_async(db, token_payload['sub'], token_payload['service'])
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                             detail="Invalid JWT")
     else:
         user.verified = True
-        db.commit() #TODO move this to db crud utils?
+        await db.commit() #TODO move this to db crud utils?
+        await invalidate_cached_user(user)
+        logger.info("User verified", extra={"public_id": user.public_id, "service": user.service})
         return RedirectResponse(redirect_url)
 
 
+# Issues an access token with a fresh fingerprint cookie, plus a refresh token in family_id or a new family
+async def issue_tokens(db: AsyncSession, user, service: str, response: Response, family_id: str | None = None) -> dict:
+    # https://cheatsheetseries.owasp.org/cheatsheets/JSON_Web_Token_for_Java_Cheat_Sheet.html
+    fingerprint, fingerprint_hash = user.generate_user_fingerprint()
+    access_token_payload = {
+        'fgp_hash': fingerprint_hash,
+        'sub': user.public_id
+    }
+    access_token = encode_jwt(access_token_payload, service)
+    refresh_token = create_refresh_token(db, user, service, family_id)
+    await db.commit()
+    response.set_cookie(key="__Secure-fgp",
+                        value=fingerprint,
+                        httponly=True,
+                        secure=True,
+                        samesite='strict',
+                        max_age=settings.ACCESS_TOKEN_EXPIRE_MINUTES*60)
+    return {"access_token": access_token, "refresh_token": refresh_token}
+
+
 @router.post("/auth", response_model=Token)
-async def login_user(service: str,
+async def login_user(service: Annotated[str, Depends(valid_service)],
                      form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
+                     request: Request,
                      response: Response,
-                     db: Session = Depends(get_db)):
-    user = get_user_by_username(db, form_data.username, service)
+                     db: AsyncSession = Depends(get_db)):
+    await enforce_throttle(_client_host(request), (service, form_data.username))
+    user = await get_user_by_username_async(db, form_data.username, service)
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                             detail="Authorisation Error",
                             headers={"WWW-Authenticate": "Bearer"})
-    if user.authenticate_user(form_data.password):
+    password_verified, new_password_hash = await password_hasher.verify_and_rehash(user.password_hash,
+                                                                                  form_data.password)
+    if password_verified:
+        if new_password_hash is not None:
+            user.password_hash = new_password_hash
+            await db.commit()
+            await invalidate_cached_user(user)
         if user.verified and not user.password_locked:
-            # https://cheatsheetseries.owasp.org/cheatsheets/JSON_Web_Token_for_Java_Cheat_Sheet.html
-            fingerprint, fingerprint_hash = user.generate_user_fingerprint()
-            access_token_payload = {
-                'fgp_hash': fingerprint_hash,
-                'sub': user.public_id
-            }
-            access_token = encode_jwt(access_token_payload, service)
-            response.set_cookie(key="__Secure-fgp",
-                                value=fingerprint,
-                                httponly=True,
-                                secure=True,
-                                samesite='strict',
-                                max_age=settings.ACCESS_TOKEN_EXPIRE_MINUTES*60)
-            return {"access_token": access_token}
+            return await issue_tokens(db, user, service, response)
         else:
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
                                 detail="Account not verified.")
@@ -128,20 +187,48 @@ async def login_user(service: str,
                             headers={"WWW-Authenticate": "Bearer"})
 
 
+# Refresh tokens are single use. Presenting one that was already rotated means it has leaked, so its whole family
+# is revoked and the client has to log in again
+@router.post("/refresh", response_model=Token)
+async def refresh_tokens(service: Annotated[str, Depends(valid_service)],
+                         form_data: Annotated[RefreshForm, Depends()],
+                         response: Response,
+                         db: AsyncSession = Depends(get_db)):
+    refresh_exception = HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                                      detail="Invalid refresh token",
+                                      headers={"WWW-Authenticate": "Bearer"})
+    refresh_token = await get_refresh_token_async(db, form_data.refresh_token, service)
+    if refresh_token is None or refresh_token.revoked or refresh_token.expires_at <= time.time():
+        raise refresh_exception
+    if not await mark_refresh_token_used(db, refresh_token.id):
+        await revoke_refresh_token_family(db, refresh_token.family_id)
+        await db.commit()
+        raise refresh_exception
+    user = await get_user_by_public_id_async(db, refresh_token.public_id, service)
+    if user is None or not user.verified or user.password_locked:
+        await db.commit()
+        raise refresh_exception
+    return await issue_tokens(db, user, service, response, refresh_token.family_id)
+
+
 @router.post("/changepassword")
-async def change_password(service: str,
+async def change_password(service: Annotated[str, Depends(valid_service)],
                           username: str,
                           form_data: Annotated[PasswordChangeForm, Depends()],
-                          db: Session = Depends(get_db)):
-    user = get_user_by_username(db, username, service)
+                          request: Request,
+                          db: AsyncSession = Depends(get_db)):
+    await enforce_throttle(_client_host(request), (service, username))
+    user = await get_user_by_username_async(db, username, service)
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                             detail="Authorisation Error",
                             headers={"WWW-Authenticate": "Bearer"})
-    if user.authenticate_user(form_data.old_password): #TODO do we need password reset lock here as well?
-        user.password_hash = pwd_hasher.hash(form_data.new_password)
-        db.commit()
-        db.refresh(user)
+    if await password_hasher.verify(user.password_hash, form_data.old_password): #TODO do we need password reset lock here as well?
+        user.password_hash = await password_hasher.hash(form_data.new_password)
+        await revoke_user_refresh_tokens(db, user)
+        await db.commit()
+        await invalidate_cached_user(user)
+        await db.refresh(user)
         return {"detail": "Password changed"}
     else:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
@@ -150,47 +237,171 @@ async def change_password(service: str,
 
 
 @router.post("/resetpasswordrequest")
-async def request_password_reset(service: str,
+async def request_password_reset(service: Annotated[str, Depends(valid_service)],
                                  form_data: Annotated[PasswordResetRequestForm, Depends()],
                                  request: Request,
-                                 background_tasks: BackgroundTasks,
-                                 db: Session = Depends(get_db)):
-    user = get_user_by_email(db, form_data.email, service)
+                                 db: AsyncSession = Depends(get_db)):
+    await enforce_throttle(_client_host(request), (service, form_data.email))
+    user = await get_user_by_email_async(db, form_data.email, service)
     if user is not None:
         password_reset_email = PasswordResetEmail(user, service)
-        print(password_reset_email.token_url)
-        background_tasks.add_task(password_reset_email.send_email)
+        password_reset_email.send_email(db)
         user.password_locked = True
-        db.commit()
-        db.refresh(user)
+        user.password_locked_at = int(time.time())
+        await revoke_user_refresh_tokens(db, user)
+        await db.commit()
+        await invalidate_cached_user(user)
+        await db.refresh(user)
+        logger.info("Password reset requested", extra={"public_id": user.public_id, "service": service})
     return {"detail": "Password reset link sent if user exists."}
 
 
 @router.post("/resetpassword")
 async def password_reset(token,
                          username,
-                         service,
+                         service: Annotated[str, Depends(valid_service)],
                          form_data: Annotated[PasswordResetForm, Depends()],
-                         background_tasks: BackgroundTasks,
-                         db: Session = Depends(get_db)):
-    user = get_user_by_username(db, username, service)
-    print(token)
+                         db: AsyncSession = Depends(get_db)):
+    user = await get_user_by_username_async(db, username, service)
     if not user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
     secret_key = f"{user.password_hash}_{user.created_at}"
-    token_payload = decode_jwt(token, secret_key)
+    token_payload = await verify_jwt(token, secret_key, token_type=PasswordResetEmail.token_type)
     token_public_id = token_payload['sub']
     if token_public_id != user.public_id:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED)
-    user.password_hash = pwd_hasher.hash(form_data.new_password)
-    db.commit()
-    db.refresh(user)
+    user.password_hash = await password_hasher.hash(form_data.new_password)
+    user.password_locked = False
+    user.password_locked_at = None
     password_reset_conformation_email = PasswordResetConfirmationEmail(user, token_payload['service'])
-    background_tasks.add_task(password_reset_conformation_email.send_email)
+    password_reset_conformation_email.send_email(db)
+    await revoke_user_refresh_tokens(db, user)
+    await db.commit()
+    await invalidate_cached_user(user)
+    await db.refresh(user)
     return {"detail": "Password reset!"}
 
 
+# Keeps raw tokens out of the introspection cache and the revocation messages other workers receive
+def _token_digest(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+# The decoded payload of a valid, unrevoked access token, or None. Payloads are cached until the token's exp claim,
+# or INTROSPECTION_CACHE_TTL_SECONDS for tokens without one
+async def _decode_access_token(token: str) -> dict | None:
+    digest = _token_digest(token)
+    token_payload = introspection_cache.get(digest)
+    if token_payload is None:
+        try:
+            token_payload = decode_jwt(token, token_type=ACCESS_TOKEN_TYPE)
+        except HTTPException:
+            return None
+        expires_at = token_payload.get('exp')
+        introspection_cache.set(digest, token_payload, ttl=None if expires_at is None else expires_at - time.time())
+    if "jti" in token_payload and await revocation_store.is_revoked(token_payload["jti"]):
+        introspection_cache.delete(digest)
+        return None
+    return token_payload
+
+
+def _user_key(token_payload: dict) -> tuple[str, str] | None:
+    key = (token_payload.get('service'), token_payload.get('sub'))
+    return key if all(isinstance(part, str) for part in key) else None
+
+
+# User state comes from the user cache rather than the introspection cache, so it is current as soon as
+# invalidate_cached_user has run
+def _introspection_result(token_payload: dict | None, users: dict[tuple, dict]) -> dict:
+    user = None if token_payload is None else users.get(_user_key(token_payload))
+    if user is None:
+        return {"active": False}
+    return {"active": True,
+            **token_payload,
+            "verified": user['verified'],
+            "password_locked": user['password_locked']}
+
+
+# https://datatracker.ietf.org/doc/html/rfc7662
+@router.post("/introspect")
+async def introspect_token(form_data: Annotated[IntrospectionForm, Depends()],
+                           db: AsyncSession = Depends(get_db)):
+    token_payload = await _decode_access_token(form_data.token)
+    if token_payload is None or _user_key(token_payload) is None:
+        return {"active": False}
+    users = await get_user_snapshots_by_public_ids_async(db, [_user_key(token_payload)])
+    return _introspection_result(token_payload, users)
+
+
+# For gateways checking many tokens at once, results are in the order of the tokens. All users not in the user
+# cache are fetched with one query
+@router.post("/introspect/batch")
+async def introspect_tokens(batch: BatchIntrospectionRequest, db: AsyncSession = Depends(get_db)):
+    token_payloads = [await _decode_access_token(token) for token in batch.tokens]
+    keys = [_user_key(token_payload) for token_payload in token_payloads if token_payload is not None]
+    users = await get_user_snapshots_by_public_ids_async(db, [key for key in keys if key is not None])
+    return {"results": [_introspection_result(token_payload, users) for token_payload in token_payloads]}
+
+
+# https://datatracker.ietf.org/doc/html/rfc7009, tokens signed with the service key are revoked until their exp.
+# Anything else is refused, so a forged token can't be used to revoke someone else's jti. That includes password
+# reset tokens, whose per user signing secret this route cannot know. Tokens issued without a jti get a 200
+@router.post("/revoke")
+async def revoke_token(form_data: Annotated[IntrospectionForm, Depends()],
+                       db: AsyncSession = Depends(get_db)):
+    token_payload = decode_jwt(form_data.token)
+    if token_payload.get("service") not in services:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid JWT")
+    jti, expires_at = token_payload.get("jti"), token_payload.get("exp")
+    if isinstance(jti, str) and isinstance(expires_at, int):
+        # No token is issued for longer than this, so a revocation can't be made to outlive the token
+        expires_at = min(expires_at, int(time.time()) + MAX_TOKEN_LIFETIME_SECONDS)
+        await revoke_token_async(db, jti, expires_at)
+        await db.commit()
+        digest = _token_digest(form_data.token)
+        revocation_store.add(jti, expires_at)
+        introspection_cache.delete(digest)
+        await state_store.publish(REVOCATION_CHANNEL, {"jti": jti, "expires_at": expires_at, "token_digest": digest})
+    return {"detail": "Token revoked"}
+
+
+@router.get("/.well-known/jwks.json")
+async def get_jwks_document(request: Request):
+    body, etag = get_jwks()
+    headers = {"ETag": etag,
+               "Cache-Control": f"public, max-age={settings.JWKS_MAX_AGE_SECONDS}"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+# For load balancer health checks, 503 until the app has warmed up and again once server.py starts draining it
+@router.get("/ready")
+async def get_ready(request: Request):
+    if not request.app.state.ready:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Not ready")
+    return {"detail": "ready"}
 
 
+@router.get("/stats")
+async def get_stats(db: AsyncSession = Depends(get_db)):
+    return {"introspection_cache": introspection_cache.stats(),
+            "user_cache": user_cache.stats(),
+            "hashing": password_hasher.admission.stats(),
+            "revocation": revocation_store.stats(),
+            "email_outbox": await get_outbox_depth(db)}
 
 
+# Gauges and counters that mirror state owned elsewhere are refreshed at scrape time rather than on every change
+@router.get("/metrics")
+async def get_metrics(db: AsyncSession = Depends(get_db)):
+    for queue, depth in (await get_outbox_depth(db)).items():
+        EMAIL_BACKLOG.set(depth, queue=f"outbox_{queue}")
+    for cache_name, cache in (("introspection", introspection_cache), ("user", user_cache)):
+        cache_stats = cache.stats()
+        for event, counter in (("hits", CACHE_HITS), ("misses", CACHE_MISSES), ("evictions", CACHE_EVICTIONS)):
+            counter.set_total(cache_stats[event], cache=cache_name)
+        CACHE_SIZE.set(cache_stats["size"], cache=cache_name)
+    for state, value in password_hasher.admission.stats().items():
+        HASHING_ADMISSION.set(value, state=state)
+    return Response(content=registry.render(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,175 @@
+"""Production entry point, runs the app on uvicorn workers forked from one preloaded parent.
+
+    python server.py
+    python server.py --workers 4 --port 8080
+
+The parent binds the listening socket and imports main once, then forks the workers, which share the socket and the
+already imported code. Workers run on uvloop and httptools, and only start accepting connections once their start up
+hooks, including warm-up, have finished. SIGTERM or SIGINT drains every worker: /ready turns 503 while they keep
+serving for SERVER_DRAIN_SECONDS, so the load balancer stops sending them traffic, then they stop accepting, finish
+in-flight requests for up to SERVER_GRACEFUL_TIMEOUT_SECONDS and run their shutdown hooks. Workers that die are
+replaced.
+"""
+import argparse
+import asyncio
+import logging
+import math
+import os
+import signal
+import socket
+import sys
+import time
+import uvicorn
+from config import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+def physical_memory_mib() -> int:
+    return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") // (1024 * 1024)
+
+
+def worker_count(cores: int | None = None, memory_budget_mib: int | None = None) -> int:
+    if settings.SERVER_WORKERS > 0:
+        return settings.SERVER_WORKERS
+    cores = cores or os.cpu_count() or 1
+    memory_budget_mib = memory_budget_mib or settings.SERVER_MEMORY_BUDGET_MIB or physical_memory_mib() * 3 // 4
+    memory_limited = memory_budget_mib // (settings.HASHING_MEMORY_BUDGET_MIB + settings.SERVER_WORKER_MEMORY_MIB)
+    return max(1, min(cores, memory_limited))
+
+
+# Hashing pool and admission limits are per process, so each worker gets its share of the cores. Has to run before
+# hash_utils is imported, which builds the pool from these settings
+def share_hashing_capacity(workers: int, cores: int | None = None):
+    per_worker = max(1, math.ceil((cores or os.cpu_count() or 1) / workers))
+    settings.HASHING_WORKERS = min(settings.HASHING_WORKERS, per_worker)
+    settings.HASHING_MAX_CONCURRENCY = min(settings.HASHING_MAX_CONCURRENCY, per_worker)
+
+
+# User cache invalidation, revocations and throttles only reach every worker through a shared state store, see
+# state_store.py. With the memory backend each worker would keep authenticating with its own stale copy
+def check_state_backend(workers: int):
+    if workers > 1 and settings.STATE_BACKEND != "sqlite":
+        raise ValueError(f"{workers} workers need STATE_BACKEND=sqlite, not {settings.STATE_BACKEND}")
+
+
+def bind_socket(host: str, port: int, backlog: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+class DrainingServer(uvicorn.Server):
+    """Marks the app not ready on the first exit signal and only starts uvicorn's shutdown drain_seconds later."""
+
+    def __init__(self, config: uvicorn.Config, app, drain_seconds: float):
+        super().__init__(config)
+        self.app = app
+        self.drain_seconds = drain_seconds
+        self.draining = False
+
+    # Runs on the event loop, uvicorn installs it with loop.add_signal_handler. A second signal skips the drain
+    def handle_exit(self, sig, frame):
+        if self.draining or self.drain_seconds <= 0:
+            return super().handle_exit(sig, frame)
+        self.draining = True
+        self.app.state.ready = False
+        logger.info("Draining for %ss before shutting down", self.drain_seconds)
+        asyncio.get_running_loop().call_later(self.drain_seconds, super().handle_exit, sig, frame)
+
+
+def run_worker(app, sock: socket.socket):
+    # The parent's handlers would duplicate the worker's own JSON log output, see log_utils.start_logging
+    logging.getLogger().handlers.clear()
+    config = uvicorn.Config(app,
+                            loop="uvloop",
+                            http="httptools",
+                            lifespan="on",
+                            backlog=settings.SERVER_BACKLOG,
+                            timeout_keep_alive=settings.SERVER_KEEPALIVE_SECONDS,
+                            timeout_graceful_shutdown=settings.SERVER_GRACEFUL_TIMEOUT_SECONDS,
+                            # RequestLoggingMiddleware writes the access log
+                            access_log=False,
+                            log_config=None,
+                            server_header=False)
+    DrainingServer(config, app, settings.SERVER_DRAIN_SECONDS).run(sockets=[sock])
+
+
+class Supervisor:
+    def __init__(self, app, sock: socket.socket, workers: int):
+        self.app = app
+        self.sock = sock
+        self.workers = workers
+        self.children: set[int] = set()
+        self.stopping = False
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGALRM, signal.SIG_DFL)
+            # os._exit skips the parent's atexit handlers and buffers, which belong to the parent alone
+            try:
+                run_worker(self.app, self.sock)
+            except BaseException:
+                logger.exception("Worker %d failed", os.getpid())
+                os._exit(1)
+            os._exit(0)
+        self.children.add(pid)
+
+    def stop(self, signum, frame):
+        if self.stopping:
+            return
+        self.stopping = True
+        logger.info("Draining %d workers", len(self.children))
+        for pid in self.children:
+            os.kill(pid, signal.SIGTERM)
+        # Workers still alive a while after their own drain and graceful timeout are killed
+        signal.alarm(math.ceil(settings.SERVER_DRAIN_SECONDS) + settings.SERVER_GRACEFUL_TIMEOUT_SECONDS + 5)
+
+    def kill(self, signum, frame):
+        for pid in self.children:
+            os.kill(pid, signal.SIGKILL)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGALRM, self.kill)
+        for _ in range(self.workers):
+            self.spawn()
+        while self.children:
+            pid, status = os.wait()
+            self.children.discard(pid)
+            if not self.stopping:
+                logger.warning("Worker %d exited with status %d, starting a new one", pid,
+                               os.waitstatus_to_exitcode(status))
+                # Keeps a worker that can't start from being restarted in a tight loop
+                time.sleep(1)
+                if not self.stopping:
+                    self.spawn()
+        self.sock.close()
+
+
+def serve(host: str, port: int, workers: int):
+    check_state_backend(workers)
+    share_hashing_capacity(workers)
+    sock = bind_socket(host, port, settings.SERVER_BACKLOG)
+    # Imported after the hashing settings are shared out, and before forking so every worker starts with it loaded
+    from main import app
+    logger.info("Serving on %s:%d with %d workers", host, port, workers)
+    Supervisor(app, sock, workers).run()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the auth server")
+    parser.add_argument("--host", default=settings.SERVER_HOST)
+    parser.add_argument("--port", type=int, default=settings.SERVER_PORT)
+    parser.add_argument("--workers", type=int, default=0, help="defaults to SERVER_WORKERS, or sized for this host")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    serve(args.host, args.port, args.workers or worker_count())
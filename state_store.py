@@ -0,0 +1,265 @@
+"""State that has to agree across uvicorn workers: counters, keys with a TTL and invalidation messages.
+
+STATE_BACKEND=memory keeps everything in process, which is only correct with a single worker. STATE_BACKEND=sqlite
+shares one SQLite file between every worker on a host. Messages published there reach the other workers' subscribers
+within STATE_POLL_SECONDS, see run_state_subscriptions. The publisher never receives its own messages, so it has to
+apply the change locally as well. Reads and writes are async, SQLite runs them on a thread so a busy file never
+blocks the event loop.
+"""
+import abc
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Callable
+from config import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class StateStore(abc.ABC):
+    shared = False
+
+    def __init__(self):
+        self._subscribers: dict[str, list[Callable]] = {}
+
+    @abc.abstractmethod
+    async def get(self, key: str, default=None):
+        pass
+
+    @abc.abstractmethod
+    async def set(self, key: str, value, ttl: float | None = None):
+        pass
+
+    @abc.abstractmethod
+    async def delete(self, key: str):
+        pass
+
+    # Atomically adds amount and returns the new value. ttl only applies when the key is created (or had expired)
+    @abc.abstractmethod
+    async def incr(self, key: str, amount: int = 1, ttl: float | None = None) -> int:
+        pass
+
+    @abc.abstractmethod
+    async def publish(self, channel: str, message):
+        pass
+
+    def subscribe(self, channel: str, callback: Callable):
+        self._subscribers.setdefault(channel, []).append(callback)
+
+    def _deliver(self, channel: str, message):
+        for callback in self._subscribers.get(channel, []):
+            try:
+                callback(message)
+            except Exception:
+                logger.exception("State store subscriber for %s failed", channel)
+
+    # Delivers messages published by other workers since the last poll, returns how many were received
+    def poll(self) -> int:
+        return 0
+
+    # Drops expired keys and old messages
+    def prune(self):
+        pass
+
+    @abc.abstractmethod
+    def clear(self):
+        pass
+
+
+class MemoryStateStore(StateStore):
+    def __init__(self):
+        super().__init__()
+        self._data: dict[str, tuple[object, float | None]] = {}
+        self._lock = threading.Lock()
+
+    # Call with the lock held
+    def _live_value(self, key: str, now: float):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= now:
+            del self._data[key]
+            return None
+        return entry
+
+    async def get(self, key: str, default=None):
+        with self._lock:
+            entry = self._live_value(key, time.time())
+        return default if entry is None else entry[0]
+
+    async def set(self, key: str, value, ttl: float | None = None):
+        with self._lock:
+            self._data[key] = (value, None if ttl is None else time.time() + ttl)
+
+    async def delete(self, key: str):
+        with self._lock:
+            self._data.pop(key, None)
+
+    async def incr(self, key: str, amount: int = 1, ttl: float | None = None) -> int:
+        now = time.time()
+        with self._lock:
+            entry = self._live_value(key, now)
+            if entry is None:
+                entry = (0, None if ttl is None else now + ttl)
+            value = entry[0] + amount
+            self._data[key] = (value, entry[1])
+            return value
+
+    # There are no other workers to tell
+    async def publish(self, channel: str, message):
+        pass
+
+    def prune(self):
+        now = time.time()
+        with self._lock:
+            for key in list(self._data):
+                self._live_value(key, now)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class SQLiteStateStore(StateStore):
+    """Shares state between processes through one SQLite file in WAL mode.
+
+    Every statement is a single atomic write, so incr needs no locking of its own. Values set with set() are stored
+    as JSON, counters as integers. The async methods run their statement with asyncio.to_thread, and each thread gets
+    its own connection.
+    """
+
+    shared = True
+
+    def __init__(self, path: str, message_retention: float = 60):
+        super().__init__()
+        self.path = path
+        self.message_retention = message_retention
+        self.origin = uuid.uuid4().hex
+        self._local = threading.local()
+        # SQLite connections must not be used across a fork, e.g. by server.py's workers
+        os.register_at_fork(after_in_child=self._reset_connections)
+        connection = self._connection()
+        connection.execute("CREATE TABLE IF NOT EXISTS state_keys (key TEXT PRIMARY KEY, value, expires_at REAL)")
+        connection.execute("CREATE TABLE IF NOT EXISTS state_messages (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                           "origin TEXT NOT NULL, channel TEXT NOT NULL, message TEXT NOT NULL, created_at REAL NOT NULL)")
+        # Only messages published after this worker started are delivered to it
+        self.last_message_id = connection.execute("SELECT coalesce(max(id), 0) FROM state_messages").fetchone()[0]
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=settings.SQLITE_BUSY_TIMEOUT_MS / 1000,
+                                         isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def _reset_connections(self):
+        self._local = threading.local()
+
+    async def get(self, key: str, default=None):
+        return await asyncio.to_thread(self._get, key, default)
+
+    async def set(self, key: str, value, ttl: float | None = None):
+        await asyncio.to_thread(self._set, key, value, ttl)
+
+    async def delete(self, key: str):
+        await asyncio.to_thread(self._delete, key)
+
+    async def incr(self, key: str, amount: int = 1, ttl: float | None = None) -> int:
+        return await asyncio.to_thread(self._incr, key, amount, ttl)
+
+    async def publish(self, channel: str, message):
+        await asyncio.to_thread(self._publish, channel, message)
+
+    def _get(self, key: str, default=None):
+        row = self._connection().execute(
+            "SELECT value FROM state_keys WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (key, time.time())).fetchone()
+        if row is None:
+            return default
+        return json.loads(row[0]) if isinstance(row[0], str) else row[0]
+
+    def _set(self, key: str, value, ttl: float | None = None):
+        self._connection().execute(
+            "INSERT OR REPLACE INTO state_keys (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, json.dumps(value), None if ttl is None else time.time() + ttl))
+
+    def _delete(self, key: str):
+        self._connection().execute("DELETE FROM state_keys WHERE key = ?", (key,))
+
+    def _incr(self, key: str, amount: int = 1, ttl: float | None = None) -> int:
+        now = time.time()
+        # An expired row restarts from amount with a new expiry, as if it had been deleted
+        return self._connection().execute(
+            "INSERT INTO state_keys (key, value, expires_at) VALUES (?1, ?2, ?3) "
+            "ON CONFLICT (key) DO UPDATE SET "
+            "value = CASE WHEN expires_at <= ?4 THEN excluded.value ELSE value + excluded.value END, "
+            "expires_at = CASE WHEN expires_at <= ?4 THEN excluded.expires_at ELSE expires_at END "
+            "RETURNING value",
+            (key, amount, None if ttl is None else now + ttl, now)).fetchone()[0]
+
+    def _publish(self, channel: str, message):
+        self._connection().execute(
+            "INSERT INTO state_messages (origin, channel, message, created_at) VALUES (?, ?, ?, ?)",
+            (self.origin, channel, json.dumps(message), time.time()))
+
+    # Not thread safe, only run_state_subscriptions should call this
+    def poll(self) -> int:
+        rows = self._connection().execute(
+            "SELECT id, origin, channel, message FROM state_messages WHERE id > ? ORDER BY id",
+            (self.last_message_id,)).fetchall()
+        received = 0
+        for message_id, origin, channel, message in rows:
+            self.last_message_id = message_id
+            if origin != self.origin:
+                self._deliver(channel, json.loads(message))
+                received += 1
+        return received
+
+    def prune(self):
+        now = time.time()
+        connection = self._connection()
+        connection.execute("DELETE FROM state_keys WHERE expires_at <= ?", (now,))
+        connection.execute("DELETE FROM state_messages WHERE created_at <= ?", (now - self.message_retention,))
+
+    def clear(self):
+        connection = self._connection()
+        connection.execute("DELETE FROM state_keys")
+        connection.execute("DELETE FROM state_messages")
+
+
+def create_state_store() -> StateStore:
+    match settings.STATE_BACKEND:
+        case "memory":
+            return MemoryStateStore()
+        case "sqlite":
+            return SQLiteStateStore(settings.STATE_STORE_PATH, settings.STATE_MESSAGE_RETENTION_SECONDS)
+    raise ValueError(f"Unknown STATE_BACKEND {settings.STATE_BACKEND}")
+
+
+state_store = create_state_store()
+
+
+# Runs for the life of the app, polling for messages from other workers on a thread
+async def run_state_subscriptions(store: StateStore = state_store):
+    if not store.shared:
+        return
+    last_prune = time.monotonic()
+    while True:
+        try:
+            await asyncio.to_thread(store.poll)
+            if time.monotonic() - last_prune >= store.message_retention:
+                await asyncio.to_thread(store.prune)
+                last_prune = time.monotonic()
+        except Exception:
+            logger.exception("Polling the state store failed")
+        await asyncio.sleep(settings.STATE_POLL_SECONDS)
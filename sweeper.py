@@ -0,0 +1,84 @@
+"""Deletes (or archives) users that never verified, clears password locks whose reset link has expired and deletes
+old sent and failed outbox emails.
+
+Run as its own process: python sweeper.py [--once] [--archive]
+
+Swept users are evicted from the user cache through the state store, so with STATE_BACKEND=sqlite and the API's
+STATE_STORE_PATH the API workers stop serving them within STATE_POLL_SECONDS.
+"""
+import argparse
+import asyncio
+import logging
+import time
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from config import settings
+from database.crud import sweep_unverified_users, clear_expired_password_locks, invalidate_cached_users, \
+    prune_outbox_emails
+from db_utils import AsyncSessionLocal
+
+
+logger = logging.getLogger(__name__)
+
+
+# Runs batches until one comes back short, pausing between them so API writes can take the lock in between
+async def _sweep_batches(sweep_batch, batch_size: int, batch_pause: float) -> int:
+    total = 0
+    while True:
+        swept = await sweep_batch()
+        total += swept
+        if swept < batch_size:
+            return total
+        await asyncio.sleep(batch_pause)
+
+
+async def sweep_once(session_factory: async_sessionmaker = AsyncSessionLocal,
+                     unverified_max_age_days: int = settings.SWEEPER_UNVERIFIED_MAX_AGE_DAYS,
+                     archive: bool = settings.SWEEPER_ARCHIVE,
+                     batch_size: int = settings.SWEEPER_BATCH_SIZE,
+                     batch_pause: float = settings.SWEEPER_BATCH_PAUSE_SECONDS) -> dict[str, int]:
+    now = int(time.time())
+    created_before = now - unverified_max_age_days * 24 * 60 * 60
+    locked_before = now - settings.ONE_TIME_TOKEN_EXPIRE_MINUTES * 60
+    outbox_before = now - settings.EMAIL_OUTBOX_RETENTION_DAYS * 24 * 60 * 60
+
+    async def sweep_unverified():
+        async with session_factory() as db:
+            swept = await sweep_unverified_users(db, created_before, batch_size, archive)
+        await invalidate_cached_users(swept)
+        return len(swept)
+
+    async def clear_locks():
+        async with session_factory() as db:
+            cleared = await clear_expired_password_locks(db, locked_before, batch_size)
+        await invalidate_cached_users(cleared)
+        return len(cleared)
+
+    async def prune_outbox():
+        async with session_factory() as db:
+            return await prune_outbox_emails(db, outbox_before, batch_size)
+
+    result = {"unverified_users": await _sweep_batches(sweep_unverified, batch_size, batch_pause),
+              "password_locks": await _sweep_batches(clear_locks, batch_size, batch_pause),
+              "outbox_emails": await _sweep_batches(prune_outbox, batch_size, batch_pause)}
+    logger.info("Swept %d unverified users, %d expired password locks and %d old outbox emails",
+                result["unverified_users"], result["password_locks"], result["outbox_emails"])
+    return result
+
+
+async def run_sweeper(interval: float = settings.SWEEPER_INTERVAL_SECONDS, once: bool = False, **kwargs):
+    while True:
+        await sweep_once(**kwargs)
+        if once:
+            return
+        await asyncio.sleep(interval)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sweep unverified users and expired password locks")
+    parser.add_argument("--once", action="store_true", help="sweep once and exit")
+    parser.add_argument("--archive", action="store_true", default=settings.SWEEPER_ARCHIVE,
+                        help="copy swept users to archived_users before deleting them")
+    parser.add_argument("--interval", type=float, default=settings.SWEEPER_INTERVAL_SECONDS)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(run_sweeper(interval=args.interval, once=args.once, archive=args.archive))
@@ -1,23 +1,62 @@
+import asyncio
 import pytest
 from fastapi import HTTPException
 from fastapi.testclient import TestClient
 from main import app
-from sqlalchemy import create_engine
-from sqlalchemy.orm import Session
-from db_utils import get_db
-from database.auth_models import BaseUser, TourTrackerUser
-from database.crud import create_user, get_user_by_username, get_user_by_email, get_user_by_public_id
+from routes import introspection_cache
+from cache_utils import TTLCache
+from throttling import throttle_store, TokenBucketStore, SharedThrottleStore
+from state_store import StateStore, MemoryStateStore, SQLiteStateStore, state_store
+from sqlalchemy import create_engine, text, select, func
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import NullPool
+from db_utils import get_db, async_database_url, create_db_engine, create_async_db_engine, _engine_options
+from database.auth_models import Base, User, EmailOutbox, RefreshToken, RevokedToken, ArchivedUser
+from revocation import BloomFilter, RevocationStore, revocation_store, REVOCATION_CHANNEL
+from warmup import warm_up
+from import_report import parse_importtime, format_report
+from import_users import import_users
+from sweeper import sweep_once
+import server
+from server import worker_count, share_hashing_capacity, check_state_backend, DrainingServer, Supervisor
+from database.crud import create_user, get_user_by_username, get_user_by_email, get_user_by_public_id, \
+    get_user_by_username_async, create_user_async, user_cache
 from database.auth_schemas import UserCreate
 from utils import pwd_hasher
-from jwt_utilities import decode_jwt
+from hash_utils import password_hasher, AdmissionController
+from jwt_utilities import decode_jwt, verify_jwt, encode_jwt, get_signing_keys, get_jwks
+from jose import jwt, jwk
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa, ec
 from email_utils import VerificationEmail, PasswordResetEmail
 from config import settings
 from urllib.parse import urlparse, parse_qs
+from email_dispatcher import EmailDispatcher
+from email_outbox import drain_outbox
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import hashlib
+import json
+import os
+import signal
+import threading
+from types import SimpleNamespace
+import uvicorn
+import httpx
+from benchmark import run_benchmark, compare_to_baseline
+from metrics import Histogram, DB_QUERY_DURATION
+import io
+import logging
+from log_utils import JSONFormatter, RequestContextFilter, request_sampled_var, start_logging, stop_logging
+from argon2 import PasswordHasher, extract_parameters
+from calibrate_argon2 import Argon2Parameters, calibrate, write_env_file
 
 # Test database setup reference: https://dev.to/jbrocher/fastapi-testing-a-database-5ao5
 
 
 SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
+ASYNC_SQLALCHEMY_DATABASE_URL = "sqlite+aiosqlite:///./test.db"
 
 # settings.secret_key = 'test-jwt-secret'
 
@@ -39,26 +78,45 @@ def test_jwts():
 @pytest.fixture(scope="session")
 def db_engine():
     engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
-    TourTrackerUser.metadata.create_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
     yield engine
 
 
+# The app uses its own async session, so test data is committed and cleared after each test rather than
+# rolled back inside a shared connection
 @pytest.fixture(scope="function")
 def db(db_engine):
-    engine = db_engine
-    connection = engine.connect()
-    transaction = connection.begin()
-    db = Session(bind=connection)
+    db = Session(bind=db_engine)
     yield db
-    db.rollback()
-    connection.close()
+    db.close()
+    with db_engine.begin() as connection:
+        for table in reversed(Base.metadata.sorted_tables):
+            connection.execute(table.delete())
+    user_cache.clear()
+
+
+@pytest.fixture(scope="session")
+def async_session_factory():
+    # NullPool because every TestClient runs its own event loop
+    async_engine = create_async_engine(ASYNC_SQLALCHEMY_DATABASE_URL, poolclass=NullPool)
+    yield async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
 
 
 @pytest.fixture(scope="function")
-def client(db):
-    app.dependency_overrides[get_db] = lambda: db
+def client(db, db_engine, async_session_factory):
+    revocation_store.session_factory = sessionmaker(bind=db_engine)
+    revocation_store.async_session_factory = async_session_factory
+
+    async def override_get_db():
+        async with async_session_factory() as async_db:
+            yield async_db
+
+    app.dependency_overrides[get_db] = override_get_db
     with TestClient(app) as c:
         yield c
+    introspection_cache.clear()
+    throttle_store.clear()
+    revocation_store.clear()
 
 
 @pytest.fixture(scope="function")
@@ -156,11 +214,54 @@ def test_create_user(client, db):
     assert user_object.verified is False
 
 
+def test_async_crud(db, async_session_factory):
+    async def create_and_fetch():
+        async with async_session_factory() as async_db:
+            user = UserCreate(email='async@test.com', username='Async Test', password_hash='dummypasswordhash')
+            created = await create_user_async(async_db, user=user, service='tourtracker')
+            fetched = await get_user_by_username_async(async_db, 'Async Test', 'tourtracker')
+            return created, fetched
+
+    created, fetched = asyncio.run(create_and_fetch())
+    assert fetched is not None
+    assert fetched.public_id == created.public_id
+    assert get_user_by_username(db, 'Async Test', 'tourtracker').email == 'async@test.com'
+
+
+def test_async_create_user_conflict(db, seed_db, async_session_factory):
+    async def create(email, username):
+        async with async_session_factory() as async_db:
+            user = UserCreate(email=email, username=username, password_hash='dummypasswordhash')
+            return await create_user_async(async_db, user=user, service='tourtracker')
+
+    assert asyncio.run(create('verified@test.com', 'New Username')) is None
+    assert asyncio.run(create('new@test.com', 'Mr Verified')) is None
+    assert asyncio.run(create('new@test.com', 'New Username')).verified is False
+
+
 def test_authenticate_user(db, seed_db):
     user = get_user_by_email(db, 'verified@test.com', 'tourtracker')
     assert user.authenticate_user("testpassword") is True
 
 
+def test_authenticate_user_rehashes_outdated_hash(db, seed_db):
+    user = get_user_by_email(db, 'verified@test.com', 'tourtracker')
+    user.password_hash = PasswordHasher(time_cost=1, memory_cost=8192, parallelism=1).hash("testpassword")
+    assert user.authenticate_user("testpassword") is True
+    assert pwd_hasher.check_needs_rehash(user.password_hash) is False
+
+
+def test_auth_rehashes_outdated_hash(client, db, seed_db):
+    user = get_user_by_username(db, 'Mr Verified', 'tourtracker')
+    user.password_hash = PasswordHasher(time_cost=1, memory_cost=8192, parallelism=1).hash("testpassword")
+    db.commit()
+    response = client.post("/auth?service=tourtracker", data={"username": "Mr Verified", "password": "testpassword"})
+    assert response.status_code == 200
+    db.refresh(user)
+    assert extract_parameters(user.password_hash).memory_cost == settings.ARGON2_MEMORY_COST_KIB
+    assert pwd_hasher.verify(user.password_hash, "testpassword") is True
+
+
 def test_signup(client, db):
     response = client.post(
         "/signup?service=tourtracker",
@@ -172,6 +273,10 @@ def test_signup(client, db):
     user = get_user_by_username(db, 'Joe Bloggs', 'tourtracker')
     assert user is not None
     assert user.email == "test2@test.com"
+    outbox_email = db.query(EmailOutbox).filter(EmailOutbox.to_email == "test2@test.com").first()
+    assert outbox_email.subject == "Please verify your email address"
+    assert outbox_email.template_data['username'] == 'Joe Bloggs'
+    assert '/verify?token=' in outbox_email.template_data['token_url']
 
 
 def test_signup_email_already_exists(client, seed_db):
@@ -243,6 +348,8 @@ def test_auth(client, seed_db):
     )
     assert response.status_code == 200
     assert response.cookies.get('__Secure-fgp') is not None
+    payload = decode_jwt(response.json()['access_token'])
+    assert User.verify_user_fingerprint(response.cookies.get('__Secure-fgp'), payload['fgp_hash']) is True
     for cookie in response.cookies.jar:
         assert cookie.secure is True
         assert cookie.get_nonstandard_attr('SameSite') == 'strict'
@@ -276,18 +383,28 @@ def test_change_password_incorrect_old_password(client, db, seed_db):
 def test_verify_user(client, db, seed_db):
     user = get_user_by_email(db, 'nonverified@test.com', 'tourtracker')
     verification_email = VerificationEmail(user, 'tourtracker', 'http://127.0.0.1:8000', 'http://testserver')
-    email_subject, token_url = verification_email.send_email()
+    email_subject, token_url = verification_email.send_email(db)
     assert email_subject == "Please verify your email address"
     parsed_url = urlparse(token_url)
     query_strings = parse_qs(parsed_url[4])
     token = query_strings['token'][0]
     redirect_url = query_strings['redirect_url'][0]
     response = client.get(f"/verify?token={token}&redirect_url={redirect_url}", follow_redirects=False)
+    db.refresh(user)
     assert user.verified is True
     assert response.is_redirect is True
     assert response.status_code == 307
 
 
+def test_verify_rejects_access_tokens(client, db, seed_db):
+    user = get_user_by_email(db, 'nonverified@test.com', 'tourtracker')
+    access_token = encode_jwt({"sub": user.public_id}, 'tourtracker')
+    response = client.get(f"/verify?token={access_token}&redirect_url=http://testserver", follow_redirects=False)
+    assert response.status_code == 401
+    db.refresh(user)
+    assert user.verified is False
+
+
 
 
 def test_password_reset_request(client, db, seed_db):
@@ -295,6 +412,10 @@ def test_password_reset_request(client, db, seed_db):
                           data={'email': 'verified@test.com'})
     assert response.status_code == 200
     assert response.json() == {"detail": "Password reset link sent if user exists."}
+    outbox_email = db.query(EmailOutbox).filter(EmailOutbox.to_email == 'verified@test.com').first()
+    assert outbox_email.subject == "Password Reset Email"
+    assert outbox_email.status == "pending"
+    assert get_user_by_email(db, 'verified@test.com', 'tourtracker').password_locked is True
 
 
 def test_password_reset_one_time_token(db, seed_db):
@@ -317,12 +438,915 @@ def test_password_reset(client, db, seed_db):
                            data={'new_password': 'newpassword'})
     print(password_reset_url)
     assert response.status_code == 200
+    db.refresh(user)
     assert user.authenticate_user("newpassword") is True
 
 
 def test_generate_user_fingerprint():
-    user = BaseUser(email='test@test.com', username='test', password_hash='dummypasswordhash')
+    user = User(email='test@test.com', username='test', password_hash='dummypasswordhash')
     fingerprint, fingerprint_hash = user.generate_user_fingerprint()
-    assert user.pwd_hasher.verify(fingerprint_hash, fingerprint) is True
+    assert len(fingerprint_hash) == 64
+    assert User.verify_user_fingerprint(fingerprint, fingerprint_hash) is True
+    assert User.verify_user_fingerprint('wrongfingerprint', fingerprint_hash) is False
+
+
+def test_verify_user_fingerprint_argon2():
+    fingerprint = 'legacyfingerprint'
+    fingerprint_hash = pwd_hasher.hash(fingerprint)
+    assert User.verify_user_fingerprint(fingerprint, fingerprint_hash) is True
+    assert User.verify_user_fingerprint('wrongfingerprint', fingerprint_hash) is False
+
+
+def test_password_hash_executor():
+    password_hash = asyncio.run(password_hasher.hash("testpassword"))
+    assert pwd_hasher.verify(password_hash, "testpassword") is True
+    assert asyncio.run(password_hasher.verify(password_hash, "testpassword")) is True
+    assert asyncio.run(password_hasher.verify(password_hash, "wrongpassword")) is False
+
+
+def test_ttl_cache():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    cache.set('expired', 4, ttl=-1)
+    assert cache.get('expired') is None
+    stats = cache.stats()
+    assert stats['size'] == 2
+    assert stats['evictions'] == 1
+    assert stats['hits'] == 2
+
+
+def test_introspect(client, db, seed_db):
+    response = client.post("/auth?service=tourtracker",
+                           data={"username": "Mr Verified", "password": "testpassword"})
+    access_token = response.json()['access_token']
+    response = client.post("/introspect", data={"token": access_token})
+    assert response.status_code == 200
+    result = response.json()
+    assert result['active'] is True
+    assert result['verified'] is True
+    assert result['password_locked'] is False
+    assert result['service'] == 'tourtracker'
+    hits = introspection_cache.hits
+    response = client.post("/introspect", data={"token": access_token})
+    assert response.json() == result
+    assert introspection_cache.hits == hits + 1
+    assert client.get("/stats").json()['introspection_cache']['size'] == 1
+
+
+def test_introspect_sees_user_changes(client, db, seed_db):
+    access_token = login(client)['access_token']
+    assert client.post("/introspect", data={"token": access_token}).json()['password_locked'] is False
+    client.post('/resetpasswordrequest?service=tourtracker', data={'email': 'verified@test.com'})
+    assert client.post("/introspect", data={"token": access_token}).json()['password_locked'] is True
+
+
+def test_introspect_rejects_other_token_types(client, db, seed_db):
+    user = get_user_by_email(db, 'nonverified@test.com', 'tourtracker')
+    _, token_url = VerificationEmail(user, 'tourtracker', 'http://127.0.0.1:8000').send_email(db)
+    verification_token = parse_qs(urlparse(token_url).query)['token'][0]
+    assert client.post("/introspect", data={"token": verification_token}).json() == {"active": False}
+    # A token without an exp claim is cached for the default ttl instead of failing
+    no_exp_token = jwt.encode({"sub": user.public_id, "service": "tourtracker", "typ": "access"},
+                              get_signing_keys().signing_key, algorithm=settings.JWT_ALGORITHM)
+    assert client.post("/introspect", data={"token": no_exp_token}).json()['active'] is True
+    response = client.post("/introspect/batch", json={"tokens": [verification_token, no_exp_token]})
+    assert [result['active'] for result in response.json()['results']] == [False, True]
+
+
+def test_introspect_invalid_token(client, test_jwts):
+    for token in [test_jwts['expired_jwt'], test_jwts['modified_jwt'], 'notajwt']:
+        response = client.post("/introspect", data={"token": token})
+        assert response.status_code == 200
+        assert response.json() == {"active": False}
+
+
+def query_count(query: str) -> int:
+    counts, _ = DB_QUERY_DURATION._values.get(DB_QUERY_DURATION._key({"query": query}), ([], 0.0))
+    return sum(counts)
+
+
+def test_introspect_batch(client, db, seed_db, test_jwts):
+    queries = query_count("get_users_by_public_ids")
+    access_token = login(client)['access_token']
+    nonverified = get_user_by_email(db, 'nonverified@test.com', 'tourtracker')
+    nonverified_token = encode_jwt({"sub": nonverified.public_id}, 'tourtracker')
+    unknown_user_token = encode_jwt({"sub": "no such user"}, 'tourtracker')
+    tokens = [access_token, nonverified_token, test_jwts['expired_jwt'], unknown_user_token, 'notajwt']
+    response = client.post("/introspect/batch", json={"tokens": tokens})
+    assert response.status_code == 200
+    results = response.json()['results']
+    assert [result['active'] for result in results] == [True, True, False, False, False]
+    assert results[0]['verified'] is True
+    assert results[1]['verified'] is False
+    assert results[1]['sub'] == nonverified.public_id
+    assert query_count("get_users_by_public_ids") == queries + 1
+
+    # Served from the introspection cache, and the same results as the single token endpoint
+    response = client.post("/introspect/batch", json={"tokens": tokens[:2]})
+    assert response.json()['results'] == results[:2]
+    assert client.post("/introspect", data={"token": nonverified_token}).json() == results[1]
+    assert query_count("get_users_by_public_ids") == queries + 1
+
+    client.post("/revoke", data={"token": access_token})
+    assert client.post("/introspect/batch", json={"tokens": [access_token]}).json() == {"results": [{"active": False}]}
+    too_many = [access_token] * (settings.INTROSPECTION_BATCH_MAX_TOKENS + 1)
+    assert client.post("/introspect/batch", json={"tokens": too_many}).status_code == 422
+
+
+@pytest.fixture(scope="function", params=[("RS256", lambda: rsa.generate_private_key(65537, 2048)),
+                                          ("ES256", lambda: ec.generate_private_key(ec.SECP256R1()))])
+def asymmetric_signing(request, tmp_path, monkeypatch):
+    algorithm, generate_key = request.param
+    key_path = tmp_path / "signing_key.pem"
+    key_path.write_bytes(generate_key().private_bytes(serialization.Encoding.PEM,
+                                                      serialization.PrivateFormat.PKCS8,
+                                                      serialization.NoEncryption()))
+    monkeypatch.setattr(settings, "JWT_ALGORITHM", algorithm)
+    monkeypatch.setattr(settings, "JWT_PRIVATE_KEY_PATH", str(key_path))
+    get_signing_keys.cache_clear()
+    get_jwks.cache_clear()
+    yield algorithm
+    get_signing_keys.cache_clear()
+    get_jwks.cache_clear()
+
+
+def test_asymmetric_encode_decode_jwt(asymmetric_signing):
+    token = encode_jwt({"sub": "Mr Verified"}, "tourtracker")
+    header = jwt.get_unverified_header(token)
+    assert header['alg'] == asymmetric_signing
+    assert header['kid'] == get_signing_keys().kid
+    payload = decode_jwt(token)
+    assert payload['sub'] == 'Mr Verified'
+
+
+def test_jwks(client, asymmetric_signing):
+    response = client.get("/.well-known/jwks.json")
+    assert response.status_code == 200
+    assert "max-age" in response.headers["Cache-Control"]
+    keys = response.json()['keys']
+    assert len(keys) == 1
+    token = encode_jwt({"sub": "Mr Verified"}, "tourtracker")
+    assert keys[0]['kid'] == jwt.get_unverified_header(token)['kid']
+    public_key = jwk.construct(keys[0], asymmetric_signing)
+    assert jwt.decode(token, public_key.to_pem().decode(), algorithms=asymmetric_signing)['sub'] == 'Mr Verified'
+    response = client.get("/.well-known/jwks.json", headers={"If-None-Match": response.headers["ETag"]})
+    assert response.status_code == 304
+
+
+def test_jwks_symmetric(client):
+    response = client.get("/.well-known/jwks.json")
+    assert response.json() == {"keys": []}
+
+
+def test_password_reset_asymmetric(client, db, seed_db, asymmetric_signing):
+    user = get_user_by_email(db, "verified@test.com", "tourtracker")
+    password_reset_email = PasswordResetEmail(user, 'tourtracker')
+    response = client.post(password_reset_email.token_url, data={'new_password': 'newpassword'})
+    assert response.status_code == 200
+    db.refresh(user)
+    assert user.authenticate_user("newpassword") is True
+
+
+@pytest.fixture(scope="function")
+def sendgrid_stub():
+    # Local stand in for the SendGrid API, fails the first request to exercise the retry path
+    received = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            received.append((self.headers['Authorization'], body))
+            self.send_response(500 if len(received) == 1 else 202)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/v3/mail/send", received
+    server.shutdown()
+
+
+def test_drain_outbox(db, sendgrid_stub, async_session_factory):
+    api_url, received = sendgrid_stub
+    now = int(time.time())
+    db.add_all([
+        EmailOutbox(to_email='pending@test.com', subject='Subject', template_id='template-1',
+                    template_data={'token_url': 'url'}, status='pending', attempts=0, created_at=now),
+        EmailOutbox(to_email='stale@test.com', subject='Subject', template_id='template-1',
+                    template_data={'token_url': 'url'}, status='sending', attempts=1, created_at=now,
+                    claimed_at=now - 3600),
+        EmailOutbox(to_email='claimed@test.com', subject='Subject', template_id='template-1',
+                    template_data={'token_url': 'url'}, status='sending', attempts=1, created_at=now,
+                    claimed_at=now)
+    ])
+    db.commit()
+    dispatcher = EmailDispatcher('test-api-key', 'sender@test.com', api_url=api_url, retry_backoff=0.01)
+    asyncio.run(drain_outbox(async_session_factory, dispatcher, lease_seconds=60, dry_run=False, once=True))
+    statuses = {email.to_email: email.status for email in db.query(EmailOutbox).all()}
+    assert statuses == {'pending@test.com': 'sent', 'stale@test.com': 'sent', 'claimed@test.com': 'sending'}
+    # Sent emails no longer hold their token links
+    template_data = {email.to_email: email.template_data for email in db.query(EmailOutbox).all()}
+    assert template_data == {'pending@test.com': None, 'stale@test.com': None, 'claimed@test.com': {'token_url': 'url'}}
+    recipients = [p['to'][0]['email'] for p in received[-1][1]['personalizations']]
+    assert sorted(recipients) == ['pending@test.com', 'stale@test.com']
+
+
+def test_drain_outbox_isolates_rejected_recipient(db, async_session_factory):
+    received = []
+
+    class Handler(BaseHTTPRequestHandler):
+        # Rejects the whole request, as SendGrid does, if any recipient is invalid
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            recipients = [p['to'][0]['email'] for p in body['personalizations']]
+            received.append(recipients)
+            self.send_response(400 if 'bad@test.com' in recipients else 202)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    now = int(time.time())
+    recipients = ['one@test.com', 'two@test.com', 'bad@test.com', 'three@test.com', 'four@test.com']
+    db.add_all([EmailOutbox(to_email=recipient, subject='Subject', template_id='template-1', template_data={},
+                            status='pending', attempts=0, created_at=now) for recipient in recipients])
+    db.commit()
+    dispatcher = EmailDispatcher('test-api-key', 'sender@test.com',
+                                 api_url=f"http://127.0.0.1:{server.server_address[1]}/v3/mail/send")
+    try:
+        asyncio.run(drain_outbox(async_session_factory, dispatcher, dry_run=False, once=True))
+    finally:
+        server.shutdown()
+    statuses = {email.to_email: email.status for email in db.query(EmailOutbox).all()}
+    assert statuses.pop('bad@test.com') != 'sent'
+    assert set(statuses.values()) == {'sent'}
+    # Every good recipient was sent exactly once
+    delivered = [recipient for request in received if 'bad@test.com' not in request for recipient in request]
+    assert sorted(delivered) == sorted(statuses)
+
+
+def test_drain_outbox_does_not_split_unauthorised_batches(db, async_session_factory):
+    received = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            received.append(json.loads(self.rfile.read(int(self.headers['Content-Length']))))
+            self.send_response(401)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    now = int(time.time())
+    db.add_all([EmailOutbox(to_email=f'user{i}@test.com', subject='Subject', template_id='template-1',
+                            template_data={}, status='pending', attempts=0, created_at=now) for i in range(8)])
+    db.commit()
+    dispatcher = EmailDispatcher('bad-api-key', 'sender@test.com',
+                                 api_url=f"http://127.0.0.1:{server.server_address[1]}/v3/mail/send")
+    try:
+        asyncio.run(drain_outbox(async_session_factory, dispatcher, dry_run=False, once=True))
+    finally:
+        server.shutdown()
+    assert len(received) == 1
+    assert {email.status for email in db.query(EmailOutbox).all()} == {'pending'}
+
+
+def test_outbox_stats(client, db, seed_db):
+    client.post('/resetpasswordrequest?service=tourtracker', data={'email': 'verified@test.com'})
+    assert client.get("/stats").json()['email_outbox'] == {"pending": 1, "sending": 0, "failed": 0}
 
 
+def test_users_are_scoped_by_service(db, seed_db):
+    user = UserCreate(email="verified@test.com", username="Mr Verified", password_hash="dummypasswordhash")
+    arcade_user = create_user(db, user, 'arcade')
+    assert get_user_by_username(db, 'Mr Verified', 'arcade').id == arcade_user.id
+    assert get_user_by_username(db, 'Mr Verified', 'tourtracker').id != arcade_user.id
+    assert get_user_by_public_id(db, arcade_user.public_id, 'tourtracker') is None
+
+
+def test_unknown_service(client):
+    response = client.post(
+        "/signup?service=unknown",
+        data={"email": "test2@test.com",
+              "username": "Joe Bloggs",
+              "password": "testpassword123"}
+    )
+    assert response.status_code == 404
+    assert response.json() == {"detail": "Unknown service"}
+
+
+def test_user_cache(client, db, seed_db):
+    login = {"username": "Mr Verified", "password": "testpassword"}
+    assert client.post("/auth?service=tourtracker", data=login).status_code == 200
+    hits = user_cache.hits
+    assert client.post("/auth?service=tourtracker", data=login).status_code == 200
+    assert user_cache.hits == hits + 1
+    response = client.post(
+        "/changepassword?service=tourtracker&username=Mr%20Verified",
+        data={"old_password": "testpassword", "new_password": "newpassword"}
+    )
+    assert response.status_code == 200
+    assert client.post("/auth?service=tourtracker", data=login).status_code == 401
+    assert client.post("/auth?service=tourtracker",
+                       data={"username": "Mr Verified", "password": "newpassword"}).status_code == 200
+    assert client.get("/stats").json()['user_cache']['hits'] == user_cache.hits
+
+
+def test_user_cache_invalidated_on_verify(client, db, seed_db):
+    login = {"username": "Mrs NonVerified", "password": "testpassword"}
+    assert client.post("/auth?service=tourtracker", data=login).status_code == 403
+    user = get_user_by_email(db, 'nonverified@test.com', 'tourtracker')
+    _, token_url = VerificationEmail(user, 'tourtracker', 'http://127.0.0.1:8000', 'http://testserver').send_email(db)
+    token = parse_qs(urlparse(token_url).query)['token'][0]
+    client.get(f"/verify?token={token}&redirect_url=http://testserver", follow_redirects=False)
+    assert client.post("/auth?service=tourtracker", data=login).status_code == 200
+
+
+def test_token_bucket_store():
+    store = TokenBucketStore(shards=2, max_keys_per_shard=1)
+    take = lambda key, capacity: asyncio.run(store.take(key, capacity=capacity, refill_per_second=1))
+    assert take('a', 2) == 0
+    assert take('a', 2) == 0
+    assert take('a', 2) > 0
+    for key in range(10):
+        take(key, 1)
+    assert sum(len(buckets) for _, buckets in store._shards) <= 2
+
+
+def test_auth_throttled(client, seed_db, monkeypatch):
+    monkeypatch.setattr(settings, "THROTTLE_IDENTITY_CAPACITY", 2)
+    for _ in range(2):
+        response = client.post("/auth?service=tourtracker",
+                               data={"username": "Mr Verified", "password": "wrong password"})
+        assert response.status_code == 401
+    response = client.post("/auth?service=tourtracker",
+                           data={"username": "MR VERIFIED", "password": "testpassword"})
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) > 0
+    response = client.post("/auth?service=tourtracker",
+                           data={"username": "Lady Locked", "password": "testpassword"})
+    assert response.status_code == 403
+
+
+def test_throttle_without_client_address(client, seed_db):
+    async def login_without_client():
+        transport = httpx.ASGITransport(app=app, client=None)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as no_client:
+            return await no_client.post("/auth?service=tourtracker",
+                                        data={"username": "Mr Verified", "password": "wrong password"})
+
+    assert asyncio.run(login_without_client()).status_code == 401
+
+
+def test_password_reset_request_throttled(client, seed_db, monkeypatch):
+    monkeypatch.setattr(settings, "THROTTLE_IP_CAPACITY", 1)
+    response = client.post('/resetpasswordrequest?service=tourtracker', data={'email': 'verified@test.com'})
+    assert response.status_code == 200
+    response = client.post('/resetpasswordrequest?service=tourtracker', data={'email': 'other@test.com'})
+    assert response.status_code == 429
+
+
+def test_admission_controller():
+    async def exercise():
+        admission = AdmissionController(memory_budget_kib=100, max_concurrency=2, max_queue=1, max_queue_wait=0.05)
+        await admission.acquire(60)
+        # Over the memory budget, so this one queues until the first call releases
+        queued = asyncio.create_task(admission.acquire(60))
+        await asyncio.sleep(0)
+        assert admission.queue_depth == 1
+        with pytest.raises(HTTPException) as e:
+            await admission.acquire(10)
+        assert e.value.status_code == 503
+        admission.release(60)
+        await queued
+        assert admission.in_flight == 1
+        with pytest.raises(HTTPException):
+            await admission.acquire(60)
+        return admission.stats()
+
+    stats = asyncio.run(exercise())
+    assert stats['shed'] == 2
+    assert stats['admitted'] == 2
+    assert stats['queue_depth'] == 0
+    assert stats['memory_in_use_kib'] == 60
+
+
+def test_admission_controller_cancelled_waiters():
+    async def exercise():
+        admission = AdmissionController(memory_budget_kib=100, max_concurrency=1, max_queue=1, max_queue_wait=5)
+        await admission.acquire(60)
+        # A waiter cancelled while queued, e.g. by a client disconnect, gives its queue slot back
+        queued = asyncio.create_task(admission.acquire(60))
+        await asyncio.sleep(0)
+        queued.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await queued
+        assert admission.queue_depth == 0
+        # One cancelled just after being admitted either returns admitted, holding the slot, or gives it back
+        queued = asyncio.create_task(admission.acquire(60))
+        await asyncio.sleep(0)
+        admission.release(60)
+        assert admission.in_flight == 1
+        queued.cancel()
+        try:
+            await queued
+            admitted = True
+        except asyncio.CancelledError:
+            admitted = False
+        assert admission.in_flight == int(admitted)
+        return admission.stats()
+
+    stats = asyncio.run(exercise())
+    assert (stats['queue_depth'], stats['shed']) == (0, 0)
+
+
+def test_benchmark(client, db_engine, monkeypatch):
+    monkeypatch.setattr(settings, "THROTTLE_ENABLED", False)
+
+    async def benchmark():
+        async with httpx.AsyncClient(app=app, base_url="http://bench.test") as bench_client:
+            return await run_benchmark(bench_client, sessionmaker(bind=db_engine), total_requests=12,
+                                       concurrency=2, user_count=2)
+
+    results = asyncio.run(benchmark())
+    assert results['overall']['requests'] == 12
+    with Session(bind=db_engine) as db:
+        assert db.query(User).filter(User.username.startswith("bench-")).count() == 0
+    for operation, endpoint in results['endpoints'].items():
+        assert set(endpoint['statuses']) <= {200, 201, 307}, operation
+        assert endpoint['p50_ms'] <= endpoint['p95_ms'] <= endpoint['p99_ms']
+    assert compare_to_baseline(results, results, 0.1) == []
+    slower = json.loads(json.dumps(results))
+    slower['overall']['p95_ms'] = results['overall']['p95_ms'] * 2
+    assert compare_to_baseline(slower, results, 0.1) != []
+
+
+
+def test_histogram_render():
+    histogram = Histogram('test_duration_seconds', 'Test histogram', ('operation',), buckets=(0.1, 1.0))
+    histogram.observe(0.05, operation='hash')
+    histogram.observe(0.5, operation='hash')
+    histogram.observe(5, operation='hash')
+    lines = histogram.render().splitlines()
+    assert '# TYPE test_duration_seconds histogram' in lines
+    assert 'test_duration_seconds_bucket{operation="hash",le="0.1"} 1' in lines
+    assert 'test_duration_seconds_bucket{operation="hash",le="1.0"} 2' in lines
+    assert 'test_duration_seconds_bucket{operation="hash",le="+Inf"} 3' in lines
+    assert 'test_duration_seconds_count{operation="hash"} 3' in lines
+
+
+def test_metrics(client, seed_db):
+    client.post("/auth?service=tourtracker", data={"username": "Mr Verified", "password": "testpassword"})
+    client.post('/resetpasswordrequest?service=tourtracker', data={'email': 'verified@test.com'})
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/plain')
+    body = response.text
+    assert 'http_requests_total{method="POST",route="/auth",status="200"}' in body
+    assert 'http_request_duration_seconds_count{method="POST",route="/auth"}' in body
+    assert 'argon2_duration_seconds_count{operation="verify"}' in body
+    assert 'jwt_duration_seconds_count{operation="encode"}' in body
+    assert 'db_query_duration_seconds_count{query="get_user_by_username"}' in body
+    assert 'email_backlog{queue="outbox_pending"} 1' in body
+    assert 'cache_size{cache="user"}' in body
+    assert '# TYPE cache_hits_total counter' in body
+    assert 'cache_misses_total{cache="user"}' in body
+    assert 'cache_evictions_total{cache="introspection"}' in body
+    assert 'hashing_admission{state="in_flight"} 0' in body
+
+
+def test_calibrate_argon2(tmp_path):
+    def measure(parameters):
+        return parameters.time_cost * parameters.memory_cost_kib / 1024 * 0.001
+
+    # 64 MiB per pass is 64ms, so memory stays at 64 MiB and three passes fit in 200ms
+    assert calibrate(measure, 0.2, 65536, 2) == Argon2Parameters(3, 65536, 2)
+    # A single 256 MiB pass is too slow, so memory halves to 128 MiB first
+    assert calibrate(measure, 0.2, 262144, 2) == Argon2Parameters(1, 131072, 2)
+    assert calibrate(measure, 0.001, 65536, 1, min_memory_cost_kib=19456) == Argon2Parameters(1, 32768, 1)
+
+    env_file = tmp_path / ".env"
+    env_file.write_text("SECRET_KEY=abc\nARGON2_TIME_COST=9\n")
+    write_env_file(str(env_file), Argon2Parameters(2, 32768, 1))
+    assert env_file.read_text().splitlines() == ["SECRET_KEY=abc", "ARGON2_TIME_COST=2",
+                                                 "ARGON2_MEMORY_COST_KIB=32768", "ARGON2_PARALLELISM=1"]
+
+
+def test_async_database_url():
+    assert async_database_url("sqlite:///./database/database.db") == "sqlite+aiosqlite:///./database/database.db"
+    assert async_database_url("postgresql://auth:secret@db/auth") == "postgresql+asyncpg://auth:secret@db/auth"
+    assert async_database_url("postgresql+psycopg2://auth@db/auth") == "postgresql+asyncpg://auth@db/auth"
+    assert async_database_url("postgresql+asyncpg://auth@db/auth") == "postgresql+asyncpg://auth@db/auth"
+
+
+def test_engine_options():
+    assert "pool_pre_ping" not in _engine_options("sqlite:///./database/database.db")
+    assert _engine_options("sqlite://") == {}
+    assert _engine_options("postgresql+asyncpg://auth@db/auth")["pool_pre_ping"] == settings.DATABASE_POOL_PRE_PING
+
+
+def test_sqlite_pragmas(tmp_path):
+    url = f"sqlite:///{tmp_path / 'pragmas.db'}"
+    engine = create_db_engine(url)
+    with engine.connect() as connection:
+        assert connection.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+        assert connection.execute(text("PRAGMA synchronous")).scalar() == 1
+        assert connection.execute(text("PRAGMA busy_timeout")).scalar() == settings.SQLITE_BUSY_TIMEOUT_MS
+    engine.dispose()
+
+    async def async_pragmas():
+        async_engine = create_async_db_engine(url)
+        async with async_engine.connect() as connection:
+            busy_timeout = (await connection.execute(text("PRAGMA busy_timeout"))).scalar()
+        await async_engine.dispose()
+        return busy_timeout
+
+    assert asyncio.run(async_pragmas()) == settings.SQLITE_BUSY_TIMEOUT_MS
+
+
+def login(client, username="Mr Verified", password="testpassword"):
+    response = client.post("/auth?service=tourtracker", data={"username": username, "password": password})
+    assert response.status_code == 200
+    return response.json()
+
+
+def test_refresh_token_rotation(client, db, seed_db):
+    tokens = login(client)
+    response = client.post("/refresh?service=tourtracker", data={"refresh_token": tokens['refresh_token']})
+    assert response.status_code == 200
+    assert response.cookies.get('__Secure-fgp') is not None
+    refreshed = response.json()
+    assert refreshed['refresh_token'] != tokens['refresh_token']
+    assert decode_jwt(refreshed['access_token'])['sub'] == decode_jwt(tokens['access_token'])['sub']
+    stored = db.scalars(select(RefreshToken)).all()
+    assert len({token.family_id for token in stored}) == 1
+    assert tokens['refresh_token'] not in {token.token_hash for token in stored}
+    response = client.post("/refresh?service=arcade", data={"refresh_token": refreshed['refresh_token']})
+    assert response.status_code == 401
+
+
+def test_refresh_token_reuse_revokes_family(client, db, seed_db):
+    tokens = login(client)
+    refreshed = client.post("/refresh?service=tourtracker", data={"refresh_token": tokens['refresh_token']}).json()
+    response = client.post("/refresh?service=tourtracker", data={"refresh_token": tokens['refresh_token']})
+    assert response.status_code == 401
+    response = client.post("/refresh?service=tourtracker", data={"refresh_token": refreshed['refresh_token']})
+    assert response.status_code == 401
+    assert all(token.revoked for token in db.scalars(select(RefreshToken)))
+
+
+def test_refresh_token_revoked_by_password_reset_request(client, seed_db):
+    tokens = login(client)
+    client.post('/resetpasswordrequest?service=tourtracker', data={'email': 'verified@test.com'})
+    response = client.post("/refresh?service=tourtracker", data={"refresh_token": tokens['refresh_token']})
+    assert response.status_code == 401
+    response = client.post("/refresh?service=tourtracker", data={"refresh_token": "notarefreshtoken"})
+    assert response.status_code == 401
+
+
+def test_bloom_filter():
+    bloom = BloomFilter(1000, 0.01)
+    for i in range(1000):
+        bloom.add(f"revoked-{i}")
+    assert all(f"revoked-{i}" in bloom for i in range(1000))
+    false_positives = sum(f"other-{i}" in bloom for i in range(10000))
+    assert false_positives < 300
+
+
+def test_revoke_token(client, db, db_engine, async_session_factory, seed_db):
+    access_token = login(client)['access_token']
+    jti = decode_jwt(access_token)['jti']
+    assert client.post("/introspect", data={"token": access_token}).json()['active'] is True
+    response = client.post("/revoke", data={"token": access_token})
+    assert response.status_code == 200
+    assert client.post("/introspect", data={"token": access_token}).json() == {"active": False}
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(verify_jwt(access_token))
+    assert e.value.status_code == 401
+    assert client.post("/revoke", data={"token": access_token}).status_code == 200
+    assert client.post("/revoke", data={"token": "notajwt"}).status_code == 400
+
+    # Another process only learns about the revocation from the table
+    store = RevocationStore(sessionmaker(bind=db_engine), async_session_factory, capacity=100, error_rate=0.01)
+    assert asyncio.run(store.is_revoked(jti)) is False
+    store.refresh()
+    assert asyncio.run(store.is_revoked(jti)) is True
+    assert asyncio.run(store.is_revoked(decode_jwt(login(client)['access_token'])['jti'])) is False
+
+
+def test_revocation_published_by_another_worker(client, seed_db):
+    access_token = login(client)['access_token']
+    claims = decode_jwt(access_token)
+    assert client.post("/introspect", data={"token": access_token}).json()['active'] is True
+    assert introspection_cache.stats()['size'] == 1
+    # What run_state_subscriptions delivers when another worker handles the /revoke
+    state_store._deliver(REVOCATION_CHANNEL, {"jti": claims['jti'], "expires_at": claims['exp'],
+                                              "token_digest": hashlib.sha256(access_token.encode()).hexdigest()})
+    assert introspection_cache.stats()['size'] == 0
+    assert client.post("/introspect", data={"token": access_token}).json() == {"active": False}
+
+
+def test_revoke_refuses_forged_tokens(client, db, seed_db):
+    access_token = login(client)['access_token']
+    claims = decode_jwt(access_token)
+    forged = jwt.encode({**claims, "exp": claims['exp'] + 10 ** 9}, "attacker-key", algorithm=settings.JWT_ALGORITHM)
+    response = client.post("/revoke", data={"token": forged})
+    assert response.status_code == 400
+    assert db.scalar(select(RevokedToken).where(RevokedToken.jti == claims['jti'])) is None
+    assert client.post("/introspect", data={"token": access_token}).json()['active'] is True
+
+    # Even a genuine token can't revoke its jti for longer than any token lives
+    client.post("/revoke", data={"token": access_token})
+    revoked = db.scalar(select(RevokedToken).where(RevokedToken.jti == claims['jti']))
+    assert revoked.expires_at <= time.time() + max(settings.ACCESS_TOKEN_EXPIRE_MINUTES,
+                                                   settings.ONE_TIME_TOKEN_EXPIRE_MINUTES) * 60
+
+
+def test_revocation_negative_cache(db, db_engine, async_session_factory):
+    store = RevocationStore(sessionmaker(bind=db_engine), async_session_factory, capacity=100, error_rate=0.01)
+    # A jti in the filter but not the table, as for a Bloom filter false positive
+    store.bloom.add("not-revoked")
+    assert asyncio.run(store.is_revoked("not-revoked")) is False
+    assert asyncio.run(store.is_revoked("not-revoked")) is False
+    assert store.db_checks == 1
+    store.add("not-revoked", time.time() + 60)
+    assert asyncio.run(store.is_revoked("not-revoked")) is True
+
+
+def test_revocation_rebuild_prunes_expired(db, db_engine, async_session_factory):
+    db.add_all([RevokedToken(jti="expired", expires_at=int(time.time()) - 10),
+                RevokedToken(jti="live", expires_at=int(time.time()) + 600)])
+    db.commit()
+    store = RevocationStore(sessionmaker(bind=db_engine), async_session_factory, capacity=100, error_rate=0.01)
+    store.rebuild()
+    assert [token.jti for token in db.scalars(select(RevokedToken))] == ["live"]
+    assert asyncio.run(store.is_revoked("live")) is True
+    assert asyncio.run(store.is_revoked("expired")) is False
+    assert store.bloom.count == 1
+
+
+def test_warm_up(db, async_session_factory):
+    async def get_test_db():
+        async with async_session_factory() as async_db:
+            yield async_db
+
+    timings = asyncio.run(warm_up(get_test_db))
+    assert set(timings) == {"configure_mappers", "queries", "jwt", "argon2"}
+    assert user_cache.stats()["size"] == 0
+
+
+def test_import_report():
+    imports = parse_importtime("""import time: self [us] | cumulative | imported package
+import time:       120 |        120 |     jose.jwt
+import time:       300 |        420 |   jwt_utilities
+import time:       500 |       2000 | main
+""")
+    assert [(i.module, i.depth) for i in imports] == [("jose.jwt", 2), ("jwt_utilities", 1), ("main", 0)]
+    report = format_report(imports, "main", top=5)
+    assert report.startswith("import main: 2.0ms")
+    assert "jwt_utilities" in report
+
+
+def test_import_users(db, db_engine, tmp_path):
+    existing_hash = PasswordHasher(time_cost=1, memory_cost=8192, parallelism=1).hash("imported")
+    import_path = tmp_path / "users.csv"
+    import_path.write_text("email,username,password,password_hash,verified\n"
+                           "one@test.com,one,secret-one,,true\n"
+                           f'two@test.com,two,,"{existing_hash}",\n'
+                           f"unquoted@test.com,unquoted,,{existing_hash},\n"
+                           "one@test.com,duplicate,secret-dup,,\n"
+                           "no-username@test.com,,secret,,\n"
+                           "three@test.com,three,,not-a-hash,\n")
+    stats = import_users(str(import_path), "tourtracker", sessionmaker(bind=db_engine), batch_size=2, workers=2)
+    assert (stats.inserted, stats.rejected, stats.last_line) == (2, 4, 7)
+    one = get_user_by_username(db, "one", "tourtracker")
+    assert one.verified is True
+    assert pwd_hasher.verify(one.password_hash, "secret-one") is True
+    assert get_user_by_username(db, "two", "tourtracker").password_hash == existing_hash
+    rejects = [json.loads(line) for line in (tmp_path / "users.csv.rejects.jsonl").read_text().splitlines()]
+    assert [reject["line"] for reject in rejects] == [4, 5, 6, 7]
+    assert all("password" not in reject["record"] for reject in rejects)
+
+    # A rerun resumes after the checkpoint, so only the new record is imported
+    with import_path.open("a") as import_file:
+        import_file.write("four@test.com,four,secret-four,,\n")
+    stats = import_users(str(import_path), "tourtracker", sessionmaker(bind=db_engine), batch_size=2, workers=2)
+    assert (stats.inserted, stats.rejected, stats.last_line) == (3, 4, 8)
+    assert db.scalar(select(func.count()).select_from(User)) == 3
+
+
+def test_import_users_rejects_non_string_fields(db, db_engine, tmp_path):
+    import_path = tmp_path / "users.jsonl"
+    records = [{"email": 5, "username": "number", "password": "secret"},
+               {"email": ["list@test.com"], "username": "list", "password": "secret"},
+               {"email": "name@test.com", "username": 7, "password": "secret"},
+               {"email": "password@test.com", "username": "password", "password": 12345},
+               {"email": "ok@test.com", "username": "ok", "password": "secret"}]
+    import_path.write_text("".join(json.dumps(record) + "\n" for record in records))
+    stats = import_users(str(import_path), "tourtracker", sessionmaker(bind=db_engine), batch_size=10, workers=1)
+    assert (stats.inserted, stats.rejected) == (1, 4)
+    assert get_user_by_username(db, "ok", "tourtracker") is not None
+
+
+@pytest.mark.parametrize("archive", [False, True])
+def test_sweeper(db, seed_db, async_session_factory, archive):
+    now = int(time.time())
+    stale = create_user(db, UserCreate(email="stale@test.com", username="stale", password_hash="x"), 'tourtracker')
+    stale.created_at = now - 8 * 24 * 60 * 60
+    expired_lock = get_user_by_username(db, 'Lady Locked', 'tourtracker')
+    expired_lock.password_locked_at = now - (settings.ONE_TIME_TOKEN_EXPIRE_MINUTES + 1) * 60
+    fresh_lock = create_user(db, UserCreate(email="fresh@test.com", username="fresh", password_hash="x"), 'tourtracker')
+    fresh_lock.verified, fresh_lock.password_locked, fresh_lock.password_locked_at = True, True, now
+    old = now - (settings.EMAIL_OUTBOX_RETENTION_DAYS + 1) * 24 * 60 * 60
+    db.add_all([EmailOutbox(to_email='old@test.com', status='sent', created_at=old),
+                EmailOutbox(to_email='old-pending@test.com', status='pending', created_at=old),
+                EmailOutbox(to_email='recent@test.com', status='failed', created_at=now)])
+    db.commit()
+    for user in (stale, expired_lock):
+        user_cache.set(('tourtracker', 'public_id', user.public_id), {'username': user.username})
+
+    result = asyncio.run(sweep_once(async_session_factory, archive=archive, batch_size=1, batch_pause=0))
+    assert result == {"unverified_users": 1, "password_locks": 1, "outbox_emails": 1}
+    assert user_cache.get(('tourtracker', 'public_id', stale.public_id)) is None
+    assert user_cache.get(('tourtracker', 'public_id', expired_lock.public_id)) is None
+    db.expire_all()
+    assert get_user_by_username(db, 'stale', 'tourtracker') is None
+    assert get_user_by_email(db, 'nonverified@test.com', 'tourtracker') is not None
+    assert get_user_by_username(db, 'Lady Locked', 'tourtracker').password_locked is False
+    assert get_user_by_username(db, 'fresh', 'tourtracker').password_locked is True
+    archived = db.scalars(select(ArchivedUser)).all()
+    assert [user.username for user in archived] == (["stale"] if archive else [])
+    assert sorted(email.to_email for email in db.scalars(select(EmailOutbox))) == ['old-pending@test.com',
+                                                                                   'recent@test.com']
+
+
+def test_structured_logging(client, seed_db):
+    output = io.StringIO()
+    stop_logging()
+    start_logging(output)
+    response = client.post('/resetpasswordrequest?service=tourtracker', data={'email': 'verified@test.com'},
+                           headers={'X-Request-ID': 'req-123'})
+    assert response.headers['x-request-id'] == 'req-123'
+    assert len(client.get('/stats').headers['x-request-id']) == 32
+    stop_logging()
+
+    lines = [json.loads(line) for line in output.getvalue().splitlines()]
+    request_lines = [line for line in lines if line['request_id'] == 'req-123']
+    assert {line['logger'] for line in request_lines} >= {'email_utils', 'routes', 'access'}
+    access = next(line for line in request_lines if line['logger'] == 'access')
+    assert (access['path'], access['status']) == ('/resetpasswordrequest', 200)
+    email_line = next(line for line in request_lines if line['logger'] == 'email_utils')
+    assert 'token=[REDACTED]' in email_line['message']
+    assert 'eyJ' not in output.getvalue()
+
+
+def test_log_redaction_and_sampling():
+    record = logging.LogRecord("routes", logging.INFO, __file__, 1, "Bearer %s", ("eyJhbGciOi.eyJzdWIi.c2ln",), None)
+    record.refresh_token = "secret"
+    entry = json.loads(JSONFormatter().format(record))
+    assert entry['message'] == "Bearer [REDACTED_JWT]"
+    assert entry['refresh_token'] == "[REDACTED]"
+
+    context_filter = RequestContextFilter()
+    token = request_sampled_var.set(False)
+    try:
+        assert not context_filter.filter(record)
+        record.levelno = logging.ERROR
+        assert context_filter.filter(record)
+    finally:
+        request_sampled_var.reset(token)
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def state_store_backend(request, tmp_path):
+    return MemoryStateStore() if request.param == "memory" else SQLiteStateStore(str(tmp_path / "state.db"))
+
+
+def test_state_store(state_store_backend):
+    async def exercise(store):
+        await store.set("user", {"id": 1})
+        assert await store.get("user") == {"id": 1}
+        await store.delete("user")
+        assert await store.get("user", "missing") == "missing"
+        await store.set("short", "lived", ttl=-1)
+        assert await store.get("short") is None
+
+        assert await store.incr("count") == 1
+        assert await store.incr("count", 5) == 6
+        assert await store.incr("expired", ttl=-1) == 1
+        # An expired counter starts again rather than adding to the old value
+        assert await store.incr("expired", ttl=60) == 1
+        assert await store.incr("expired") == 2
+
+        throttle = SharedThrottleStore(store)
+        assert await throttle.take(("ip", "1.2.3.4"), capacity=2, refill_per_second=0.01) == 0
+        assert await throttle.take(("ip", "1.2.3.4"), capacity=2, refill_per_second=0.01) == 0
+        assert 0 < await throttle.take(("ip", "1.2.3.4"), capacity=2, refill_per_second=0.01) <= 200
+
+    asyncio.run(exercise(state_store_backend))
+
+
+def test_state_store_is_abstract():
+    with pytest.raises(TypeError):
+        StateStore()
+
+
+def test_sqlite_state_store_shared_between_workers(tmp_path):
+    path = str(tmp_path / "state.db")
+    workers = [SQLiteStateStore(path) for _ in range(2)]
+
+    # Each worker's increments run on the default executor's threads, so they race both within and across workers
+    async def increment():
+        await asyncio.gather(*(store.incr("requests") for store in workers for _ in range(400)))
+        return await workers[0].get("requests")
+
+    assert asyncio.run(increment()) == 800
+
+    received = []
+    workers[1].subscribe("user_cache", received.append)
+    workers[0].subscribe("user_cache", received.append)
+    asyncio.run(workers[0].publish("user_cache", [["tourtracker", "username", "Mr Verified"]]))
+    # The publisher never receives its own message
+    assert workers[0].poll() == 0
+    assert workers[1].poll() == 1
+    assert received == [[["tourtracker", "username", "Mr Verified"]]]
+    assert workers[1].poll() == 0
+    # A worker that starts later only receives messages published after it started
+    assert SQLiteStateStore(path).poll() == 0
+
+
+def test_ready(client):
+    assert client.get("/ready").json() == {"detail": "ready"}
+    app.state.ready = False
+    try:
+        assert client.get("/ready").status_code == 503
+    finally:
+        app.state.ready = True
+
+
+def test_server_sizing(monkeypatch):
+    monkeypatch.setattr(settings, "SERVER_WORKERS", 0)
+    monkeypatch.setattr(settings, "HASHING_MEMORY_BUDGET_MIB", 512)
+    monkeypatch.setattr(settings, "SERVER_WORKER_MEMORY_MIB", 128)
+    assert worker_count(cores=8, memory_budget_mib=16384) == 8
+    # 2 GiB only fits three workers that each hash with up to 512 MiB
+    assert worker_count(cores=8, memory_budget_mib=2048) == 3
+    assert worker_count(cores=8, memory_budget_mib=256) == 1
+    monkeypatch.setattr(settings, "SERVER_WORKERS", 5)
+    assert worker_count(cores=8, memory_budget_mib=256) == 5
+
+    monkeypatch.setattr(settings, "HASHING_WORKERS", 8)
+    monkeypatch.setattr(settings, "HASHING_MAX_CONCURRENCY", 2)
+    share_hashing_capacity(3, cores=8)
+    assert (settings.HASHING_WORKERS, settings.HASHING_MAX_CONCURRENCY) == (3, 2)
+
+
+def test_server_drains_before_shutting_down():
+    drained_app = SimpleNamespace(state=SimpleNamespace(ready=True))
+    server = DrainingServer(uvicorn.Config(drained_app), drained_app, drain_seconds=0.05)
+
+    async def terminate():
+        server.handle_exit(signal.SIGTERM, None)
+        # Still serving, but the load balancer now sees 503 from /ready
+        assert (drained_app.state.ready, server.should_exit) == (False, False)
+        await asyncio.sleep(0.1)
+        return server.should_exit
+
+    assert asyncio.run(terminate()) is True
+
+
+@pytest.mark.parametrize("fail", [False, True])
+def test_worker_exit_status(monkeypatch, fail):
+    def run_worker(app, sock):
+        if fail:
+            raise RuntimeError("worker failed to start")
+
+    monkeypatch.setattr(server, "run_worker", run_worker)
+    supervisor = Supervisor(None, None, workers=1)
+    supervisor.spawn()
+    _, status = os.waitpid(supervisor.children.pop(), 0)
+    assert os.waitstatus_to_exitcode(status) == int(fail)
+
+
+def test_server_requires_shared_state(monkeypatch):
+    monkeypatch.setattr(settings, "STATE_BACKEND", "memory")
+    check_state_backend(1)
+    with pytest.raises(ValueError):
+        check_state_backend(2)
+    monkeypatch.setattr(settings, "STATE_BACKEND", "sqlite")
+    check_state_backend(2)
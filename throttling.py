@@ -0,0 +1,81 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from fastapi import HTTPException, status
+from config import settings
+from state_store import StateStore, state_store
+
+
+class TokenBucketStore:
+    """In memory token buckets, sharded across locks so checks on different keys rarely contend."""
+
+    def __init__(self, shards: int = 64, max_keys_per_shard: int = 10000):
+        self.max_keys_per_shard = max_keys_per_shard
+        self._shards = [(threading.Lock(), OrderedDict()) for _ in range(shards)]
+
+    # Returns 0 if a token was taken, otherwise the seconds until the next token is available. Never waits, it is
+    # only async to match SharedThrottleStore
+    async def take(self, key, capacity: float, refill_per_second: float) -> float:
+        lock, buckets = self._shards[hash(key) % len(self._shards)]
+        now = time.monotonic()
+        with lock:
+            tokens, updated_at = buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated_at) * refill_per_second)
+            retry_after = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                retry_after = (1 - tokens) / refill_per_second
+            buckets[key] = (tokens, now)
+            buckets.move_to_end(key)
+            # The least recently used bucket has had the longest to refill, so it is the cheapest one to forget
+            if len(buckets) > self.max_keys_per_shard:
+                buckets.popitem(last=False)
+            return retry_after
+
+    def clear(self):
+        for lock, buckets in self._shards:
+            with lock:
+                buckets.clear()
+
+
+class SharedThrottleStore:
+    """Throttles shared by every worker, as fixed window counters in the state store.
+
+    A window is the time an empty bucket takes to refill, so the long run rate and the burst match the token
+    bucket, though a client can get up to twice the capacity through across a window boundary.
+    """
+
+    def __init__(self, store: StateStore):
+        self.store = store
+
+    async def take(self, key, capacity: float, refill_per_second: float) -> float:
+        window = capacity / refill_per_second
+        window_index, elapsed = divmod(time.time(), window)
+        count = await self.store.incr(f"throttle:{':'.join(map(str, key))}:{int(window_index)}", ttl=window)
+        return 0.0 if count <= capacity else window - elapsed
+
+    def clear(self):
+        self.store.clear()
+
+
+throttle_store = SharedThrottleStore(state_store) if state_store.shared else TokenBucketStore()
+
+
+# Call before any database query or password hash so throttled requests cost next to nothing
+async def enforce_throttle(client_ip: str, identity: tuple | None = None):
+    if not settings.THROTTLE_ENABLED:
+        return
+    retry_after = await throttle_store.take(("ip", client_ip),
+                                            settings.THROTTLE_IP_CAPACITY,
+                                            settings.THROTTLE_IP_REFILL_PER_SECOND)
+    if identity is not None:
+        identity_key = ("identity",) + tuple(str(part).lower() for part in identity)
+        retry_after = max(retry_after, await throttle_store.take(identity_key,
+                                                                 settings.THROTTLE_IDENTITY_CAPACITY,
+                                                                 settings.THROTTLE_IDENTITY_REFILL_PER_SECOND))
+    if retry_after > 0:
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                            detail="Too many requests",
+                            headers={"Retry-After": str(math.ceil(retry_after))})
@@ -2,12 +2,13 @@ from typing import Annotated
 from fastapi import HTTPException, status, Depends
 from fastapi.security import OAuth2PasswordBearer
 from jose import jwt, JWTError
-from argon2 import PasswordHasher
 from config import settings
+from jwt_utilities import get_signing_keys
+from hash_utils import build_password_hasher
 from database.crud import get_user_by_username
 
 
-pwd_hasher = PasswordHasher()
+pwd_hasher = build_password_hasher()
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
 
@@ -18,7 +19,7 @@ async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], db, se
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        token_payload = jwt.decode(token, str(settings.SECRET_KEY), algorithms=settings.JWT_ALGORITHM)
+        token_payload = jwt.decode(token, get_signing_keys().verification_key, algorithms=settings.JWT_ALGORITHM)
         username: str = token_payload.get("sub")
         if username is None:
             raise auth_exception
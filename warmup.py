@@ -0,0 +1,51 @@
+"""Start up warm-up, so the first real request doesn't pay for work every later request gets for free."""
+import logging
+import time
+from contextlib import asynccontextmanager, contextmanager
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import configure_mappers
+from config import services
+from database.crud import get_user_by_username_async, get_user_by_email_async, get_user_by_public_id_async, \
+    get_refresh_token_async, get_outbox_depth
+from hash_utils import PasswordHashExecutor, password_hasher
+from jwt_utilities import encode_jwt, decode_jwt
+
+
+logger = logging.getLogger(__name__)
+
+WARMUP_VALUE = "warm-up"
+
+
+@contextmanager
+def _timed(timings: dict[str, float], step: str):
+    start = time.perf_counter()
+    yield
+    timings[step] = time.perf_counter() - start
+
+
+# Each lookup matches no rows, it runs only to open a pooled connection and put the compiled statement in the
+# engine's query cache. Lookups that miss are not stored in the user cache
+async def _compile_queries(db: AsyncSession, service: str):
+    await get_user_by_username_async(db, WARMUP_VALUE, service)
+    await get_user_by_email_async(db, WARMUP_VALUE, service)
+    await get_user_by_public_id_async(db, WARMUP_VALUE, service)
+    await get_refresh_token_async(db, WARMUP_VALUE, service)
+    await get_outbox_depth(db)
+
+
+# get_db is the same session dependency the routes use, so overrides (e.g. in tests) are warmed up too
+async def warm_up(get_db, hasher: PasswordHashExecutor = password_hasher) -> dict[str, float]:
+    timings = {}
+    service = next(iter(services))
+    with _timed(timings, "configure_mappers"):
+        configure_mappers()
+    with _timed(timings, "queries"):
+        async with asynccontextmanager(get_db)() as db:
+            await _compile_queries(db, service)
+    with _timed(timings, "jwt"):
+        decode_jwt(encode_jwt({"sub": WARMUP_VALUE}, service))
+    # Also starts the hashing pool's worker processes
+    with _timed(timings, "argon2"):
+        await hasher.hash(WARMUP_VALUE)
+    logger.info("Warm-up took %s", ", ".join(f"{step} {seconds * 1000:.1f}ms" for step, seconds in timings.items()))
+    return timings